@@ -32,26 +32,64 @@ import codecs
 import configparser
 import threading
 import datetime
+import time
+import collections
+import concurrent.futures
+import multiprocessing
 from io import BytesIO
 
 # 分離したモジュールをインポート
 from image_utils import (
     contraction, 
     pil_through_paste_greyscale, 
+    ndarray_through_paste_greyscale,
+    ndarray_paste,
     letter_to_pil_image, 
     greyscale_autocrop,
-    maybe_list_natsort
+    maybe_list_natsort,
+    get_truetype_font,
+    invalidate_font_pool,
+    ImageLRUCache,
+    image_size_bytes
 )
-from csv_utils import csv_to_list, pil_printing
+from csv_utils import read_csv_file, collect_csv_rows, AddressTableModel, AddressTableHistory, pil_printing, PdfPrintBatch, PrintPipeline, PrintJobJournal, PrintJobMetrics, printer_capabilities, make_spool_backend, SPOOL_BACKEND_NAMES, CardFileExporter, EXPORT_FORMATS, PDF_IMAGE_ENCODINGS
 
+#NumPyは宛名画像をndarrayで合成するモード（canvas_mode = "numpy"）でのみ使う
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+
+#宛名画像の解像度（pixel/mm）の段階
+#draftは画面表示用の粗いもの、standardは従来の8pixel/mm、highは600dpi程度のプリンター用
+RENDER_RESOLUTION_TIERS = { "draft" : 3, "standard" : 8, "high" : 24 }
+
+#レイアウト辞書のフォントサイズや赤枠の線幅は、この解像度でのピクセル数として保存している
+STANDARD_MM_PIXEL_RATE = RENDER_RESOLUTION_TIERS[ "standard" ]
+
+#プリンターに送らずPDFファイルとして保存する場合に、フォルダの指定がなければ使う（このソフトのフォルダの中の）フォルダ名
+DEFAULT_SPOOL_DIRECTORY_NAME = "print-spool"
+
+#住所表の列幅・行の高さを自動調整するときに、調べる行の数（全行は調べない）
+TABLE_AUTOSIZE_SAMPLE_ROWS = 200
 
 
 class atena_image_maker():
 
-	def __init__( self, papersize_widthheight_millimetre = ( 100, 148 ), overwrite_settings = {} ):
+	def __init__( self, papersize_widthheight_millimetre = ( 100, 148 ), overwrite_settings = {}, canvas_mode = "pil", resolution = "standard" ):
+
+		#用紙サイズ（mm）は、別の解像度のインスタンスを作り直す（derive）ときのために控えておく
+		self.papersize_mm = ( papersize_widthheight_millimetre[0], papersize_widthheight_millimetre[1] )
 
 		#画素数とミリメートルの変換比（pixel/mm）。用紙サイズや各パーツの配置の基準となる。
-		self.mm_pixel_rate = 8
+		#resolutionには段階の名前（"draft"、"standard"、"high"）か、pixel/mmの数値を渡す
+		self.resolution = resolution
+		self.mm_pixel_rate = self.resolution_to_mm_pixel_rate( resolution )
+
+		#レイアウト辞書のフォントサイズ（標準解像度でのピクセル数）に掛ける倍率
+		self.resolution_scale = self.mm_pixel_rate / STANDARD_MM_PIXEL_RATE
 
 		#宛名の画像イメージの横幅と縦の長さを何ピクセルにするかを算出する。
 		#横幅のピクセル値から、様々な寸法を連動して決定することになる。
@@ -64,14 +102,16 @@ class atena_image_maker():
 		#各項目のフォントサイズ
 		#レイアウトの〜-areasizeを大きくしても、このサイズ以上には字は大きくなりません。
 		#万一、文字をものすごく大きくしたいという人がいましたら、ここを増やしてください。
-		self.postalcode_fontsize = int( self.width / 7 )
-		self.name_fontsize = int( self.width / 4 )
-		self.company_fontsize = int( self.width / 9 )
-		self.department_fontsize = int( self.width / 11 )
-		self.address_fontsize = int( self.width / 10 )
-		self.our_postalcode_fontsize = int( self.width / 11 )
-		self.our_name_fontsize = int( self.width / 10 )
-		self.our_address_fontsize = int( self.width / 15 )
+		#（解像度によらず同じレイアウト辞書を使えるように、標準解像度での横幅から決める）
+		standard_width = papersize_widthheight_millimetre[0] * STANDARD_MM_PIXEL_RATE
+		self.postalcode_fontsize = int( standard_width / 7 )
+		self.name_fontsize = int( standard_width / 4 )
+		self.company_fontsize = int( standard_width / 9 )
+		self.department_fontsize = int( standard_width / 11 )
+		self.address_fontsize = int( standard_width / 10 )
+		self.our_postalcode_fontsize = int( standard_width / 11 )
+		self.our_name_fontsize = int( standard_width / 10 )
+		self.our_address_fontsize = int( standard_width / 15 )
 
 		#フォントの画像を取得するための台紙画像の正方形の一辺の長さ
 		#暫定的に宛名画像の幅にしておくが、あとでGUIオブジェクトから再決定関数を起動する
@@ -96,6 +136,50 @@ class atena_image_maker():
 		#引数として与えられている設定上書き用の辞書で、設定の初期値を更新する
 		self.parts_dict.update( overwrite_settings )
 
+		#parts_setting で作った縦書き部分の画像の控え（同じ文字列・同じ条件なら作り直さない）
+		self.parts_memo = ImageLRUCache( max_bytes = 32 * 1024 * 1024 )
+
+		#差出人など宛先によらない部分だけを貼り付けた、印刷ジョブの下地画像（prepare_job_templateで作成）
+		self.job_template = None
+
+		#郵便番号の数字のスプライト（get_postalcode_spritesで作成）
+		self.postalcode_sprites = {}
+
+		#宛名画像を合成する台紙の持ち方
+		#"pil"（標準）はPILイメージ、"numpy"はuint8のndarrayで合成して、最後に一度だけPILイメージに変換する
+		self.canvas_mode = "pil"
+		self.set_canvas_mode( canvas_mode )
+
+
+	#解像度の段階の名前かpixel/mmの数値を、pixel/mmの数値にする（不明な名前なら標準解像度にする）
+	def resolution_to_mm_pixel_rate( self, resolution ):
+		if isinstance( resolution, ( int, float ) ) and not isinstance( resolution, bool ) and resolution > 0:
+			return resolution
+
+		if resolution in RENDER_RESOLUTION_TIERS:
+			return RENDER_RESOLUTION_TIERS[ resolution ]
+
+		print( "解像度の指定「" + str( resolution ) + "」が不明なので、標準の解像度（" + str( STANDARD_MM_PIXEL_RATE ) + "pixel/mm）にします。" )
+		return STANDARD_MM_PIXEL_RATE
+
+
+	#同じ用紙サイズ・レイアウトで、解像度だけを変えた宛名画像生成インスタンスを返す
+	#（画面表示用と印刷用で解像度を分けるため。解像度が同じなら自分自身を返す）
+	def derive( self, resolution ):
+		if self.resolution_to_mm_pixel_rate( resolution ) == self.mm_pixel_rate:
+			return self
+
+		derived_maker = atena_image_maker( papersize_widthheight_millimetre = self.papersize_mm, overwrite_settings = copy.deepcopy( self.parts_dict ), canvas_mode = self.canvas_mode, resolution = resolution )
+		derived_maker.standard_parts_dict = copy.deepcopy( self.standard_parts_dict )
+		derived_maker.determine_fontmat_size( derived_maker.parts_dict[ "fontfile" ] )
+
+		return derived_maker
+
+
+	#レイアウト辞書の値（標準解像度でのピクセル数）を、この解像度でのピクセル数にする
+	def scale_standard_pixel( self, standard_pixel ):
+		return int( standard_pixel * self.resolution_scale )
+
 
 	#宛名レイアウトの値を書き換える関数
 	def set_parts_data( self, dict_key, value, list_position = None ):
@@ -141,15 +225,18 @@ class atena_image_maker():
 
 
 	#宛名、住所、差出人など、縦書き部分の画像を作成する関数。
+	#まず各字の画像と置く位置を決めてから、必要な大きさだけの台紙を作って貼り付ける。
 	def vertical_text( self, text, font_path ,font_size, mat_size ):
 
 		if not os.path.isfile( font_path ):
 			print( "関数に渡されたフォントのパス「" + font_path + "」が存在しません。\nこれでは実行不可能なので終了します。" )
 			sys.exit()
 
-		image = Image.new( "L", ( int( self.width / 2 ), self.height * 4 ), 255 )
-		font = ImageFont.truetype( font_path, font_size, encoding="unic" )
+		#以前は幅 width/2、高さ height*4 の台紙に直接貼り付けていたので、その範囲をはみ出す部分は切り捨てる
+		mat_width = int( self.width / 2 )
+		mat_height = self.height * 4
 		vertical_position = 0 #それぞれの字を置く縦の位置
+		placement_list = [] #（字の画像、横の位置、縦の位置）を並べたもの
 
 		#「|」の高さを半角・全角スペースの間隔を算出する基準とし、その1/5を文字の間隔（vertical_space）とする。
 		letter_image = letter_to_pil_image( "|", font_path, font_size, max_square_width = mat_size )
@@ -162,6 +249,7 @@ class atena_image_maker():
 		horizontal_line2 = "━"
 		horizontal_line3 = "＝"
 
+		#1回目：各字の画像を用意して、置く位置を決めていく
 		for i in range( len( text ) ):
 			if text[i] == fullsize_space:
 				vertical_position += int( vertical_unit * 0.8 )
@@ -185,47 +273,104 @@ class atena_image_maker():
 
 				else:
 					if single_area.size[1] > int( vertical_unit * 0.3 ):
-						image.paste( single_area,( int( ( image.size[0] - single_area.size[0] ) / 2 ), vertical_position ) )
+						placement_list.append( ( single_area, int( ( mat_width - single_area.size[0] ) / 2 ), vertical_position ) )
 						vertical_position += single_area.size[1] + vertical_space
 					else:
 					#漢数字の一のように高さがあまりに小さい場合、前後の字との間隔を2倍にする。
-						image.paste( single_area,( int( ( image.size[0] - single_area.size[0] ) / 2 ), vertical_position + vertical_space ) )
+						placement_list.append( ( single_area, int( ( mat_width - single_area.size[0] ) / 2 ), vertical_position + vertical_space ) )
 						vertical_position += single_area.size[1] + vertical_space * 3
 
+		#2回目：字が置かれる範囲だけの台紙を作って貼り付ける
+		if placement_list == []:
+			image = Image.new( "L", ( 1, 1 ), 255 )
+
+		else:
+			left_end = max( 0, min( [ x[1] for x in placement_list ] ) )
+			right_end = min( mat_width, max( [ x[1] + x[0].size[0] for x in placement_list ] ) )
+			bottom_end = min( mat_height, max( [ x[2] + x[0].size[1] for x in placement_list ] ) )
+
+			if right_end <= left_end or bottom_end <= 0:
+				image = Image.new( "L", ( 1, 1 ), 255 )
+			else:
+				image = Image.new( "L", ( right_end - left_end, bottom_end ), 255 )
+				for single_area, position_x, position_y in placement_list:
+					image.paste( single_area, ( position_x - left_end, position_y ) )
+
 		return greyscale_autocrop( image )
 
 
 	#郵便番号のPILイメージを作成する
 	#番号の間隔をあらかじめミリメートルで指定しているので、郵便番号については全体の縮小はしない。（1字ごとの縮小はする）
+	#各数字は、あらかじめ縮小済みの画像（スプライト）を貼り付けるだけにしている。
 	def postal_code_build( self, code, center_list, font_path ,font_size, letter_size_list, mat_size ):
 
 		letter_size_x = int( letter_size_list[0] * self.mm_pixel_rate )
 		letter_size_y = int( letter_size_list[1] * self.mm_pixel_rate )
-		pcode_image = Image.new( "L", ( self.width, int( self.width / 4 ) ), 255 )
 
-		horizontal_zero_point = int( letter_size_x / 2 )
+		digit_sprites = self.get_postalcode_sprites( font_path, font_size, letter_size_x, letter_size_y, mat_size )
 
-		for i in range( 0, 7 ):
-			single_letter = letter_to_pil_image( code[i], font_path, font_size, max_square_width = mat_size )
+		#以前は幅 width、高さ width/4 の台紙に貼ってから切り抜いていたので、
+		#切り抜く範囲がその台紙に収まる場合は、切り抜く大きさの台紙に直接貼る
+		pcode_size = ( center_list[5] + letter_size_x, letter_size_y )
+		if pcode_size[0] <= self.width and pcode_size[1] <= int( self.width / 4 ):
+			pcode_image = Image.new( "L", pcode_size, 255 )
+		else:
+			pcode_image = Image.new( "L", ( self.width, int( self.width / 4 ) ), 255 )
 
-			#まず、収めようとする範囲の高さに合わせて縮小（ここではアスペクト比は保持する）
-			single_letter = single_letter.resize( ( int( single_letter.size[0] * letter_size_y / single_letter.size[1] ), letter_size_y ), Image.LANCZOS )
+		horizontal_zero_point = int( letter_size_x / 2 )
 
-			#高さを揃えた上で、収めようとする範囲より横長なら、横幅だけを縮小する
-			#※アスペクト比を捨てるので、収める範囲があまりに縦長だと見苦しくなる
-			#しかし、アスペクト比を保つと数字の大きさがバラつきすぎる場合があるので、このほうがまだマシだと判断した
-			if single_letter.size[0] > letter_size_x:
-				single_letter = single_letter.resize( ( letter_size_x, single_letter.size[1] ), Image.LANCZOS )
+		for i in range( 0, 7 ):
+			single_letter = digit_sprites.get( code[i] )
+			if single_letter is None:
+				single_letter = self.make_postalcode_letter_image( code[i], font_path, font_size, letter_size_x, letter_size_y, mat_size )
 
 			if i == 0:
 				pcode_image.paste( single_letter,( int( ( letter_size_x - single_letter.size[0] ) / 2 ), 0 ) )
 			else:
 				pcode_image.paste( single_letter,( horizontal_zero_point + center_list[ i - 1 ] - int( single_letter.size[0] / 2 ), 0 ) )
 
-		pcode_image = pcode_image.crop( ( 0, 0, center_list[5] + letter_size_x, letter_size_y ) )
+		if pcode_image.size != pcode_size:
+			pcode_image = pcode_image.crop( ( 0, 0, pcode_size[0], pcode_size[1] ) )
+
 		return pcode_image
 
 
+	#郵便番号の1字分の画像を、収める範囲の大きさに合わせて縮小して返す
+	def make_postalcode_letter_image( self, letter, font_path ,font_size, letter_size_x, letter_size_y, mat_size ):
+		single_letter = letter_to_pil_image( letter, font_path, font_size, max_square_width = mat_size )
+
+		#まず、収めようとする範囲の高さに合わせて縮小（ここではアスペクト比は保持する）
+		single_letter = single_letter.resize( ( int( single_letter.size[0] * letter_size_y / single_letter.size[1] ), letter_size_y ), Image.LANCZOS )
+
+		#高さを揃えた上で、収めようとする範囲より横長なら、横幅だけを縮小する
+		#※アスペクト比を捨てるので、収める範囲があまりに縦長だと見苦しくなる
+		#しかし、アスペクト比を保つと数字の大きさがバラつきすぎる場合があるので、このほうがまだマシだと判断した
+		if single_letter.size[0] > letter_size_x:
+			single_letter = single_letter.resize( ( letter_size_x, single_letter.size[1] ), Image.LANCZOS )
+
+		return single_letter
+
+
+	#0〜9の数字のスプライトを（フォント, フォントサイズ, 1字の範囲, 台紙サイズ）ごとに作って控えておき、それを返す
+	def get_postalcode_sprites( self, font_path, font_size, letter_size_x, letter_size_y, mat_size ):
+		sprite_key = ( font_path, font_size, letter_size_x, letter_size_y, mat_size )
+		digit_sprites = self.postalcode_sprites.get( sprite_key )
+
+		if digit_sprites is None:
+			digit_sprites = {}
+			for digit in "0123456789":
+				digit_sprites[ digit ] = self.make_postalcode_letter_image( digit, font_path, font_size, letter_size_x, letter_size_y, mat_size )
+
+			self.postalcode_sprites[ sprite_key ] = digit_sprites
+
+		return digit_sprites
+
+
+	#郵便番号のスプライトを破棄する（1字の範囲やフォントが変更されたとき用）
+	def clear_postalcode_sprites( self ):
+		self.postalcode_sprites = {}
+
+
 	#与えた文字列から縦書き画像を作成して、指定位置の指定方向に来るように貼り付ける。
 	def parts_setting( self, image, text1, text2, font, fontsize, position_xy, size_xy, mat_size, mm_space = 1, direction = ( "center", "center" ), alignment_mode = "address" ):
 
@@ -234,6 +379,42 @@ class atena_image_maker():
 
 		#ミリメートルで指定された値をピクセルに変換する。
 		parts_position = [ int( x * self.mm_pixel_rate ) for x in position_xy ]
+
+		united_parts, oneline_areasize = self.get_parts_image( text1, text2, font, fontsize, size_xy, mat_size, mm_space, alignment_mode )
+
+		#左右方向の指定に従い、貼り付け位置を決める
+		if direction[0] == "right" :
+			pastepoint_x = parts_position[0]
+		elif direction[0] == "left" :
+			pastepoint_x = parts_position[0] - united_parts.size[0]
+		else:
+			pastepoint_x = int( parts_position[0] - united_parts.size[0] / 2 )
+
+		#上下方向の指定に従い、貼り付け位置を決める
+		if direction[1] == "down" :
+			pastepoint_y = parts_position[1]
+		elif direction[1] == "up" :
+			pastepoint_y = parts_position[1] - united_parts.size[1]
+		else:
+			pastepoint_y = int( parts_position[1] - united_parts.size[1] / 2 )
+
+		self.through_paste( image, united_parts, ( pastepoint_x , pastepoint_y ) )
+
+		#貼り付けた範囲（始点、終点）と一列目（name1、address1など）の大きさを返す
+		return { "start-point" : ( pastepoint_x , pastepoint_y ), "end-point" : ( pastepoint_x + united_parts.size[0], pastepoint_y + united_parts.size[1] ), "oneline-areasize" : oneline_areasize }
+
+
+	#縦書きの文字列（一列か二列）を縮小・結合した画像と、各列の大きさのリストを返す。
+	#同じ条件で作った画像はparts_memoに控えておき、次からはそれを返す。
+	#（差出人の部分や、家族で共通の住所などは毎回同じ画像になるので）
+	def get_parts_image( self, text1, text2, font, fontsize, size_xy, mat_size, mm_space = 1, alignment_mode = "address" ):
+
+		#二列の名前の揃え方はレイアウト辞書から読むので、それもキーに含める
+		memo_key = ( text1, text2, font, fontsize, tuple( size_xy ), mm_space, alignment_mode, self.parts_dict.get( "twoname-alignment-mode" ), mat_size, self.width, self.mm_pixel_rate )
+		memo_result = self.parts_memo.get( memo_key )
+		if memo_result is not None:
+			return memo_result[0], list( memo_result[1] )
+
 		parts_size = [ int( x * self.mm_pixel_rate ) for x in size_xy ]
 		space = mm_space * self.mm_pixel_rate
 
@@ -305,26 +486,8 @@ class atena_image_maker():
 				united_parts.paste( resized_part2, ( 0, united_parts.size[1] - resized_part2.size[1] ) )
 				united_parts.paste( resized_part1, ( int( resized_part2.size[0] + space ), united_parts.size[1] - resized_part1.size[1] ) )
 
-		#左右方向の指定に従い、貼り付け位置を決める
-		if direction[0] == "right" :
-			pastepoint_x = parts_position[0]
-		elif direction[0] == "left" :
-			pastepoint_x = parts_position[0] - united_parts.size[0]
-		else:
-			pastepoint_x = int( parts_position[0] - united_parts.size[0] / 2 )
-
-		#上下方向の指定に従い、貼り付け位置を決める
-		if direction[1] == "down" :
-			pastepoint_y = parts_position[1]
-		elif direction[1] == "up" :
-			pastepoint_y = parts_position[1] - united_parts.size[1]
-		else:
-			pastepoint_y = int( parts_position[1] - united_parts.size[1] / 2 )
-
-		pil_through_paste_greyscale( image, united_parts, ( pastepoint_x , pastepoint_y ), 255 )
-
-		#貼り付けた範囲（始点、終点）と一列目（name1、address1など）の大きさを返す
-		return { "start-point" : ( pastepoint_x , pastepoint_y ), "end-point" : ( pastepoint_x + united_parts.size[0], pastepoint_y + united_parts.size[1] ), "oneline-areasize" : oneline_areasize }
+		self.parts_memo.put( memo_key, ( united_parts, list( oneline_areasize ) ), image_size_bytes( united_parts ) )
+		return united_parts, oneline_areasize
 
 
 	#郵便番号から画像を作成して、指定位置の指定方向に来るように貼り付ける。
@@ -380,17 +543,29 @@ class atena_image_maker():
 		else:
 			pastepoint_y = int( pc_position[1] - pc_image.size[1] / 2 )
 
-		pil_through_paste_greyscale( image, pc_image, ( pastepoint_x , pastepoint_y ), 255 )
+		self.through_paste( image, pc_image, ( pastepoint_x , pastepoint_y ) )
 
 
 	#台紙画像の上に各部品を配置していき、宛名画像を作成する
 	def get_atena_image( self, data_dict, area_frame = False ):
+		return self.canvas_to_image( self.compose_atena_canvas( data_dict, area_frame ) )
+
+
+	#get_atena_imageの本体。numpyモードではndarrayのまま返す
+	def compose_atena_canvas( self, data_dict, area_frame = False ):
 
-		atena_image = self.atena_baseimage.copy()
+		#差出人の部分を描いた下地が用意されていて、レイアウトも差出人も同じなら、その上に宛先だけを描く
+		#（透過貼り付けは重ねる順番によらず同じ結果になるので、差出人を先に描いておいてもかまわない）
+		if self.job_template is not None and self.job_template[ "key" ] == self.get_job_template_key( data_dict ):
+			atena_image = self.job_template[ "image" ].copy()
+			our_parts_pasted = True
+		else:
+			atena_image = self.new_canvas()
+			our_parts_pasted = False
 
-		# フォントサイズの倍率を取得
+		# フォントサイズの倍率を取得（レイアウト辞書のフォントサイズは標準解像度での値なので、解像度の倍率も掛ける）
 		resize_percent = self.parts_dict.get( "resize％", [ 100, 100 ] )
-		font_scale = resize_percent[0] / 100.0
+		font_scale = resize_percent[0] / 100.0 * self.resolution_scale
 
 		#宛先の郵便番号
 		self.postalcode_setting( image = atena_image, postal_code = data_dict.get( "postal-code", "" ), font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "postalcode-fontsize" ] * font_scale ), letter_size_xy = self.parts_dict[ "postalcode-letter-areasize" ], position_xy = self.parts_dict[ "postalcode-position" ], center_mm_list = self.parts_dict[ "postalcode-placement" ], direction = self.parts_dict[ "postalcode-direction" ], mat_size = self.postalcode_fontmat_size )
@@ -409,28 +584,28 @@ class atena_image_maker():
 			if len( name_result.get( "oneline-areasize" ) ) == 1:
 				honorific_image = contraction( honorific_image_origine, ( name_result.get( "oneline-areasize" )[0][0], name_result.get( "oneline-areasize" )[0][1] * 3 ) )
 
-				pil_through_paste_greyscale( atena_image, honorific_image, ( int( ( name_result.get( "start-point" )[0] + name_result.get( "end-point" )[0] ) / 2 - honorific_image.size[0] / 2 ), name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ), 255 )
+				self.through_paste( atena_image, honorific_image, ( int( ( name_result.get( "start-point" )[0] + name_result.get( "end-point" )[0] ) / 2 - honorific_image.size[0] / 2 ), name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ) )
 
 			#宛名が二列あってtwoname-honorific-modeが1なら、二列の中間の大きさで中央に一つ敬称を付ける。
 			elif self.parts_dict.get( "twoname-honorific-mode" ) == 1:
 				honorific_image = contraction( honorific_image_origine, ( int( ( name_result.get( "oneline-areasize" )[0][0] + name_result.get( "oneline-areasize" )[1][0] ) / 2 ), int( ( name_result.get( "oneline-areasize" )[0][1] + name_result.get( "oneline-areasize" )[1][1] ) / 2 ) * 3 ) )
 
-				pil_through_paste_greyscale( atena_image, honorific_image, ( int( ( name_result.get( "start-point" )[0] + name_result.get( "end-point" )[0] ) / 2 - honorific_image.size[0] / 2 ), name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ), 255 )
+				self.through_paste( atena_image, honorific_image, ( int( ( name_result.get( "start-point" )[0] + name_result.get( "end-point" )[0] ) / 2 - honorific_image.size[0] / 2 ), name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ) )
 
 			#宛名が二列あってtwoname-honorific-modeが2なら、二列それぞれに敬称を付ける。
 			elif self.parts_dict.get( "twoname-honorific-mode" ) == 2:
 				honorific_image1 = contraction( honorific_image_origine, ( name_result.get( "oneline-areasize" )[0][0], name_result.get( "oneline-areasize" )[0][1] * 3 ) )
 				honorific_image2 = contraction( honorific_image_origine, ( name_result.get( "oneline-areasize" )[1][0], name_result.get( "oneline-areasize" )[1][1] * 3 ) )
 
-				pil_through_paste_greyscale( atena_image, honorific_image2, ( name_result.get( "start-point" )[0], name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ), 255 )
+				self.through_paste( atena_image, honorific_image2, ( name_result.get( "start-point" )[0], name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ) )
 
-				pil_through_paste_greyscale( atena_image, honorific_image1, ( name_result.get( "end-point" )[0] - name_result.get( "oneline-areasize" )[0][0], name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ), 255 )
+				self.through_paste( atena_image, honorific_image1, ( name_result.get( "end-point" )[0] - name_result.get( "oneline-areasize" )[0][0], name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ) )
 
 			#宛名が二列あってtwoname-honorific-modeが1,2以外（3を想定）なら、左側にのみ敬称を付ける。
 			else:
 				honorific_image2 = contraction( honorific_image_origine, ( name_result.get( "oneline-areasize" )[1][0], name_result.get( "oneline-areasize" )[1][1] * 3 ) )
 
-				pil_through_paste_greyscale( atena_image, honorific_image2, ( name_result.get( "start-point" )[0], name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ), 255 )
+				self.through_paste( atena_image, honorific_image2, ( name_result.get( "start-point" )[0], name_result.get( "end-point" )[1] + int( self.parts_dict[ "honorific-space" ] * self.mm_pixel_rate ) ) )
 
 		#宛先の会社名
 		self.parts_setting( image = atena_image, text1 = data_dict.get( "company", "" ), text2 = "", font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "company-fontsize" ] * font_scale ), position_xy = self.parts_dict[ "company-position" ], size_xy = self.parts_dict[ "company-areasize" ], mat_size = self.company_fontmat_size, mm_space = self.parts_dict[ "company-bind-space" ], direction = self.parts_dict[ "company-direction" ], alignment_mode = "address" )
@@ -441,14 +616,9 @@ class atena_image_maker():
 		#宛先の住所
 		self.parts_setting( image = atena_image, text1 = data_dict.get( "address1", "" ), text2 = data_dict.get( "address2", "" ), font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "address-fontsize" ] * font_scale ), position_xy = self.parts_dict[ "address-position" ], size_xy = self.parts_dict[ "address-areasize" ], mat_size = self.address_fontmat_size, mm_space = self.parts_dict[ "address-bind-space" ], direction = self.parts_dict[ "address-direction" ], alignment_mode = "address" )
 
-		#差出人側の郵便番号
-		self.postalcode_setting( image = atena_image, postal_code = data_dict.get( "our-postal-code", "" ), font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "our-postalcode-fontsize" ] * font_scale ), letter_size_xy = self.parts_dict[ "our-postalcode-letter-areasize" ], position_xy = self.parts_dict[ "our-postalcode-position" ], center_mm_list = self.parts_dict[ "our-postalcode-placement" ], direction = self.parts_dict[ "our-postalcode-direction" ], mat_size = self.our_postalcode_fontmat_size )
-
-		#差出人の氏名
-		self.parts_setting( image = atena_image, text1 = data_dict.get( "our-name1", "" ), text2 = data_dict.get( "our-name2", "" ), font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "our-name-fontsize" ] * font_scale ), position_xy = self.parts_dict[ "our-name-position" ], size_xy = self.parts_dict[ "our-name-areasize" ], mat_size = self.our_name_fontmat_size, mm_space = self.parts_dict[ "our-name-bind-space" ], direction = self.parts_dict[ "our-name-direction" ], alignment_mode = "name")
-
-		#差出人の住所
-		self.parts_setting( image = atena_image, text1 = data_dict.get( "our-address1", "" ), text2 = data_dict.get( "our-address2", "" ), font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "our-address-fontsize" ] * font_scale ), position_xy = self.parts_dict[ "our-address-position" ], size_xy = self.parts_dict[ "our-address-areasize" ], mat_size = self.our_address_fontmat_size, mm_space = self.parts_dict[ "our-address-bind-space" ], direction = self.parts_dict[ "our-address-direction" ], alignment_mode = "address" )
+		#差出人の郵便番号・氏名・住所
+		if our_parts_pasted is False:
+			self.paste_our_parts( atena_image, data_dict )
 
 		#郵便番号や住所や名前といった各パーツの最大範囲を示す枠を付加する
 		if area_frame is True:
@@ -540,6 +710,50 @@ class atena_image_maker():
 		return atena_image
 
 
+	#差出人の郵便番号・氏名・住所（宛先によらない部分）を台紙画像に貼り付ける
+	def paste_our_parts( self, atena_image, data_dict ):
+
+		# フォントサイズの倍率を取得（レイアウト辞書のフォントサイズは標準解像度での値なので、解像度の倍率も掛ける）
+		resize_percent = self.parts_dict.get( "resize％", [ 100, 100 ] )
+		font_scale = resize_percent[0] / 100.0 * self.resolution_scale
+
+		#差出人側の郵便番号
+		self.postalcode_setting( image = atena_image, postal_code = data_dict.get( "our-postal-code", "" ), font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "our-postalcode-fontsize" ] * font_scale ), letter_size_xy = self.parts_dict[ "our-postalcode-letter-areasize" ], position_xy = self.parts_dict[ "our-postalcode-position" ], center_mm_list = self.parts_dict[ "our-postalcode-placement" ], direction = self.parts_dict[ "our-postalcode-direction" ], mat_size = self.our_postalcode_fontmat_size )
+
+		#差出人の氏名
+		self.parts_setting( image = atena_image, text1 = data_dict.get( "our-name1", "" ), text2 = data_dict.get( "our-name2", "" ), font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "our-name-fontsize" ] * font_scale ), position_xy = self.parts_dict[ "our-name-position" ], size_xy = self.parts_dict[ "our-name-areasize" ], mat_size = self.our_name_fontmat_size, mm_space = self.parts_dict[ "our-name-bind-space" ], direction = self.parts_dict[ "our-name-direction" ], alignment_mode = "name")
+
+		#差出人の住所
+		self.parts_setting( image = atena_image, text1 = data_dict.get( "our-address1", "" ), text2 = data_dict.get( "our-address2", "" ), font = self.parts_dict[ "fontfile" ], fontsize = int( self.parts_dict[ "our-address-fontsize" ] * font_scale ), position_xy = self.parts_dict[ "our-address-position" ], size_xy = self.parts_dict[ "our-address-areasize" ], mat_size = self.our_address_fontmat_size, mm_space = self.parts_dict[ "our-address-bind-space" ], direction = self.parts_dict[ "our-address-direction" ], alignment_mode = "address" )
+
+
+	#印刷ジョブの下地として、差出人の部分だけを貼り付けた台紙画像を用意する
+	#以後、同じ差出人・同じレイアウトでget_atena_imageを呼ぶと、この下地のコピーに宛先だけを描く
+	def prepare_job_template( self, data_dict ):
+		template_key = self.get_job_template_key( data_dict )
+
+		if self.job_template is None or self.job_template[ "key" ] != template_key:
+			template_image = self.new_canvas()
+			self.paste_our_parts( template_image, data_dict )
+			self.job_template = { "key" : template_key, "image" : template_image }
+
+		return self.job_template[ "image" ]
+
+
+	#下地画像が使えるかどうかを判別するためのキー
+	#差出人のデータと、レイアウトや台紙の大きさが一致していれば同じ下地を使える
+	def get_job_template_key( self, data_dict ):
+		our_data_tuple = tuple( [ data_dict.get( x, "" ) for x in ( "our-postal-code", "our-name1", "our-name2", "our-address1", "our-address2" ) ] )
+		fontmat_tuple = ( self.our_postalcode_fontmat_size, self.our_name_fontmat_size, self.our_address_fontmat_size )
+
+		return ( our_data_tuple, json.dumps( self.parts_dict, sort_keys = True ), fontmat_tuple, self.width, self.height, self.mm_pixel_rate )
+
+
+	#下地画像を破棄する
+	def discard_job_template( self ):
+		self.job_template = None
+
+
 	#灰色の枠を作成し、ある位置から指定された方向にずらして台紙画像に貼り付ける
 	def paste_area_frame( self, base_image, area_size, area_position, area_direction, line_width, additional_height = 0 ):
 		#まず、引数にある線幅で枠の画像を作る
@@ -565,11 +779,12 @@ class atena_image_maker():
 		#台紙画像に貼り付ける
 		#pasteで単純に貼り付けると既存の字を消してしまうし、枠と字が重なる場合に
 		#どちらかだけにしたくないので、処理が重くなるが透過貼り付けの関数を使う
-		pil_through_paste_greyscale( base_image, frame_image, ( pastepoint_x, pastepoint_y ), 255 )
+		self.through_paste( base_image, frame_image, ( pastepoint_x, pastepoint_y ) )
 
 
 	#上下左右の余白領域を消した宛名画像を取得する
-	def get_cutted_atena_image( self, data_dict, space_tblr_mm_list = [ 0, 0, 0, 0 ], return_pasted_image = False, cutted_atena_image_upside_down = False ):
+	#rotate_upside_downをTrueにすると、切り抜いた画像を180°回転させて返す（上下反転印刷用）
+	def get_cutted_atena_image( self, data_dict, space_tblr_mm_list = [ 0, 0, 0, 0 ], return_pasted_image = False, cutted_atena_image_upside_down = False, rotate_upside_down = False ):
 
 		#ミリメートルで指定された値をピクセルに変換する
 		upper_space_pixel = int( space_tblr_mm_list[0] * self.mm_pixel_rate )
@@ -577,65 +792,146 @@ class atena_image_maker():
 		left_space_pixel = int( space_tblr_mm_list[2] * self.mm_pixel_rate )
 		right_space_pixel = int( space_tblr_mm_list[3] * self.mm_pixel_rate )
 
-		origin_atena_image = self.get_atena_image( data_dict )
+		origin_atena_image = self.compose_atena_canvas( data_dict )
+		origin_size = self.canvas_size( origin_atena_image )
 
 		if cutted_atena_image_upside_down is False:
-			cutted_atena_image = origin_atena_image.crop( ( left_space_pixel, upper_space_pixel, origin_atena_image.size[0] - right_space_pixel, origin_atena_image.size[1] - down_space_pixel ) )
+			cut_box = ( left_space_pixel, upper_space_pixel, origin_size[0] - right_space_pixel, origin_size[1] - down_space_pixel )
 
 		else:
-			cutted_atena_image = origin_atena_image.crop( ( right_space_pixel, down_space_pixel, origin_atena_image.size[0] - left_space_pixel, origin_atena_image.size[1] - upper_space_pixel ) )
+			cut_box = ( right_space_pixel, down_space_pixel, origin_size[0] - left_space_pixel, origin_size[1] - upper_space_pixel )
+
+		cutted_atena_image = self.crop_canvas( origin_atena_image, cut_box )
 
 		#印刷「プレビュー」用に、上下左右を切り取った画像を、元サイズの空白画像に貼り付けて返す
 		#（プリンターで印刷できない部分が空白領域として存在している）
 		if return_pasted_image is True:
-			paste_image = Image.new( "L", origin_atena_image.size, 255 )
-
-			if cutted_atena_image_upside_down is False:
-				paste_image.paste( cutted_atena_image, ( left_space_pixel, upper_space_pixel ) )
-			else:
-				paste_image.paste( cutted_atena_image, ( right_space_pixel, down_space_pixel ) )
-
-			return paste_image
+			result_image = self.new_canvas( origin_size )
+			self.paste_canvas( result_image, cutted_atena_image, ( cut_box[0], cut_box[1] ) )
 
 		else:
 			#印刷用に、「印刷不可能部分が削除されて存在しない」画像を返す
-			return cutted_atena_image
+			result_image = cutted_atena_image
+
+		if rotate_upside_down is True:
+			result_image = self.rotate_canvas_180( result_image )
+
+		return self.canvas_to_image( result_image )
 
 
 	def make_A6_image( self, datadict_or_pilimage ):
 
-		A6_image = self.A6_baseimage.copy()
+		A6_image = self.new_canvas( self.A6_baseimage.size )
 		mode = self.parts_dict.get( "A6-adjust-mode" )
 		paste_point = self.parts_dict.get( "A6-adjust-point" )
 		resize_percent = self.parts_dict.get( "resize％" )
 
 		if isinstance( datadict_or_pilimage, dict ):
-			image = self.get_atena_image( datadict_or_pilimage )
+			image = self.compose_atena_canvas( datadict_or_pilimage )
 		else:
 			image = datadict_or_pilimage
 
 		if resize_percent != [ 100, 100 ]:
+			image = self.canvas_to_image( image )
 			image = image.resize( ( int( image.size[0] * resize_percent[0] / 100 ), int( image.size[1] * resize_percent[1] / 100 ) ), Image.LANCZOS )
 
+		A6_size = self.canvas_size( A6_image )
+		image_size = self.canvas_size( image )
+
 		if mode == "manual" :
 			A6_adjust_pixel = ( int( paste_point[0] * self.mm_pixel_rate ), int( paste_point[1] * self.mm_pixel_rate ) )
-			A6_image.paste( image, A6_adjust_pixel )
+			self.paste_canvas( A6_image, image, A6_adjust_pixel )
 
 		elif mode == "center" :
-			A6_image.paste( image, ( int( ( A6_image.size[0] - image.size[0] ) / 2 ), 0 ) ) #あくまで左右方向のcenter指定なので、上下の調整はしない。上下に動かしたいならmanualで。
+			self.paste_canvas( A6_image, image, ( int( ( A6_size[0] - image_size[0] ) / 2 ), 0 ) ) #あくまで左右方向のcenter指定なので、上下の調整はしない。上下に動かしたいならmanualで。
 
 		elif mode == "right" :
-			A6_image.paste( image, ( A6_image.size[0] - image.size[0], 0 ) )
+			self.paste_canvas( A6_image, image, ( A6_size[0] - image_size[0], 0 ) )
 
 		else:
-			A6_image.paste( image, ( 0, 0 ) ) #leftの場合を想定
+			self.paste_canvas( A6_image, image, ( 0, 0 ) ) #leftの場合を想定
+
+		return self.canvas_to_image( A6_image )
+
 
-		return A6_image
+	#台紙の持ち方（"pil"か"numpy"）を切り替える。NumPyがなければ"pil"のままにする
+	def set_canvas_mode( self, canvas_mode ):
+		if canvas_mode == "numpy" and numpy is None:
+			print( "NumPyがインストールされていないので、宛名画像はPILイメージで合成します。" )
+			canvas_mode = "pil"
+
+		if canvas_mode != self.canvas_mode:
+			self.canvas_mode = canvas_mode
+			#下地画像は台紙の持ち方ごとに作り直す
+			self.discard_job_template()
+
+
+	#合成用の空白の台紙を用意する（numpyモードならndarray、それ以外はPILイメージ）
+	def new_canvas( self, size_xy = None ):
+		if size_xy is None:
+			size_xy = ( self.width, self.height )
+
+		if self.canvas_mode == "numpy":
+			return numpy.full( ( size_xy[1], size_xy[0] ), 255, dtype = numpy.uint8 )
+		else:
+			return Image.new( "L", size_xy, 255 )
+
+
+	#台紙に部品画像を透過貼り付けする（白を透過色として扱う）
+	def through_paste( self, canvas, part_image, point_tuple ):
+		if isinstance( canvas, Image.Image ):
+			pil_through_paste_greyscale( canvas, part_image, point_tuple, 255 )
+		else:
+			ndarray_through_paste_greyscale( canvas, part_image, point_tuple, 255 )
+
+
+	#台紙に画像を（透過させずに）貼り付ける
+	def paste_canvas( self, canvas, part_image, point_tuple ):
+		if isinstance( canvas, Image.Image ):
+			canvas.paste( self.canvas_to_image( part_image ), point_tuple )
+		else:
+			ndarray_paste( canvas, part_image, point_tuple )
+
+
+	#台紙の（幅, 高さ）を返す
+	def canvas_size( self, canvas ):
+		if isinstance( canvas, Image.Image ):
+			return canvas.size
+		else:
+			return ( canvas.shape[1], canvas.shape[0] )
+
+
+	#台紙の一部を（左, 上, 右, 下）の範囲で切り抜く
+	def crop_canvas( self, canvas, box ):
+		if isinstance( canvas, Image.Image ):
+			return canvas.crop( box )
+
+		#PILのcropと同じく、範囲が逆転している場合はエラーにする
+		if box[2] < box[0] or box[3] < box[1]:
+			raise ValueError( "切り抜く範囲が不正です：" + str( box ) )
+
+		return canvas[ box[1]:box[3], box[0]:box[2] ]
+
+
+	#台紙を180°回転させる
+	def rotate_canvas_180( self, canvas ):
+		if isinstance( canvas, Image.Image ):
+			return canvas.transpose( Image.ROTATE_180 )
+		else:
+			return canvas[ ::-1, ::-1 ]
+
+
+	#台紙をPILイメージにして返す（numpyモードでの出力の境目）
+	def canvas_to_image( self, canvas ):
+		if isinstance( canvas, Image.Image ):
+			return canvas
+		else:
+			return Image.fromarray( numpy.ascontiguousarray( canvas ), "L" )
 
 
 	# 実際の印刷サイズの検証用として、赤色で外縁部に枠が描かれた印刷用イメージを返す
 	def get_red_frame_image( self ):
-		line_width_pixel = self.parts_dict.get( "redline-width", 2 )
+		line_width_pixel = self.get_redline_width()
 
 		#枠だけの画像を印刷しても方向がわからないので、上下左右を記述した画像を中央に貼る
 		#上下左右の説明パーツをそれぞれ用意
@@ -675,6 +971,11 @@ class atena_image_maker():
 		return frame_image
 
 
+	#赤枠の線幅（レイアウト辞書には標準解像度でのピクセル数で入っている）を、この解像度でのピクセル数で返す
+	def get_redline_width( self ):
+		return max( 1, self.scale_standard_pixel( self.parts_dict.get( "redline-width", 2 ) ) )
+
+
 	#宛名画像生成オブジェクト外での宛名画像の操作用に、ミリメートル単位の長さを
 	#宛名画像のピクセル単位に変換して返す（主にサンプル画像への赤枠追加用）
 	def convert_mm_to_pixel( self, millimeter_value ):
@@ -690,33 +991,95 @@ class atena_image_maker():
 
 	#フォントを画像にする際の台紙となる正方形画像の一辺の長さを決める
 	def determine_fontmat_size( self, font_path ):
-		max_fontsize = max( ( self.parts_dict[ "postalcode-fontsize" ], self.parts_dict[ "name-fontsize" ], self.parts_dict[ "address-fontsize" ], self.parts_dict[ "our-postalcode-fontsize" ], self.parts_dict[ "our-name-fontsize" ], self.parts_dict[ "our-address-fontsize" ] ) )
+		#レイアウト辞書のフォントサイズは標準解像度での値なので、この解像度での大きさにしてから測る
+		fontsize_dict = { x : self.scale_standard_pixel( self.parts_dict[ x ] ) for x in ( "postalcode-fontsize", "name-fontsize", "address-fontsize", "our-postalcode-fontsize", "our-name-fontsize", "our-address-fontsize" ) }
+		max_fontsize = max( fontsize_dict.values() )
 
 		#これからフォント画像を取得していくための仮の台紙長さを決める
 		temp_letter_image = letter_to_pil_image( "|", font_path, max_fontsize, self.width )
 		temp_mat_size = int( temp_letter_image.size[1] * 3 )
 
-		temp_letter_image = letter_to_pil_image( "|", font_path, self.parts_dict[ "postalcode-fontsize" ], temp_mat_size )
+		temp_letter_image = letter_to_pil_image( "|", font_path, fontsize_dict[ "postalcode-fontsize" ], temp_mat_size )
 		self.postalcode_fontmat_size = int( temp_letter_image.size[1] * 1.4 )
 
-		temp_letter_image = letter_to_pil_image( "|", font_path, self.parts_dict[ "name-fontsize" ], temp_mat_size )
+		temp_letter_image = letter_to_pil_image( "|", font_path, fontsize_dict[ "name-fontsize" ], temp_mat_size )
 		self.name_fontmat_size =  int( temp_letter_image.size[1] * 2 )
 
-		temp_letter_image = letter_to_pil_image( "|", font_path, self.parts_dict[ "address-fontsize" ], temp_mat_size )
+		temp_letter_image = letter_to_pil_image( "|", font_path, fontsize_dict[ "address-fontsize" ], temp_mat_size )
 		self.address_fontmat_size =  int( temp_letter_image.size[1] * 2 )
 
-		temp_letter_image = letter_to_pil_image( "|", font_path, self.parts_dict[ "our-postalcode-fontsize" ], temp_mat_size )
+		temp_letter_image = letter_to_pil_image( "|", font_path, fontsize_dict[ "our-postalcode-fontsize" ], temp_mat_size )
 		self.our_postalcode_fontmat_size =  int( temp_letter_image.size[1] * 1.4 )
 
-		temp_letter_image = letter_to_pil_image( "|", font_path, self.parts_dict[ "our-name-fontsize" ], temp_mat_size )
+		temp_letter_image = letter_to_pil_image( "|", font_path, fontsize_dict[ "our-name-fontsize" ], temp_mat_size )
 		self.our_name_fontmat_size =  int( temp_letter_image.size[1] * 2 )
 
-		temp_letter_image = letter_to_pil_image( "|", font_path, self.parts_dict[ "our-address-fontsize" ], temp_mat_size )
+		temp_letter_image = letter_to_pil_image( "|", font_path, fontsize_dict[ "our-address-fontsize" ], temp_mat_size )
 		self.our_address_fontmat_size =  int( temp_letter_image.size[1] * 2 )
 
 
+	#各項目のフォント画像の台紙サイズを辞書で返す
+	def get_fontmat_sizes( self ):
+		return { "postalcode" : self.postalcode_fontmat_size, "name" : self.name_fontmat_size, "company" : self.company_fontmat_size, "department" : self.department_fontmat_size, "address" : self.address_fontmat_size, "our-postalcode" : self.our_postalcode_fontmat_size, "our-name" : self.our_name_fontmat_size, "our-address" : self.our_address_fontmat_size }
+
+
+	#get_fontmat_sizesで得た辞書の値を、各項目のフォント画像の台紙サイズに設定する
+	def set_fontmat_sizes( self, fontmat_size_dict ):
+		self.postalcode_fontmat_size = fontmat_size_dict[ "postalcode" ]
+		self.name_fontmat_size = fontmat_size_dict[ "name" ]
+		self.company_fontmat_size = fontmat_size_dict[ "company" ]
+		self.department_fontmat_size = fontmat_size_dict[ "department" ]
+		self.address_fontmat_size = fontmat_size_dict[ "address" ]
+		self.our_postalcode_fontmat_size = fontmat_size_dict[ "our-postalcode" ]
+		self.our_name_fontmat_size = fontmat_size_dict[ "our-name" ]
+		self.our_address_fontmat_size = fontmat_size_dict[ "our-address" ]
+
+
+	#別プロセスで同じ宛名画像を作るための、レイアウトの控え（pickleできる辞書）を返す
+	#（用紙サイズ、レイアウト辞書、フォント画像の台紙サイズ、解像度、台紙の持ち方）
+	def get_layout_snapshot( self ):
+		return { "papersize-mm" : self.papersize_mm, "parts-dict" : copy.deepcopy( self.parts_dict ), "standard-parts-dict" : copy.deepcopy( self.standard_parts_dict ), "fontmat-sizes" : self.get_fontmat_sizes(), "mm-pixel-rate" : self.mm_pixel_rate, "canvas-mode" : self.canvas_mode }
+
+
+#get_layout_snapshotで得た控えから、同じレイアウトの宛名画像生成インスタンスを作る
+def atena_image_maker_from_snapshot( layout_snapshot ):
+	snapshot_maker = atena_image_maker( papersize_widthheight_millimetre = layout_snapshot[ "papersize-mm" ], overwrite_settings = copy.deepcopy( layout_snapshot[ "parts-dict" ] ), canvas_mode = layout_snapshot[ "canvas-mode" ], resolution = layout_snapshot[ "mm-pixel-rate" ] )
+	snapshot_maker.standard_parts_dict = copy.deepcopy( layout_snapshot[ "standard-parts-dict" ] )
+	snapshot_maker.set_fontmat_sizes( layout_snapshot[ "fontmat-sizes" ] )
+
+	return snapshot_maker
+
+
 #-----宛名画像の生成クラスはここまで
 
+#-----宛名画像を別プロセスで並列に作るための関数（ProcessPoolExecutorのワーカーで動く）
+
+#ワーカープロセスごとの宛名画像生成インスタンスと、印刷の設定
+render_worker_state = {}
+
+
+#ワーカープロセスの起動時に一度だけ呼ばれ、レイアウトの控えから宛名画像生成インスタンスを作っておく
+#差出人の部分はどの行でも同じなので、下地画像もここで一度だけ描いておく
+def init_render_worker( layout_snapshot, our_data_dict, print_options ):
+	render_worker_state[ "maker" ] = atena_image_maker_from_snapshot( layout_snapshot )
+	render_worker_state[ "maker" ].prepare_job_template( our_data_dict )
+	render_worker_state[ "print-options" ] = print_options
+
+
+#（行番号, 宛名データの辞書）のリストを受け取り、（行番号, 印刷用の宛名画像, 作成にかかった秒数）のリストを同じ順番で返す
+def render_cards_in_worker( record_chunk ):
+	worker_maker = render_worker_state[ "maker" ]
+	print_options = render_worker_state[ "print-options" ]
+	rendered_cards = []
+
+	for line_number, print_data in record_chunk:
+		render_start = time.perf_counter()
+		print_grayscale_image = worker_maker.get_cutted_atena_image( data_dict = print_data, space_tblr_mm_list = print_options[ "space-tblr-mm" ], cutted_atena_image_upside_down = print_options[ "upside-down" ], rotate_upside_down = print_options[ "upside-down" ] )
+		rendered_cards.append( ( line_number, print_grayscale_image, time.perf_counter() - render_start ) )
+
+	return rendered_cards
+
+
 # ユーティリティ関数は image_utils.py と csv_utils.py に移動しました
 # - contraction()
 # - pil_through_paste_greyscale()
@@ -749,6 +1112,118 @@ class TextCtrlPlus( wx.TextCtrl ):
 # maybe_list_natsort() は image_utils.py に移動しました
 
 
+#住所表（grid）に、AddressTableModelの内容を見せるためのテーブル
+#gridはセルの値を持たず、描画する範囲のセルだけをここから取り出す
+class AddressGridTable( wx.grid.GridTableBase ):
+
+	def __init__( self, model ):
+		wx.grid.GridTableBase.__init__( self )
+		self.model = model
+		self.col_labels = {}
+
+	def GetNumberRows( self ):
+		return self.model.get_row_count()
+
+	def GetNumberCols( self ):
+		return self.model.get_column_count()
+
+	def IsEmptyCell( self, row, col ):
+		return self.model.get_value( row, col ) == ""
+
+	def GetValue( self, row, col ):
+		return self.model.get_value( row, col )
+
+	def SetValue( self, row, col, value ):
+		self.model.set_value( row, col, value )
+
+	def GetColLabelValue( self, col ):
+		return self.col_labels.get( col, "列" + str( col + 1 ) )
+
+	def SetColLabelValue( self, col, label ):
+		self.col_labels[ col ] = label
+
+	#行・列の数が変わったことを、表（grid）に知らせる
+	def notify_grid( self, message_type, *args ):
+		if self.GetView() is not None:
+			self.GetView().ProcessTableMessage( wx.grid.GridTableMessage( self, message_type, *args ) )
+
+	def AppendRows( self, numRows = 1 ):
+		self.model.append_rows( numRows )
+		self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_ROWS_APPENDED, numRows )
+		return True
+
+	def InsertRows( self, pos = 0, numRows = 1 ):
+		self.model.insert_rows( pos, numRows )
+		self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_ROWS_INSERTED, pos, numRows )
+		return True
+
+	def DeleteRows( self, pos = 0, numRows = 1 ):
+		numRows = min( numRows, self.model.get_row_count() - pos )
+		self.model.delete_rows( pos, numRows )
+		self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_ROWS_DELETED, pos, numRows )
+		return True
+
+	def AppendCols( self, numCols = 1 ):
+		self.model.append_columns( numCols )
+		self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_COLS_APPENDED, numCols )
+		return True
+
+	def DeleteCols( self, pos = 0, numCols = 1 ):
+		numCols = min( numCols, self.model.get_column_count() - pos )
+		self.model.delete_columns( pos, numCols )
+		self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_COLS_DELETED, pos, numCols )
+		return True
+
+	#履歴のパッチを当てて、行・列の増減だけを表に知らせる（アンドゥ・リドゥ用）
+	#undoなら、パッチを逆順に戻す向きで当てる。当てた操作の一覧を返す
+	def apply_patches( self, patches, undo = False ):
+		applied_operations = []
+		notify_types = { "insert-rows" : wx.grid.GRIDTABLE_NOTIFY_ROWS_INSERTED, "delete-rows" : wx.grid.GRIDTABLE_NOTIFY_ROWS_DELETED, "insert-columns" : wx.grid.GRIDTABLE_NOTIFY_COLS_INSERTED, "delete-columns" : wx.grid.GRIDTABLE_NOTIFY_COLS_DELETED }
+
+		grid = self.GetView()
+		if grid is not None:
+			grid.BeginBatch()
+
+		for patch in ( reversed( patches ) if undo else patches ):
+			operation = self.model.apply_patch( patch, undo )
+			if operation[0] in notify_types:
+				self.notify_grid( notify_types[ operation[0] ], operation[1], operation[2] )
+			applied_operations.append( operation )
+
+		if grid is not None:
+			grid.EndBatch()
+			grid.ForceRefresh()
+
+		return applied_operations
+
+	#モデルを丸ごと入れ替える（ファイルの読み込み用）
+	#セルの値は写さず、行・列の数の増減だけを表に知らせて、見えている部分を描き直させる
+	def set_model( self, model ):
+		old_rows = self.model.get_row_count()
+		old_cols = self.model.get_column_count()
+		self.model = model
+
+		grid = self.GetView()
+		if grid is None:
+			return
+
+		grid.BeginBatch()
+
+		if model.get_row_count() > old_rows:
+			self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_ROWS_APPENDED, model.get_row_count() - old_rows )
+		elif model.get_row_count() < old_rows:
+			self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_ROWS_DELETED, model.get_row_count(), old_rows - model.get_row_count() )
+
+		if model.get_column_count() > old_cols:
+			self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_COLS_APPENDED, model.get_column_count() - old_cols )
+		elif model.get_column_count() < old_cols:
+			self.notify_grid( wx.grid.GRIDTABLE_NOTIFY_COLS_DELETED, model.get_column_count(), old_cols - model.get_column_count() )
+
+		self.notify_grid( wx.grid.GRIDTABLE_REQUEST_VIEW_GET_VALUES )
+		grid.EndBatch()
+		grid.ForceRefresh()
+
+
 #GUI部分の構築
 class frame_plus( wx.Frame ):
 
@@ -760,9 +1235,9 @@ class frame_plus( wx.Frame ):
 
 		self.paper_size_data = { "category" : "はがき", "width" : 100, "height" : 148 }
 
-		self.software_setting = { "window_maximize" : False, "window_size" : [ 1600, 760 ], "table-font" : "", "table-fontsize" : 0, "write-fileinfo-on-titlebar" : "filename"  }
+		self.software_setting = { "window_maximize" : False, "window_size" : [ 1600, 760 ], "table-font" : "", "table-fontsize" : 0, "write-fileinfo-on-titlebar" : "filename", "canvas-mode" : "pil", "screen-resolution" : "standard", "print-resolution" : "standard", "batch-print-chunk-size" : 100, "render-workers" : 0, "spool-backend" : "lp", "spool-directory" : "", "export-skip-existing" : True, "pdf-image-encoding" : "grey", "bilevel-threshold" : 128, "bilevel-dither" : False, "table-history-memory-mb" : 64  }
 
-		self.column_etc_dictionary = { "column-postalcode" : 1, "column-address1" : 2, "column-address2" : 3, "column-name1" : 4, "column-name2" : 5, "column-company" : 6, "column-department" : 7, "enable-default-honorific" : True, "default-honorific" : "様", "printer-space-top,bottom,left,right" : [ 0, 0, 0, 0 ], "print-control" : False, "print-control-column" : 0, "print-sign" : "×", "print-or-ignore" : "ignore", "enable-honorific-in-table" : True, "column-honorific" : 8, "sampleimage-areaframe" : True, "upside-down-print" : False }
+		self.column_etc_dictionary = { "column-postalcode" : 1, "column-address1" : 2, "column-address2" : 3, "column-name1" : 4, "column-name2" : 5, "column-company" : 6, "column-department" : 7, "enable-default-honorific" : True, "default-honorific" : "様", "printer-space-top,bottom,left,right" : [ 0, 0, 0, 0 ], "print-control" : False, "print-control-column" : 0, "print-sign" : "×", "print-or-ignore" : "ignore", "enable-honorific-in-table" : True, "column-honorific" : 8, "sampleimage-areaframe" : True, "upside-down-print" : False, "batch-print" : False }
 
 		self.our_data = { "our-postalcode-data" : "", "our-name1-data" : "", "our-name2-data" : "", "our-address1-data" : "", "our-address2-data" : "" }
 
@@ -801,9 +1276,10 @@ class frame_plus( wx.Frame ):
 		self.current_find_number = 0
 
 		#住所表の履歴
-		self.table_history = [] #内容変更やCSVの読み込みによる変化を記録した、住所表の履歴
-		self.current_history_position = 0 #アンドゥ、リドゥで、現在どこまで戻っているかという位置（csv_history[？]の？になる。0が最新の位置で、古いものほど数字が増える後の方に押し出されていく）
-		self.history_stock_max = 20 #履歴の最大数
+		#表を丸ごと写さず、変更したセル・行・列の差分を操作ごとに積む
+		#アンドゥ、リドゥで現在どこまで戻っているかは self.table_history.position（0が最新の位置で、古いものほど数字が増える）
+		#どこまで古い履歴を残すかは、回数ではなく差分の大きさ（設定タブのメモリの上限）で決める
+		self.table_history = AddressTableHistory()
 
 		#宛名画像作成インスタンスの作成時に引数として渡す、設定値上書き用辞書
 		#もしINIファイルが読み込まれたら、保存されていた設定値でこれを上書きする
@@ -815,7 +1291,7 @@ class frame_plus( wx.Frame ):
 		self.load_settings()
 
 		#設定を読みこんだら、最新になった用紙サイズと設定値の辞書をもとに宛名画像作成インスタンスを作る
-		self.image_generator = atena_image_maker( papersize_widthheight_millimetre =  ( self.paper_size_data[ "width" ], self.paper_size_data[ "height" ] ), overwrite_settings = self.overwrite_dict_for_image_generator )
+		self.image_generator = atena_image_maker( papersize_widthheight_millimetre =  ( self.paper_size_data[ "width" ], self.paper_size_data[ "height" ] ), overwrite_settings = self.overwrite_dict_for_image_generator, canvas_mode = self.software_setting[ "canvas-mode" ], resolution = self.software_setting[ "screen-resolution" ] )
 
 		#ないとは思うが、読み込んだ用紙サイズがデフォルトの用紙サイズ候補の中にない場合のために
 		#INIに記されている用紙サイズを候補リスト(重複しないようにsetにしてある)に追加しておく
@@ -861,6 +1337,9 @@ class frame_plus( wx.Frame ):
 		#郵便番号や住所、宛名の各画像を得るための台紙サイズを決定しておく
 		self.image_generator.determine_fontmat_size( self.image_generator.get_parts_data( "fontfile" ) )
 
+		#最初の印刷で待たないように、プリンターの情報を先に調べておく
+		self.prepare_printer_capabilities()
+
 		#設定を読みこんでフォント設定も一段落したので、各設定値辞書の初期値をコピーして記録しておく
 		#ソフトの終了時に、その時点での設定と比較して設定変更があったかチェックするためのもの
 		#設定保存したら、これを上書きする
@@ -937,6 +1416,14 @@ class frame_plus( wx.Frame ):
 		self.preview_button.SetMinSize( ( 120, 30 ) )
 		self.preview_button.SetMaxSize( ( 120, 30 ) )
 		self.preview_button.SetToolTip( "ここをクリックすると、指定された範囲の各行をどのような外観で印刷するかを、実際に印刷しないで画面上で確認できます" )
+		self.resume_print_button = wx.Button( self.atena_tab_panel, wx.ID_ANY, "続きから印刷", size = ( 120, 30 ) )
+		self.resume_print_button.SetMinSize( ( 120, 30 ) )
+		self.resume_print_button.SetMaxSize( ( 120, 30 ) )
+		self.export_button = wx.Button( self.atena_tab_panel, wx.ID_ANY, "ファイルに書き出す", size = ( 140, 30 ) )
+		self.export_button.SetMinSize( ( 140, 30 ) )
+		self.export_button.SetMaxSize( ( 140, 30 ) )
+		self.export_button.SetToolTip( "印刷する代わりに、指定された範囲の宛名画像を、複数ページのPDFか複数ページのTIFF、または1枚ずつのPNGファイルとして書き出します（印刷で送るものと同じ画像です）" )
+		self.resume_print_button.SetToolTip( "紙詰まりや中止で途中までになった前回の印刷を、プリンターに送り終わった行を飛ばして続きから印刷します（前回からレイアウトや住所表を変えていたら、続きからは印刷できません）" )
 
 		self.upsidedown_print_checkbox = wx.CheckBox( self.atena_tab_panel, wx.ID_ANY, "反転印刷" )
 		if self.column_etc_dictionary[ "upside-down-print" ] is True:
@@ -944,12 +1431,16 @@ class frame_plus( wx.Frame ):
 		else:
 			self.upsidedown_print_checkbox.SetValue( False )
 
+		self.batch_print_checkbox = wx.CheckBox( self.atena_tab_panel, wx.ID_ANY, "まとめて印刷" )
+		self.batch_print_checkbox.SetValue( self.column_etc_dictionary[ "batch-print" ] is True )
+
 		self.close_button = wx.Button( self.atena_tab_panel, wx.ID_ANY, "終了", size = ( 60, 30 ) )
 		self.close_button.SetMinSize( ( 60, 30 ) )
 		self.close_button.SetMaxSize( ( 60, 30 ) )
 		self.close_button.SetToolTip( "ウィンドウを閉じて、このソフトを終了します" )
 
 		self.upsidedown_print_checkbox.SetToolTip( "封筒の印刷を安定させるために、下方向からプリンターに給紙して180°反転した印刷にしたい場合は、これにチェックを入れてください" )
+		self.batch_print_checkbox.SetToolTip( "1枚ずつではなく、複数ページのPDFにまとめてプリンターに送ります（何枚ずつまとめるかは「設定」タブで指定できます）。印刷を中止すると、まだ送っていない分は印刷されません" )
 
 		#CSVファイルのボタンと印刷入力欄を1行にまとめる
 		self.csv_and_print_sizer = wx.BoxSizer( wx.HORIZONTAL )
@@ -968,7 +1459,10 @@ class frame_plus( wx.Frame ):
 		self.csv_and_print_sizer.Add( self.print_button, 0, wx.FIXED_MINSIZE | wx.LEFT, 2 )
 		self.csv_and_print_sizer.Add( wx.StaticText( self.atena_tab_panel, wx.ID_ANY, "ないし" ), 0, wx.FIXED_MINSIZE | wx.ALIGN_CENTER_VERTICAL | wx.LEFT | wx.RIGHT, 4 )
 		self.csv_and_print_sizer.Add( self.preview_button, 0, wx.FIXED_MINSIZE )
+		self.csv_and_print_sizer.Add( self.resume_print_button, 0, wx.FIXED_MINSIZE | wx.LEFT, 4 )
+		self.csv_and_print_sizer.Add( self.export_button, 0, wx.FIXED_MINSIZE | wx.LEFT, 4 )
 		self.csv_and_print_sizer.Add( self.upsidedown_print_checkbox, 0, wx.FIXED_MINSIZE | wx.ALIGN_CENTER_VERTICAL | wx.LEFT, 8 )
+		self.csv_and_print_sizer.Add( self.batch_print_checkbox, 0, wx.FIXED_MINSIZE | wx.ALIGN_CENTER_VERTICAL | wx.LEFT, 8 )
 		self.csv_and_print_sizer.Add( self.close_button, 0, wx.FIXED_MINSIZE | wx.LEFT, 8 )
 
 		#SpinCtrlの初期値を設定
@@ -980,6 +1474,8 @@ class frame_plus( wx.Frame ):
 		self.csvsave_button.Bind( wx.EVT_BUTTON, self.save_csv_file )
 		self.print_button.Bind( wx.EVT_BUTTON, self.atenaprint_thread_control )
 		self.preview_button.Bind( wx.EVT_BUTTON, self.show_preview_dialog )
+		self.resume_print_button.Bind( wx.EVT_BUTTON, self.resume_atena_print )
+		self.export_button.Bind( wx.EVT_BUTTON, self.export_atena_images )
 
 		self.history_button.Bind( wx.EVT_BUTTON, self.goto_history_point )
 		self.grep_button.Bind( wx.EVT_BUTTON, self.table_search )
@@ -988,6 +1484,7 @@ class frame_plus( wx.Frame ):
 		self.close_button.Bind( wx.EVT_BUTTON, self.window_close )
 
 		self.upsidedown_print_checkbox.Bind( wx.EVT_CHECKBOX, self.change_upsidedown_print )
+		self.batch_print_checkbox.Bind( wx.EVT_CHECKBOX, self.change_batch_print )
 
 		#終了ボタンのBindの直下に、終了時の設定変更チェックのBindもついでに書いておく
 		self.Bind( wx.EVT_CLOSE, self.check_at_close )
@@ -996,16 +1493,20 @@ class frame_plus( wx.Frame ):
 		self.grid = wx.grid.Grid( self.atena_tab_panel )
 		self.grid.CanDragCell() #これを作っている時点では、効果がないようだ
 		self.grid.CanDragColMove() #これを作っている時点では、効果がないようだ
-		self.grid.CreateGrid( 5, 7 )
+		#セルの内容は表（grid）に直接書き込まず、モデルに持たせてテーブル経由で見せる
+		self.grid_table = AddressGridTable( AddressTableModel.blank( 5, 7 ) )
+		self.grid.SetTable( self.grid_table, takeOwnership = False )
 		self.set_grid_labels()
-		self.table_history.append( [ [ "" for x in range( self.grid.GetNumberCols() ) ] for y in range( self.grid.GetNumberRows() ) ] ) #開始時点の空白の表を、最初の履歴にしておく
+		self.table_history.set_memory_budget( self.software_setting[ "table-history-memory-mb" ] * 1024 * 1024 ) #開始時点の空白の表が、履歴の起点になる
 
 		#表の内容の控えを作る
 		#終了時やファイルを開く前に、これと比較して変更が保存されているかどうかチェックする
 		#その性質上、ファイルを開いた直後や保存した後に更新しておく必要がある
-		self.table_checkpoint = self.get_current_table_list()
+		self.table_checkpoint = self.get_table_snapshot()
 		#開いたファイルのパスも今のうちに用意する
 		self.opened_file_path = ""
+		#開いたファイルの文字コード（保存時に同じ文字コードで書き戻すため）
+		self.opened_file_encoding = None
 
 		#印刷行範囲のデフォルト値を表の行数に合わせる
 		self.print_start_line.SetValue( 1 )
@@ -1024,8 +1525,7 @@ class frame_plus( wx.Frame ):
 			self.grid.SetDefaultCellFont( self.table_fontdata )
 
 			#フォントあるいはフォントサイズを変更したので、表の行・列のサイズを調整する
-			self.grid.AutoSizeColumns()
-			self.grid.AutoSizeRows()
+			self.autosize_table()
 
 
 		#住所表の変更を、履歴を蓄積する関数にバインドする
@@ -2079,6 +2579,23 @@ class frame_plus( wx.Frame ):
 		#バインド
 		self.table_fontsize_input.Bind( wx.EVT_SPINCTRL, self.change_table_fontsize )
 
+		#表の変更履歴（アンドゥ・リドゥ）に使うメモリの上限
+		self.table_history_memory_input = wx.SpinCtrl( self.setting_tab_panel, wx.ID_ANY, value = str( self.software_setting[ "table-history-memory-mb" ] ), min = 1, max = 1024 )
+		self.table_history_memory_input.SetToolTip( "履歴は変更したセル・行・列の差分だけを残し、その合計がこの大きさを超えたら古いものから捨てます（最新の1回分は必ず残します）" )
+
+		#説明とつなげて1行にまとめる
+		textline_table_history_memory = wx.BoxSizer( wx.HORIZONTAL )
+		textline_table_history_memory.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "変更履歴に使うメモリの上限（MB）：" ) )
+		textline_table_history_memory.Add( self.table_history_memory_input )
+
+		#バインド
+		self.table_history_memory_input.Bind( wx.EVT_SPINCTRL, self.change_table_history_memory )
+
+		#枠（StaticBoxSizer）に入れる
+		self.table_history_sbox = wx.StaticBox( self.setting_tab_panel, wx.ID_ANY, "●表の変更履歴（アンドゥ・リドゥ）●" )
+		self.table_history_sizer = wx.StaticBoxSizer( self.table_history_sbox, wx.VERTICAL )
+		self.table_history_sizer.Add( textline_table_history_memory, 1, wx.ALL | wx.EXPAND, 10 )
+
 		#タイトルバーに、読み込んだCSVファイルの情報（ファイル名かパス）を表示するかどうか
 		self.array_titlebar_mode = ( "ファイル名を表示する", "パスを表示する", "ファイルの情報を表示しない" )
 		self.combobox_titlebar_mode = wx.ComboBox( self.setting_tab_panel, wx.ID_ANY, "タイトルバーの表示", choices = self.array_titlebar_mode, style = wx.CB_READONLY )
@@ -2102,6 +2619,166 @@ class frame_plus( wx.Frame ):
 		self.titlebar_mode_sizer = wx.StaticBoxSizer( self.titlebar_mode_sbox, wx.VERTICAL )
 		self.titlebar_mode_sizer.Add( textline_titlebar, 1, wx.ALL | wx.EXPAND, 10 )
 
+		#宛名画像の合成を、PILイメージで行うかNumPyの配列で行うか
+		self.canvas_mode_checkbox = wx.CheckBox( self.setting_tab_panel, wx.ID_ANY, "宛名画像をNumPyの配列で合成する（NumPyがインストールされている場合のみ。出来上がる画像は同じです）" )
+		self.canvas_mode_checkbox.SetValue( self.image_generator.canvas_mode == "numpy" )
+
+		#バインド
+		self.canvas_mode_checkbox.Bind( wx.EVT_CHECKBOX, self.change_canvas_mode )
+
+		#枠（StaticBoxSizer）に入れる
+		self.canvas_mode_sbox = wx.StaticBox( self.setting_tab_panel, wx.ID_ANY, "●宛名画像の合成方式●" )
+		self.canvas_mode_sizer = wx.StaticBoxSizer( self.canvas_mode_sbox, wx.VERTICAL )
+		self.canvas_mode_sizer.Add( self.canvas_mode_checkbox, 1, wx.ALL | wx.EXPAND, 10 )
+
+		#宛名画像の解像度（画面表示用と印刷用）
+		self.array_resolution_tier = ( "draft", "standard", "high" )
+		self.array_resolution_label = ( "粗い（" + str( RENDER_RESOLUTION_TIERS[ "draft" ] ) + "pixel/mm、表示が速い）", "標準（" + str( RENDER_RESOLUTION_TIERS[ "standard" ] ) + "pixel/mm）", "高精細（" + str( RENDER_RESOLUTION_TIERS[ "high" ] ) + "pixel/mm、600dpi程度のプリンター向け）" )
+		self.combobox_screen_resolution = wx.ComboBox( self.setting_tab_panel, wx.ID_ANY, "画面表示の解像度", choices = self.array_resolution_label, style = wx.CB_READONLY )
+		self.combobox_print_resolution = wx.ComboBox( self.setting_tab_panel, wx.ID_ANY, "印刷の解像度", choices = self.array_resolution_label, style = wx.CB_READONLY )
+
+		for resolution_combobox, setting_key in ( ( self.combobox_screen_resolution, "screen-resolution" ), ( self.combobox_print_resolution, "print-resolution" ) ):
+			if self.software_setting[ setting_key ] in self.array_resolution_tier:
+				resolution_combobox.SetSelection( self.array_resolution_tier.index( self.software_setting[ setting_key ] ) )
+			else:
+				resolution_combobox.SetSelection( 1 )
+
+		#説明とつなげて1行にまとめる
+		textline_screen_resolution = wx.BoxSizer( wx.HORIZONTAL )
+		textline_screen_resolution.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "印刷レイアウトのサンプル画像、印刷プレビュー：" ) )
+		textline_screen_resolution.Add( self.combobox_screen_resolution )
+
+		textline_print_resolution = wx.BoxSizer( wx.HORIZONTAL )
+		textline_print_resolution.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "宛名印刷、余白計測用の枠の印刷：" ) )
+		textline_print_resolution.Add( self.combobox_print_resolution )
+
+		#バインド
+		self.combobox_screen_resolution.Bind( wx.EVT_COMBOBOX, self.change_screen_resolution )
+		self.combobox_print_resolution.Bind( wx.EVT_COMBOBOX, self.change_print_resolution )
+
+		#枠（StaticBoxSizer）に入れる
+		self.resolution_sbox = wx.StaticBox( self.setting_tab_panel, wx.ID_ANY, "●宛名画像の解像度（画面表示用と印刷用）●" )
+		self.resolution_sizer = wx.StaticBoxSizer( self.resolution_sbox, wx.VERTICAL )
+		self.resolution_sizer.Add( textline_screen_resolution, 1, wx.ALL | wx.EXPAND, 10 )
+		self.resolution_sizer.Add( textline_print_resolution, 1, wx.LEFT | wx.RIGHT | wx.BOTTOM | wx.EXPAND, 10 )
+
+		#まとめて印刷するときに、何枚ずつ1つのPDF（印刷ジョブ）にするか
+		self.batch_chunk_size_input = wx.SpinCtrl( self.setting_tab_panel, wx.ID_ANY, value = str( self.software_setting[ "batch-print-chunk-size" ] ), min = 0, max = 10000 )
+
+		#説明とつなげて1行にまとめる
+		textline_batch_chunk_size = wx.BoxSizer( wx.HORIZONTAL )
+		textline_batch_chunk_size.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "1つのPDFにまとめる枚数（0なら印刷範囲の全部を1つにまとめる）：" ) )
+		textline_batch_chunk_size.Add( self.batch_chunk_size_input )
+
+		#バインド
+		self.batch_chunk_size_input.Bind( wx.EVT_SPINCTRL, self.change_batch_print_chunk_size )
+
+		#宛名画像を作るワーカープロセスの数
+		self.render_workers_input = wx.SpinCtrl( self.setting_tab_panel, wx.ID_ANY, value = str( self.software_setting[ "render-workers" ] ), min = 0, max = os.cpu_count() or 1 )
+		self.render_workers_input.SetToolTip( "印刷する宛名画像を、いくつのプロセスで並列に作るか（0なら並列にしない）。CPUのコア数までにしてください" )
+
+		#説明とつなげて1行にまとめる
+		textline_render_workers = wx.BoxSizer( wx.HORIZONTAL )
+		textline_render_workers.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "宛名画像を並列に作るプロセスの数（0なら並列にしない）：" ) )
+		textline_render_workers.Add( self.render_workers_input )
+
+		#バインド
+		self.render_workers_input.Bind( wx.EVT_SPINCTRL, self.change_render_workers )
+
+		#枠（StaticBoxSizer）に入れる
+		self.batch_print_sbox = wx.StaticBox( self.setting_tab_panel, wx.ID_ANY, "●印刷処理（「まとめて印刷」でプリンターに送るPDFの大きさ、宛名画像の並列作成）●" )
+		self.batch_print_sizer = wx.StaticBoxSizer( self.batch_print_sbox, wx.VERTICAL )
+		self.batch_print_sizer.Add( textline_batch_chunk_size, 1, wx.ALL | wx.EXPAND, 10 )
+		self.batch_print_sizer.Add( textline_render_workers, 1, wx.LEFT | wx.RIGHT | wx.BOTTOM | wx.EXPAND, 10 )
+
+		#プリンターの情報（印刷先、用紙サイズ名）を調べなおすボタン
+		self.refresh_printer_button = wx.Button( self.setting_tab_panel, wx.ID_ANY, "プリンターの情報を調べなおす" )
+		self.refresh_printer_button.SetToolTip( "印刷先のプリンターや対応する用紙サイズは、一度調べたら" + str( int( printer_capabilities.ttl_seconds / 60 ) ) + "分間は調べなおさずに使います。プリンターを追加・変更した場合は、これをクリックしてください" )
+
+		#バインド
+		self.refresh_printer_button.Bind( wx.EVT_BUTTON, self.refresh_printer_capabilities )
+
+		#プリンターに送るPDFに、宛名画像をどう埋め込むか（グレースケールのまま、白黒2値にしてCCITT G4かFlateで圧縮）
+		self.array_pdf_image_encoding_label = ( "グレースケールのまま（従来どおり）", "白黒2値にしてCCITT G4で圧縮する（最も小さい）", "白黒2値にしてFlateで圧縮する" )
+		self.combobox_pdf_image_encoding = wx.ComboBox( self.setting_tab_panel, wx.ID_ANY, "PDFの画像", choices = self.array_pdf_image_encoding_label, style = wx.CB_READONLY )
+		if self.software_setting[ "pdf-image-encoding" ] in PDF_IMAGE_ENCODINGS:
+			self.combobox_pdf_image_encoding.SetSelection( PDF_IMAGE_ENCODINGS.index( self.software_setting[ "pdf-image-encoding" ] ) )
+		else:
+			self.combobox_pdf_image_encoding.SetSelection( 0 )
+
+		#白黒2値にするときの明るさの境目と、誤差拡散するかどうか
+		self.bilevel_threshold_input = wx.SpinCtrl( self.setting_tab_panel, wx.ID_ANY, value = str( self.software_setting[ "bilevel-threshold" ] ), min = 1, max = 254 )
+		self.bilevel_threshold_input.SetToolTip( "大きくするほど薄い部分も黒になり、文字が太くなります（標準は128）" )
+		self.bilevel_dither_checkbox = wx.CheckBox( self.setting_tab_panel, wx.ID_ANY, "誤差拡散で中間の濃さを表す（文字の縁が滑らかになるが、PDFは少し大きくなる）" )
+		self.bilevel_dither_checkbox.SetValue( self.software_setting[ "bilevel-dither" ] is True )
+		if self.software_setting[ "pdf-image-encoding" ] == "grey":
+			self.bilevel_threshold_input.Disable()
+			self.bilevel_dither_checkbox.Disable()
+
+		#説明とつなげて1行にまとめる
+		textline_pdf_image_encoding = wx.BoxSizer( wx.HORIZONTAL )
+		textline_pdf_image_encoding.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "宛名画像の埋め込み方：" ) )
+		textline_pdf_image_encoding.Add( self.combobox_pdf_image_encoding )
+		textline_bilevel_threshold = wx.BoxSizer( wx.HORIZONTAL )
+		textline_bilevel_threshold.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "白黒2値にする明るさの境目（1〜254）：" ) )
+		textline_bilevel_threshold.Add( self.bilevel_threshold_input )
+
+		#バインド
+		self.combobox_pdf_image_encoding.Bind( wx.EVT_COMBOBOX, self.change_pdf_image_encoding )
+		self.bilevel_threshold_input.Bind( wx.EVT_SPINCTRL, self.change_bilevel_threshold )
+		self.bilevel_dither_checkbox.Bind( wx.EVT_CHECKBOX, self.change_bilevel_dither )
+
+		#枠（StaticBoxSizer）に入れる
+		self.pdf_image_sbox = wx.StaticBox( self.setting_tab_panel, wx.ID_ANY, "●プリンターに送るPDFの画像（白黒2値にするとPDFが小さくなり、印刷が速くなります）●" )
+		self.pdf_image_sizer = wx.StaticBoxSizer( self.pdf_image_sbox, wx.VERTICAL )
+		self.pdf_image_sizer.Add( textline_pdf_image_encoding, 1, wx.ALL | wx.EXPAND, 10 )
+		self.pdf_image_sizer.Add( textline_bilevel_threshold, 1, wx.LEFT | wx.RIGHT | wx.EXPAND, 10 )
+		self.pdf_image_sizer.Add( self.bilevel_dither_checkbox, 1, wx.ALL | wx.EXPAND, 10 )
+
+		#PDFをプリンターに送る方法（lpコマンド、IPPでCUPSに直接、フォルダにPDFファイルとして保存）
+		self.array_spool_backend_label = ( "lpコマンドで送る（標準）", "IPPでCUPSに直接送る（lpを起動せず、接続を使い回すので速い）", "プリンターに送らず、PDFファイルとしてフォルダに保存する（試し刷り用）" )
+		self.combobox_spool_backend = wx.ComboBox( self.setting_tab_panel, wx.ID_ANY, "プリンターへの送り方", choices = self.array_spool_backend_label, style = wx.CB_READONLY )
+		if self.software_setting[ "spool-backend" ] in SPOOL_BACKEND_NAMES:
+			self.combobox_spool_backend.SetSelection( SPOOL_BACKEND_NAMES.index( self.software_setting[ "spool-backend" ] ) )
+		else:
+			self.combobox_spool_backend.SetSelection( 0 )
+
+		self.spool_directory_input = wx.TextCtrl( self.setting_tab_panel, wx.ID_ANY, self.software_setting[ "spool-directory" ] )
+		self.spool_directory_input.SetToolTip( "空欄なら、このソフトのフォルダの中の「" + DEFAULT_SPOOL_DIRECTORY_NAME + "」に保存します" )
+		if self.software_setting[ "spool-backend" ] != "file":
+			self.spool_directory_input.Disable()
+
+		#説明とつなげて1行にまとめる
+		textline_spool_backend = wx.BoxSizer( wx.HORIZONTAL )
+		textline_spool_backend.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "PDFをプリンターに送る方法：" ) )
+		textline_spool_backend.Add( self.combobox_spool_backend )
+		textline_spool_directory = wx.BoxSizer( wx.HORIZONTAL )
+		textline_spool_directory.Add( wx.StaticText( self.setting_tab_panel, wx.ID_ANY, "PDFファイルを保存するフォルダ：" ) )
+		textline_spool_directory.Add( self.spool_directory_input, 1, wx.EXPAND )
+
+		#バインド
+		self.combobox_spool_backend.Bind( wx.EVT_COMBOBOX, self.change_spool_backend )
+		self.spool_directory_input.Bind( wx.EVT_KILL_FOCUS, self.input_spool_directory )
+
+		#枠（StaticBoxSizer）に入れる
+		self.printer_capability_sbox = wx.StaticBox( self.setting_tab_panel, wx.ID_ANY, "●プリンターへの送り方、プリンターの情報●" )
+		self.printer_capability_sizer = wx.StaticBoxSizer( self.printer_capability_sbox, wx.VERTICAL )
+		self.printer_capability_sizer.Add( textline_spool_backend, 1, wx.ALL | wx.EXPAND, 10 )
+		self.printer_capability_sizer.Add( textline_spool_directory, 1, wx.LEFT | wx.RIGHT | wx.EXPAND, 10 )
+		self.printer_capability_sizer.Add( self.refresh_printer_button, 0, wx.ALL, 10 )
+
+		#宛名画像をファイルに書き出すときに、すでにあるファイルを飛ばすかどうか
+		self.export_skip_existing_checkbox = wx.CheckBox( self.setting_tab_panel, wx.ID_ANY, "すでにあるファイルは書き出さずに飛ばす（PNGは行ごと、PDFとTIFFはファイルごと）" )
+		self.export_skip_existing_checkbox.SetValue( self.software_setting[ "export-skip-existing" ] is True )
+
+		#バインド
+		self.export_skip_existing_checkbox.Bind( wx.EVT_CHECKBOX, self.change_export_skip_existing )
+
+		#枠（StaticBoxSizer）に入れる
+		self.export_sbox = wx.StaticBox( self.setting_tab_panel, wx.ID_ANY, "●宛名画像のファイルへの書き出し●" )
+		self.export_sizer = wx.StaticBoxSizer( self.export_sbox, wx.VERTICAL )
+		self.export_sizer.Add( self.export_skip_existing_checkbox, 1, wx.ALL | wx.EXPAND, 10 )
+
 		#設定を保存するボタン
 		self.save_settings_button = wx.Button( self.setting_tab_panel, wx.ID_ANY, "レイアウト、その他の設定を設定ファイル(iniファイル)に保存する", size=( 500,60 ) )
 
@@ -2111,7 +2788,14 @@ class frame_plus( wx.Frame ):
 		self.setting_tab_sizer = wx.BoxSizer( wx.VERTICAL )
 		self.setting_tab_sizer.Add( self.window_mode_size_sizer, 0, wx.ALL | wx.EXPAND, 10 )
 		self.setting_tab_sizer.Add( self.csv_table_font_sizer, 0, wx.ALL | wx.EXPAND, 10 )
+		self.setting_tab_sizer.Add( self.table_history_sizer, 0, wx.ALL | wx.EXPAND, 10 )
 		self.setting_tab_sizer.Add( self.titlebar_mode_sizer, 0, wx.ALL | wx.EXPAND, 10 )
+		self.setting_tab_sizer.Add( self.canvas_mode_sizer, 0, wx.ALL | wx.EXPAND, 10 )
+		self.setting_tab_sizer.Add( self.resolution_sizer, 0, wx.ALL | wx.EXPAND, 10 )
+		self.setting_tab_sizer.Add( self.batch_print_sizer, 0, wx.ALL | wx.EXPAND, 10 )
+		self.setting_tab_sizer.Add( self.pdf_image_sizer, 0, wx.ALL | wx.EXPAND, 10 )
+		self.setting_tab_sizer.Add( self.printer_capability_sizer, 0, wx.ALL | wx.EXPAND, 10 )
+		self.setting_tab_sizer.Add( self.export_sizer, 0, wx.ALL | wx.EXPAND, 10 )
 		self.setting_tab_sizer.Add( self.save_settings_button, 0, wx.ALIGN_CENTER_HORIZONTAL | wx.BOTTOM | wx.FIXED_MINSIZE )
 
 		self.setting_tab_panel.SetSizer( self.setting_tab_sizer )
@@ -2403,9 +3087,11 @@ class frame_plus( wx.Frame ):
 		self.changedict_image_restructure_int( dict_key = "postalcode-position", value = self.postalcode_position_y.GetValue(), list_position = 1 )
 
 	def send_postalcode_letterwidth( self, event ):
+		self.image_generator.clear_postalcode_sprites() #1字の範囲が変わると、郵便番号のスプライトは作り直しになる
 		self.changedict_image_restructure_int( dict_key = "postalcode-letter-areasize", value = self.postalcode_letterwidth.GetValue(), list_position = 0 )
 
 	def send_postalcode_letterheight( self, event ):
+		self.image_generator.clear_postalcode_sprites() #1字の範囲が変わると、郵便番号のスプライトは作り直しになる
 		self.changedict_image_restructure_int( dict_key = "postalcode-letter-areasize", value = self.postalcode_letterheight.GetValue(), list_position = 1 )
 
 	def send_postalcode_placement2( self, event ):
@@ -2463,9 +3149,11 @@ class frame_plus( wx.Frame ):
 		self.changedict_image_restructure_int( dict_key = "our-postalcode-position", value = self.our_postalcode_position_y.GetValue(), list_position = 1 )
 
 	def send_our_postalcode_letterwidth( self, event ):
+		self.image_generator.clear_postalcode_sprites() #1字の範囲が変わると、郵便番号のスプライトは作り直しになる
 		self.changedict_image_restructure_int( dict_key = "our-postalcode-letter-areasize", value = self.our_postalcode_letterwidth.GetValue(), list_position = 0 )
 
 	def send_our_postalcode_letterheight( self, event ):
+		self.image_generator.clear_postalcode_sprites() #1字の範囲が変わると、郵便番号のスプライトは作り直しになる
 		self.changedict_image_restructure_int( dict_key = "our-postalcode-letter-areasize", value = self.our_postalcode_letterheight.GetValue(), list_position = 1 )
 
 	def send_our_postalcode_placement2( self, event ):
@@ -2777,6 +3465,32 @@ class frame_plus( wx.Frame ):
 		#現在のタイトルバーを現在の設定で表示し直す
 		self.write_titlebar( self.software_setting[ "write-fileinfo-on-titlebar" ] )
 
+	#宛名画像の合成方式（PILイメージかNumPyの配列か）の設定変更
+	def change_canvas_mode( self, event ):
+		if self.canvas_mode_checkbox.GetValue() is True:
+			self.image_generator.set_canvas_mode( "numpy" )
+		else:
+			self.image_generator.set_canvas_mode( "pil" )
+
+		#NumPyが使えずに"pil"のままになった場合は、チェックを戻しておく
+		if self.canvas_mode_checkbox.GetValue() is True and self.image_generator.canvas_mode != "numpy":
+			self.canvas_mode_checkbox.SetValue( False )
+			self.SetStatusText( "NumPyがインストールされていないので、宛名画像はPILイメージで合成します" )
+
+		self.software_setting[ "canvas-mode" ] = self.image_generator.canvas_mode
+
+	#画面表示用の解像度の設定変更
+	#宛名画像生成インスタンスを、同じレイアウトのまま解像度だけ変えて作り直す
+	def change_screen_resolution( self, event ):
+		self.software_setting[ "screen-resolution" ] = self.array_resolution_tier[ self.combobox_screen_resolution.GetSelection() ]
+		self.image_generator = self.image_generator.derive( self.software_setting[ "screen-resolution" ] )
+
+		self.show_sample_image( cutted_atena_image_upside_down = self.column_etc_dictionary[ "upside-down-print" ] )
+
+	#印刷用の解像度の設定変更（印刷のたびに、画面表示用のインスタンスから作る）
+	def change_print_resolution( self, event ):
+		self.software_setting[ "print-resolution" ] = self.array_resolution_tier[ self.combobox_print_resolution.GetSelection() ]
+
 	#印刷を上下180°回転して印刷するかの設定変更
 	def change_upsidedown_print( self, event ):
 		self.column_etc_dictionary[ "upside-down-print" ] = self.upsidedown_print_checkbox.GetValue()
@@ -2791,6 +3505,66 @@ class frame_plus( wx.Frame ):
 		#サンプル画像の赤枠を更新する
 		self.show_sample_image( cutted_atena_image_upside_down = self.column_etc_dictionary[ "upside-down-print" ] )
 
+	#複数ページのPDFにまとめて印刷するかの設定変更
+	def change_batch_print( self, event ):
+		self.column_etc_dictionary[ "batch-print" ] = self.batch_print_checkbox.GetValue()
+
+	#まとめて印刷するときに、何枚ずつ1つのPDFにするかの設定変更
+	def change_batch_print_chunk_size( self, event ):
+		self.software_setting[ "batch-print-chunk-size" ] = self.batch_chunk_size_input.GetValue()
+
+	#印刷する宛名画像を並列に作るプロセス数の設定変更
+	def change_render_workers( self, event ):
+		self.software_setting[ "render-workers" ] = self.render_workers_input.GetValue()
+
+	#PDFをプリンターに送る方法の設定変更（フォルダの入力欄は、PDFファイルとして保存する場合だけ有効にする）
+	def change_spool_backend( self, event ):
+		self.software_setting[ "spool-backend" ] = SPOOL_BACKEND_NAMES[ self.combobox_spool_backend.GetSelection() ]
+
+		if self.software_setting[ "spool-backend" ] == "file":
+			self.spool_directory_input.Enable()
+		else:
+			self.spool_directory_input.Disable()
+
+	#プリンターに送るPDFへの宛名画像の埋め込み方の設定変更（白黒2値にしない場合は、境目と誤差拡散の入力欄を無効にする）
+	def change_pdf_image_encoding( self, event ):
+		self.software_setting[ "pdf-image-encoding" ] = PDF_IMAGE_ENCODINGS[ self.combobox_pdf_image_encoding.GetSelection() ]
+
+		if self.software_setting[ "pdf-image-encoding" ] == "grey":
+			self.bilevel_threshold_input.Disable()
+			self.bilevel_dither_checkbox.Disable()
+		else:
+			self.bilevel_threshold_input.Enable()
+			self.bilevel_dither_checkbox.Enable()
+
+	#白黒2値にするときの明るさの境目の設定変更
+	def change_bilevel_threshold( self, event ):
+		self.software_setting[ "bilevel-threshold" ] = self.bilevel_threshold_input.GetValue()
+
+	#白黒2値にするときに誤差拡散するかどうかの設定変更
+	def change_bilevel_dither( self, event ):
+		self.software_setting[ "bilevel-dither" ] = self.bilevel_dither_checkbox.GetValue()
+
+	#PDFへの宛名画像の埋め込み方の設定を、PdfPrintBatchの引数の辞書にする
+	def get_pdf_image_options( self ):
+		return { "image_encoding" : self.software_setting[ "pdf-image-encoding" ], "bilevel_threshold" : self.software_setting[ "bilevel-threshold" ], "bilevel_dither" : self.software_setting[ "bilevel-dither" ] }
+
+	#宛名画像をファイルに書き出すときに、すでにあるファイルを飛ばすかどうかの設定変更
+	def change_export_skip_existing( self, event ):
+		self.software_setting[ "export-skip-existing" ] = self.export_skip_existing_checkbox.GetValue()
+
+	#PDFファイルとして保存する場合のフォルダの設定変更
+	def input_spool_directory( self, event ):
+		self.software_setting[ "spool-directory" ] = self.spool_directory_input.GetValue()
+
+	#設定にしたがって、PDFをプリンターに送る方法のインスタンスを作る
+	def make_print_spool_backend( self ):
+		spool_directory = self.software_setting[ "spool-directory" ]
+		if spool_directory == "":
+			spool_directory = os.path.join( os.path.split( sys.argv[0] )[0], DEFAULT_SPOOL_DIRECTORY_NAME )
+
+		return make_spool_backend( self.software_setting[ "spool-backend" ], spool_directory )
+
 	#現在の郵便番号や住所氏名の各パーツの配置と用紙種別＆サイズをレイアウトファイルとして保存する
 	def layoutfile_save( self, event ):
 		#現在時刻の取得とデフォルトファイル名の作成
@@ -2897,7 +3671,7 @@ class frame_plus( wx.Frame ):
 			self.overwrite_dict_for_image_generator = saved_atena_layout_dict
 
 			#更新された用紙サイズと設定値の辞書をもとに宛名画像作成インスタンスを再作成する
-			self.image_generator = atena_image_maker( papersize_widthheight_millimetre =  ( self.paper_size_data[ "width" ], self.paper_size_data[ "height" ] ), overwrite_settings = self.overwrite_dict_for_image_generator )
+			self.image_generator = atena_image_maker( papersize_widthheight_millimetre =  ( self.paper_size_data[ "width" ], self.paper_size_data[ "height" ] ), overwrite_settings = self.overwrite_dict_for_image_generator, canvas_mode = self.software_setting[ "canvas-mode" ], resolution = self.software_setting[ "screen-resolution" ] )
 
 			#各入力欄などの数値や選択の表示を再設定する
 			#一部、更新された宛名画像作成オブジェクトの値を使用するので、再作成の後に置かないといけない
@@ -2906,6 +3680,9 @@ class frame_plus( wx.Frame ):
 			#サンプルイメージを更新する
 			self.show_sample_image( cutted_atena_image_upside_down = self.column_etc_dictionary[ "upside-down-print" ] )
 
+			#用紙サイズが変わったかもしれないので、プリンターの情報を調べておく
+			self.prepare_printer_capabilities()
+
 		fdialog.Destroy()
 
 	#印刷用紙のサイズが変更された場合に設定辞書や表示を連動して変更させる
@@ -2989,7 +3766,7 @@ class frame_plus( wx.Frame ):
 		auto_relocation_question_dialog.Destroy()
 
 		#宛名画像生成インスタンスの作り直し
-		self.image_generator = atena_image_maker( papersize_widthheight_millimetre =  ( self.paper_size_data[ "width" ], self.paper_size_data[ "height" ] ), overwrite_settings = new_parts_dict )
+		self.image_generator = atena_image_maker( papersize_widthheight_millimetre =  ( self.paper_size_data[ "width" ], self.paper_size_data[ "height" ] ), overwrite_settings = new_parts_dict, canvas_mode = self.software_setting[ "canvas-mode" ], resolution = self.software_setting[ "screen-resolution" ] )
 
 		#レイアウト参考画像部分の用紙サイズ表示を更新
 		self.sampleimage_sbox.SetLabel( "印刷の参考イメージ ( " + self.paper_size_data[ "category" ] + "、" + str( self.paper_size_data[ "width" ] ) + "mm x " + str( self.paper_size_data[ "height" ] ) + "mm )" )
@@ -3000,6 +3777,22 @@ class frame_plus( wx.Frame ):
 		#各入力欄の値を再設定する
 		self.layout_widgets_initialize()
 
+		#新しい用紙サイズについて、プリンターの情報を先に調べておく
+		self.prepare_printer_capabilities()
+
+	#プリンターの印刷先と用紙サイズ名を、別スレッドで調べて控えておく（lpstatなどの待ち時間でGUIを止めないため）
+	def prepare_printer_capabilities( self, refresh = False ):
+		if refresh is True:
+			printer_capabilities.refresh()
+
+		prepare_thread = threading.Thread( target = printer_capabilities.prepare, args = ( self.paper_size_data[ "width" ], self.paper_size_data[ "height" ] ), daemon = True )
+		prepare_thread.start()
+
+	#プリンターの情報を調べなおす（プリンターを追加・変更した場合用）
+	def refresh_printer_capabilities( self, event ):
+		self.prepare_printer_capabilities( refresh = True )
+		self.SetStatusText( "プリンターの情報を調べなおしています" )
+
 	#タイトルバーの表示を更新する
 	def write_titlebar( self, titlebar_mode ):
 
@@ -3085,7 +3878,7 @@ class frame_plus( wx.Frame ):
 		self.sample_color_image = ImageOps.colorize( self.sample_grayscale_image, ( 0, 0, 0 ), ( 255, 255, 255 ) )
 
 		#赤枠をつける処理
-		redline_width = self.image_generator.get_parts_data( "redline-width" )
+		redline_width = self.image_generator.get_redline_width()
 		space_tblr_list = self.image_generator.convert_mm_to_pixel( self.column_etc_dictionary[ "printer-space-top,bottom,left,right" ] )
 
 
@@ -3207,7 +4000,14 @@ class frame_plus( wx.Frame ):
 	def change_font( self, event ):
 		obj = event.GetEventObject()
 		choiced_fontpath = obj.GetClientData(obj.GetSelection())
+
+		#前のフォントのハンドルはもう使わないので、フォントプールから破棄しておく
+		previous_fontpath = self.image_generator.get_parts_data( "fontfile" )
+		if previous_fontpath != choiced_fontpath:
+			invalidate_font_pool( previous_fontpath )
+
 		self.image_generator.set_parts_data( "fontfile", choiced_fontpath )
+		self.image_generator.clear_postalcode_sprites()
 		self.image_generator.determine_fontmat_size( choiced_fontpath )
 		self.show_sample_image( cutted_atena_image_upside_down = self.column_etc_dictionary[ "upside-down-print" ] )
 
@@ -3220,9 +4020,15 @@ class frame_plus( wx.Frame ):
 
 	#余白計測用の枠画像を印刷
 	def print_frame_image( self, event ):
-		red_frame_image = self.image_generator.get_red_frame_image()
+		print_generator = self.image_generator.derive( self.software_setting[ "print-resolution" ] )
+		red_frame_image = print_generator.get_red_frame_image()
 
-		pil_printing( red_frame_image, paper_size = "Custom." + str( self.paper_size_data[ "width" ] ) + "x" + str( self.paper_size_data[ "height" ] ) + "mm" )
+		#宛名の印刷と同じく、設定で選んだ送り方でプリンターに送る
+		spool_backend = self.make_print_spool_backend()
+		try:
+			pil_printing( red_frame_image, paper_size = "Custom." + str( self.paper_size_data[ "width" ] ) + "x" + str( self.paper_size_data[ "height" ] ) + "mm", mm_pixel_rate = print_generator.mm_pixel_rate, spool_backend = spool_backend )
+		finally:
+			spool_backend.close()
 
 	#印刷の可否判別を有効にするか無効にするか
 	def change_print_control_on_off( self, event ):
@@ -3390,68 +4196,83 @@ class frame_plus( wx.Frame ):
 
 	#-----以下、表に関する関数-----
 
-	#読み込んだCSVファイルの内容、または履歴中の一つを表に反映させる
+	#読み込んだCSVファイルの内容を表に反映させる
 	def set_table( self, string_2dimension_list ):
-		#Rows(縦の行数)をlistの行数に合わせる
-		current_rows = len( string_2dimension_list )
-
-		if current_rows - self.grid.GetNumberRows() > 0:
-			self.grid.AppendRows( current_rows - self.grid.GetNumberRows() )
-		elif current_rows - self.grid.GetNumberRows() < 0:
-			self.grid.DeleteRows( current_rows, self.grid.GetNumberRows() - current_rows )
-
-		#Cols（横の列数）をlistの最大列数に合わせる
-		max_len = max( [ len( x ) for x in string_2dimension_list ] ) #CSVがすべての行で同じ列数とは限らないので、最大の長さを求める
-
-		if max_len - self.grid.GetNumberCols() > 0:
-			self.grid.AppendCols( max_len - self.grid.GetNumberCols() )
-		elif max_len - self.grid.GetNumberCols() < 0:
-			self.grid.DeleteCols( max_len, self.grid.GetNumberCols() - max_len )
-
-		#それぞれのセルにCSVの内容を入れていく
-		for j in range( self.grid.GetNumberRows() ):
-			for i in range( self.grid.GetNumberCols() ):
-				try:
-					self.grid.SetCellValue( j, i, string_2dimension_list[j][i] ) #セルに値を設定する（値は文字列のみ、( 縦の位置, 横の位置, 値 )になる）
-				except:
-					#CSVが行によって項目数が不揃いだったりすると、項目が少ない行では
-					#欠落が生じるので、そこには空白を充てる
-					self.grid.SetCellValue( j, i, "" )
+		#CSVが行によって項目数が不揃いでも、モデルの側で最大の列数に合わせて空白で埋める
+		#セルごとに値を書き込むのではなく、表が参照するモデルを入れ替えるだけにする
+		self.grid_table.set_model( AddressTableModel( string_2dimension_list ) )
 
 		#行・列のサイズを自動調整
-		self.grid.AutoSizeColumns()
-		self.grid.AutoSizeRows()
-
-	#表に変更があった場合に、表の内容をリスト化して履歴に加える
+		self.autosize_table()
+
+	#表の列幅と行の高さを、一部の行だけを調べて自動調整する
+	#（AutoSizeColumns、AutoSizeRowsは全行を調べるので、行数が多いと固まってしまう）
+	def autosize_table( self ):
+		model = self.grid_table.model
+		sample_rows = model.sample_row_indices( TABLE_AUTOSIZE_SAMPLE_ROWS )
+		cell_margin = 10
+
+		dc = wx.ClientDC( self.grid )
+		self.grid.BeginBatch()
+
+		#列幅は、調べた行のセルの文字列とラベルの幅の大きい方に合わせる
+		for col in range( model.get_column_count() ):
+			dc.SetFont( self.grid.GetLabelFont() )
+			col_width = dc.GetTextExtent( self.grid.GetColLabelValue( col ) )[0]
+
+			dc.SetFont( self.grid.GetDefaultCellFont() )
+			for row in sample_rows:
+				for text_line in model.get_value( row, col ).split( "\n" ):
+					col_width = max( col_width, dc.GetTextExtent( text_line )[0] )
+
+			self.grid.SetColSize( col, col_width + cell_margin )
+
+		#行の高さは、調べた行の中で最も行数の多いセルに合わせて、全行をそろえる
+		dc.SetFont( self.grid.GetDefaultCellFont() )
+		line_height = dc.GetTextExtent( "あ" )[1]
+		max_lines = 1
+		for row in sample_rows:
+			for col in range( model.get_column_count() ):
+				max_lines = max( max_lines, model.get_value( row, col ).count( "\n" ) + 1 )
+
+		self.grid.SetDefaultRowSize( line_height * max_lines + cell_margin // 2, resizeExistingRows = True )
+		self.grid.EndBatch()
+
+	#表に変更があった場合に、その変更の差分を履歴に加える
+	#（セルの編集や行・列の加減は、表が参照するモデルが差分を記録しているので、それを1回の操作としてまとめて積む）
 	def add_table_to_history( self, event ):
 
-		#リドゥ中で、履歴中の現在位置が最初でなかった場合は、最新〜現在までの履歴を削除する
-		if self.current_history_position != 0:
-			for delete in range( self.current_history_position ):
-				self.table_history.pop( 0 )
-			self.current_history_position = 0
+		#リドゥ中で、履歴中の現在位置が最新でなかった場合は、最新〜現在までの履歴は履歴の側で削除される
+		#履歴の大きさが上限に達していれば、古い履歴から削除される
+		self.table_history.record( self.grid_table.model.take_patches() )
 
-		#履歴の数が一定数に達していれば、それ以上の履歴を削除する
-		if len( self.table_history ) > self.history_stock_max:
-			for delete in range( len( self.table_history ) - self.history_stock_max ):
-				self.table_history.pop()
+		#（表を操作した）イベントで使用されたなら、ステータスバーをクリア
+		if event is not None:
+			self.statusbar.SetStatusText( "" )
 
-		#本番の作業（表の内容をリスト化して履歴に加える）
-		current_table = []
-		temporary_list = []
+	#履歴を指定の位置（0が最新）まで戻す・進める
+	#表を丸ごと入れ替えずに、差分だけを表に当てて、変わったところだけを描き直す
+	def move_table_history( self, target_position ):
+		#履歴に積んでいない変更が残っていたら、先に積んでおく
+		self.add_table_to_history( None )
 
-		for j in range( self.grid.GetNumberRows() ):
-			temporary_list = []
+		applied_operations = []
 
-			for i in range( self.grid.GetNumberCols() ):
-				temporary_list.append( self.grid.GetCellValue( j, i ) )
-			current_table.append( temporary_list )
+		while self.table_history.position < target_position:
+			applied_operations += self.grid_table.apply_patches( self.table_history.undo(), undo = True )
 
-		self.table_history.insert( 0, current_table )
+		while self.table_history.position > target_position:
+			applied_operations += self.grid_table.apply_patches( self.table_history.redo(), undo = False )
 
-		#（表を操作した）イベントで使用されたなら、ステータスバーをクリア
-		if event is not None:
-			self.statusbar.SetStatusText( "" )
+		#列数が変化したかもしれない場合だけ、ラベルを貼り直す
+		if any( operation[0] in ( "insert-columns", "delete-columns" ) for operation in applied_operations ):
+			self.set_grid_labels()
+
+		#最後に変わったセルまでスクロールさせる
+		changed_cells = [ operation for operation in applied_operations if operation[0] == "cell" ]
+		if len( changed_cells ) > 0:
+			self.grid.SetGridCursor( changed_cells[-1][1], changed_cells[-1][2] )
+			self.grid.MakeCellVisible( changed_cells[-1][1], changed_cells[-1][2] )
 
 
 	#列のラベルを設定する
@@ -3469,8 +4290,11 @@ class frame_plus( wx.Frame ):
 
 		#役割のある最大列より表の列数が足りなければ、表を横に広げる
 		#（逆に、余った場合に列を削除する、ということはしない）
+		#（ラベルのための列の追加は、表の変更履歴には積まない）
 		if max_special_column >= self.grid.GetNumberCols():
+			self.grid_table.model.recording = False
 			self.grid.AppendCols( max_special_column - self.grid.GetNumberCols() + 1 )
+			self.grid_table.model.recording = True
 
 		#指定のない列でもABC...というのはわかりにくいので、番号をつける
 		nomal_labels = ["列" + str( x ) for x in range( 1, self.grid.GetNumberCols() + 1 ) ]
@@ -3496,13 +4320,13 @@ class frame_plus( wx.Frame ):
 			self.grid.SetColLabelValue( column, nomal_labels[ column ] )
 
 		#列幅を自動調整
-		self.grid.AutoSizeColumns()
+		self.autosize_table()
 
 
 	#ファイル選択ダイアログからCSVファイルを選び、CSVファイルを開く関数に渡す
 	def fileselect_and_opencsv( self, event ):
 		#まず、現在の表の内容が（変更がない時点の）控えと同一かチェックする
-		current_table = self.get_current_table_list()
+		current_table = self.get_table_snapshot()
 
 		if current_table != self.table_checkpoint:
 			question_dialog = wx.MessageDialog( parent = self, message = "現在の表の内容が変更されていますが保存されていません。\nこのまま開くと現在の内容は失われます。\n\n開く前に保存しますか？", caption = "表内容の変更に関する確認", style = wx.YES_NO | wx.ICON_QUESTION )
@@ -3545,12 +4369,12 @@ class frame_plus( wx.Frame ):
 		if csv_path != "" and os.path.isfile( csv_path ):
 
 			#CSVファイルの読み込み
-			#関数の中で読み込みテストをすることで、いくつかの文字コードに対応したCSV読み込みをする
-			csv_data = csv_to_list( csv_path )
+			#関数の中で文字コードを判定して、いくつかの文字コードに対応したCSV読み込みをする
+			#判定した文字コードは保存時に使うので控えておく
+			csv_data, csv_encoding = read_csv_file( csv_path )
 
 			#ファイル読み込み時点を履歴の起点とするので、履歴をリセットする
-			self.table_history = []
-			self.current_history_position = 0
+			self.table_history.clear()
 
 			#読み込んだCSVのデータを表に書き込む
 			self.set_table( csv_data )
@@ -3559,16 +4383,14 @@ class frame_plus( wx.Frame ):
 			self.print_start_line.SetValue( 1 )
 			self.print_end_line.SetValue( self.grid.GetNumberRows() )
 
-			#ファイル読み込み直後の表の内容を履歴に登録する
-			#（add_table_to_history( None )を起動してもいいが、ここでは簡単にCSVのデータを代わりに履歴に追加しておく）
-			self.table_history.insert( 0, csv_data )
 			self.statusbar.SetStatusText( "CSVファイル「" + os.path.basename( csv_path ) + "」を開きました" )
 
 			#表の内容の控えをリセット・更新する（変更が保存されているかのチェック用）
-			self.table_checkpoint = self.get_current_table_list()
+			self.table_checkpoint = self.get_table_snapshot()
 
-			#開いたファイルのパスを控えておく
+			#開いたファイルのパスと文字コードを控えておく
 			self.opened_file_path = csv_path
+			self.opened_file_encoding = csv_encoding
 
 			#CSVの列数のままだとラベルを貼るために必要な列数に足りないかもしれないので
 			#その調整も兼ねてラベルを貼り直す
@@ -3581,7 +4403,7 @@ class frame_plus( wx.Frame ):
 	#表の内容をCSVファイルとして保存する
 	def save_csv_file( self, event ):
 		#表の内容をリスト化
-		current_table = self.get_current_table_list()
+		current_table = self.get_table_snapshot()
 
 		csv_path = ""
 
@@ -3606,9 +4428,24 @@ class frame_plus( wx.Frame ):
 
 			csv_path = os.path.join ( dirpath, filename )
 
-			with open( csv_path, "w" ) as f:
-				writer = csv.writer( f, quoting = csv.QUOTE_ALL )
-				writer.writerows( current_table )
+			#開いたファイルと同じ文字コードで書き戻す
+			#（新規の表なら従来通りシステムの既定の文字コードで書く）
+			csv_encoding = self.opened_file_encoding
+			try:
+				with open( csv_path, "w", encoding = csv_encoding ) as f:
+					writer = csv.writer( f, quoting = csv.QUOTE_ALL )
+					writer.writerows( current_table )
+			except UnicodeEncodeError:
+				#元の文字コードで表せない文字が入っていたら、UTF-8で書き直す
+				csv_encoding = "utf-8"
+				with open( csv_path, "w", encoding = csv_encoding ) as f:
+					writer = csv.writer( f, quoting = csv.QUOTE_ALL )
+					writer.writerows( current_table )
+				self.statusbar.SetStatusText( "元の文字コードで保存できない文字があったため、UTF-8で保存しました" )
+
+			#開いているファイルに上書きした場合は、書いた文字コードを控え直す
+			if os.path.abspath( csv_path ) == os.path.abspath( self.opened_file_path ):
+				self.opened_file_encoding = csv_encoding
 
 		fdialog.Destroy()
 
@@ -3616,20 +4453,11 @@ class frame_plus( wx.Frame ):
 		self.table_checkpoint = current_table
 
 
-	#現在の表の内容をリスト化して取得する
-	def get_current_table_list( self ):
-		current_table_list = []
-		temporary_list = []
-
-		for j in range( self.grid.GetNumberRows() ):
-			temporary_list = []
-
-			for i in range( self.grid.GetNumberCols() ):
-				cell_value = self.grid.GetCellValue( j, i )
-				temporary_list.append( cell_value )
-			current_table_list.append( temporary_list )
-
-		return current_table_list
+	#現在の表の内容の写しを取得する
+	#セルごとにgridから取り出さず、表が参照しているモデルの写し（変更できず、作るのにコピーのいらないもの）を返す
+	#写しは行番号で引くと行のリストを返すので、印刷やプレビュー、保存ではリストのリストと同じように読める
+	def get_table_snapshot( self ):
+		return self.grid_table.model.snapshot()
 
 
 	#タブの切り替えに応じて、住所表のタブでのみステータスバーを出して、それ以外では隠す
@@ -3649,7 +4477,7 @@ class frame_plus( wx.Frame ):
 			#行が取得できていれば、それらのリストの最初の行番号だけにする
 			selected_row_position = selected_row_position_list[0]
 
-		current_table = self.get_current_table_list()
+		current_table = self.get_table_snapshot()
 
 		image_preview_dialog = AtenaPreviewDialog( paper_data_dict = self.paper_size_data, destination_list = current_table, column_data = self.column_etc_dictionary, our_data = self.our_data, min_line_int = self.print_start_line.GetValue(), max_line_int = self.print_end_line.GetValue(), image_generator_instance = self.image_generator, space_tblr_mm_list = self.column_etc_dictionary[ "printer-space-top,bottom,left,right" ], cutted_atena_image_upside_down = self.column_etc_dictionary[ "upside-down-print" ], current_row = selected_row_position )
 
@@ -3759,10 +4587,9 @@ class frame_plus( wx.Frame ):
 				return False
 			temporary_list = []
 
-			#検索の本体といえる処理
-			for j in range( self.grid.GetNumberRows() ):
-				for i in range( self.grid.GetNumberCols() ):
-					cell_value = self.grid.GetCellValue( j, i )
+			#検索の本体といえる処理（gridのセルを1つずつ取り出さず、モデルの行を直接調べる）
+			for j, row in enumerate( self.get_table_snapshot() ):
+				for i, cell_value in enumerate( row ):
 					if search_word in cell_value:
 						temporary_list.append( [ i, j ] )
 
@@ -3826,8 +4653,7 @@ class frame_plus( wx.Frame ):
 			self.grid.SetDefaultCellFont( changed_fontdata )
 
 			#表の行・列のサイズを自動調整する
-			self.grid.AutoSizeColumns()
-			self.grid.AutoSizeRows()
+			self.autosize_table()
 
 
 	#表のフォントサイズ変更
@@ -3848,8 +4674,13 @@ class frame_plus( wx.Frame ):
 			self.grid.SetDefaultCellFont( changed_fontdata )
 
 			#フォントあるいはフォントサイズを変更したので、表の行・列のサイズを調整する
-			self.grid.AutoSizeColumns()
-			self.grid.AutoSizeRows()
+			self.autosize_table()
+
+
+	#表の変更履歴に使うメモリの上限の設定変更（上限を下げたら、その場で古い履歴を捨てる）
+	def change_table_history_memory( self, event ):
+		self.software_setting[ "table-history-memory-mb" ] = self.table_history_memory_input.GetValue()
+		self.table_history.set_memory_budget( self.software_setting[ "table-history-memory-mb" ] * 1024 * 1024 )
 
 
 	#-----表関係の関数はここまで-----
@@ -3896,22 +4727,311 @@ class frame_plus( wx.Frame ):
 
 			current_label = self.print_button.GetLabel()
 
-			self.print_button.SetLabel( "印刷を中止" )
-			self.thread = threading.Thread( target = self.atena_print, args = ( None, ), daemon=True )
-			self.thread.setDaemon( True )
-			self.thread.start()
+			self.start_print_thread()
 
 		#ボタンのラベルが「宛名印刷する」以外、つまり「印刷を中止」のときに押したら、中止する
 		else:
 			self.print_stop_flag = True
 
 
+	#印刷のスレッドを始める（印刷中は印刷ボタンを中止ボタンにする）
+	#resume_journalに印刷ジョブの記録を渡すと、その続きから印刷する
+	def start_print_thread( self, resume_journal = None ):
+		self.print_button.SetLabel( "印刷を中止" )
+		self.resume_print_button.Disable()
+		self.export_button.Disable()
+		self.thread = threading.Thread( target = self.atena_print, args = ( None, resume_journal ), daemon=True )
+		self.thread.setDaemon( True )
+		self.thread.start()
+
+
+	#印刷や書き出しが終わったら、中止ボタンにしていた印刷ボタンを元に戻し、無効にしていたボタンを有効に戻す
+	def restore_print_buttons( self ):
+		self.print_button.SetLabel( "宛名印刷する" )
+		self.resume_print_button.Enable()
+		self.export_button.Enable()
+
+
+	#前回の印刷を続きから印刷する
+	def resume_atena_print( self, event ):
+		#印刷中は何もしない
+		if self.print_button.GetLabel() != "宛名印刷する":
+			return
+
+		print_journal = PrintJobJournal( self.get_print_journal_path() )
+
+		if print_journal.load() is False or print_journal.finished is True:
+			self.stop_message_dialog( "続きから印刷できる、途中で止まった印刷はありません" )
+			return
+
+		current_table = self.get_table_snapshot()
+		print_generator = self.image_generator.derive( self.software_setting[ "print-resolution" ] )
+		layout_hash, table_hash = self.get_print_job_hashes( current_table, print_generator, print_journal.params[ "print-size" ] )
+		layout_match, table_match = print_journal.matches( layout_hash, table_hash )
+
+		#前回の印刷からレイアウトか住所表が変わっていたら、続きからは印刷しない
+		if layout_match is False or table_match is False:
+			changed_list = []
+			if layout_match is False:
+				changed_list.append( "印刷レイアウト（用紙サイズ、位置、フォント、列の割り当て、差出人など）" )
+			if table_match is False:
+				changed_list.append( "住所表の内容" )
+
+			self.stop_message_dialog( "前回の印刷から" + "と".join( changed_list ) + "が変わっているため、続きから印刷できません。\n\n最初から印刷し直すか、印刷する行の範囲を指定して印刷してください。" )
+			return
+
+		min_line = print_journal.params[ "min-line" ]
+		max_line = print_journal.params[ "max-line" ]
+		resume_dialog = wx.MessageDialog( self, message = str( min_line + 1 ) + "行目から" + str( max_line + 1 ) + "行目までの印刷のうち、" + str( print_journal.done_count() ) + "件はプリンターに送り終わっています。\n残りを印刷しますか？", caption = "続きから印刷", style = wx.YES_NO | wx.ICON_QUESTION )
+
+		if resume_dialog.ShowModal() == wx.ID_YES:
+			self.start_print_thread( resume_journal = print_journal )
+
+		resume_dialog.Destroy()
+
+
+	#印刷ジョブの記録ファイルのパス（CSVファイルを開いていればその隣、そうでなければINIファイルの隣）
+	def get_print_journal_path( self ):
+		return self.get_print_record_basepath() + ".printjob.json"
+
+
+	#印刷の所要時間の記録ファイルのパス（印刷ジョブの記録と同じ場所）
+	def get_print_report_path( self ):
+		return self.get_print_record_basepath() + ".printreport.json"
+
+
+	def get_print_record_basepath( self ):
+		if os.path.isfile( self.opened_file_path ):
+			return os.path.splitext( self.opened_file_path )[0]
+		else:
+			return os.path.splitext( sys.argv[0] )[0]
+
+
+	#続きから印刷してよいかを確かめるための、印刷レイアウトと住所表のハッシュを返す
+	#（画像の合成方式とまとめて印刷するかどうかは、印刷される内容に関係ないので含めない）
+	def get_print_job_hashes( self, current_table, print_generator, print_size ):
+		layout_snapshot = print_generator.get_layout_snapshot()
+		del layout_snapshot[ "canvas-mode" ]
+		column_etc_data = { key : value for key, value in self.column_etc_dictionary.items() if key != "batch-print" }
+
+		layout_hash = PrintJobJournal.hash_data( { "layout" : layout_snapshot, "column-etc" : column_etc_data, "our-data" : self.our_data, "print-size" : print_size } )
+		table_hash = PrintJobJournal.hash_data( current_table.to_list() )
+
+		return ( layout_hash, table_hash )
+
+
 	#宛名の印刷
-	def atena_print( self, event ):
-		current_table = self.get_current_table_list()
+	#「宛先の取り出し → 宛名画像の作成 → PDF化 → プリンターへの送信」の各段を別々のスレッドで並行に動かし、
+	#前の宛名をプリンターに送っている間に、次の宛名画像を作っておく
+	#印刷ジョブの記録（resume_journal）を渡された場合は、記録した行の範囲のうち、プリンターに送り終わった行を飛ばして印刷する
+	def atena_print( self, event, resume_journal = None ):
+		current_table = self.get_table_snapshot()
 
 		print_size = "Custom." + str( self.paper_size_data[ "width" ] ) + "x" + str( self.paper_size_data[ "height" ] ) + "mm"
 
+		min_line, max_line = self.get_print_line_range( current_table )
+
+		#印刷用の解像度の宛名画像生成インスタンス（画面表示用と同じ解像度なら、それをそのまま使う）
+		print_generator = self.image_generator.derive( self.software_setting[ "print-resolution" ] )
+
+		#まとめて印刷する場合はbatch-print-chunk-size枚（0なら全部）ごとに、そうでなければ1枚ごとに1つのPDFにしてプリンターに送る
+		if self.column_etc_dictionary[ "batch-print" ] is True:
+			chunk_size = self.software_setting[ "batch-print-chunk-size" ]
+		else:
+			chunk_size = 1
+
+		#印刷ジョブの記録（CSVファイルの隣に書いて、途中で止まったら続きから印刷できるようにする）
+		if resume_journal is not None:
+			print_journal = resume_journal
+			min_line = print_journal.params[ "min-line" ]
+			max_line = print_journal.params[ "max-line" ]
+		else:
+			print_journal = PrintJobJournal( self.get_print_journal_path() )
+			layout_hash, table_hash = self.get_print_job_hashes( current_table, print_generator, print_size )
+			print_journal.start( { "csv-path" : self.opened_file_path, "min-line" : min_line, "max-line" : max_line, "print-size" : print_size, "print-resolution" : self.software_setting[ "print-resolution" ], "chunk-size" : chunk_size, "started" : datetime.datetime.now().isoformat( timespec = "seconds" ) }, layout_hash, table_hash )
+
+		#各段の1枚あたりの所要時間の集計（ステータスバーの速度・残り時間の表示と、終了時の記録ファイル用）
+		print_metrics = PrintJobMetrics( total_rows = len( [ line_number for line_number in range( min_line, max_line + 1 ) if not print_journal.is_done( line_number ) ] ) )
+
+		render_stage = self.make_render_stage( print_generator, print_metrics )
+
+		#プリンターに送り終わった最後の行（中止したときの表示用）と、送った印刷ジョブのID
+		spool_progress = { "last-line" : None, "job-ids" : [] }
+
+		#PDFをプリンターに送る方法（IPPなら、この印刷の間は1つの接続を使い回す）
+		spool_backend = self.make_print_spool_backend()
+
+		#各段の間の待ち行列は4個までにしておき、作りためた宛名画像でメモリを使いすぎないようにする
+		print_pipeline = PrintPipeline( source = self.iterate_print_records( current_table, min_line, max_line, print_metrics, skip_check = print_journal.is_done ), stages = [ render_stage, lambda images : self.encode_print_stage( images, print_size, print_generator.mm_pixel_rate, chunk_size, print_metrics, self.get_pdf_image_options() ), lambda pdf_chunks : self.spool_print_stage( pdf_chunks, print_size, spool_progress, print_journal, print_metrics, spool_backend ) ], queue_depth = 4, stop_check = lambda : self.print_stop_flag )
+
+		#所要時間の記録ファイルに一緒に書く、送り方と印刷ジョブのID
+		report_extra = { "spool-backend" : spool_backend.name, "pdf-image-encoding" : self.software_setting[ "pdf-image-encoding" ], "job-ids" : spool_progress[ "job-ids" ] }
+
+		try:
+			print_completed = print_pipeline.run()
+		except Exception as e:
+			# 印刷エラーが発生した場合、ダイアログで表示して処理を中止
+			error_message = str(e)
+			if len( spool_progress[ "job-ids" ] ) > 0:
+				error_message += "\n\n（エラーの前に" + str( len( spool_progress[ "job-ids" ] ) ) + "件の印刷ジョブを送っています。最後のジョブID: " + spool_progress[ "job-ids" ][-1] + "）"
+			print_metrics.write_report( self.get_print_report_path(), result = "error", extra = report_extra )
+			wx.CallAfter( self.restore_print_buttons )
+			wx.CallAfter( self.SetStatusText, "印刷エラーが発生しました" )
+			wx.CallAfter( self.stop_message_dialog, error_message )
+			self.print_stop_flag = False
+			return False
+		finally:
+			#使い回していた接続を閉じる（すべての段が止まった後なので、もう送ることはない）
+			spool_backend.close()
+
+		#印刷中止用の変数がTrueになって止まったなら、ステータスバーやダイアログで中止を表明して関数を終了する
+		#（まだプリンターに送っていなかった分は、作りかけの画像やPDFごと捨てられる）
+		if print_completed is False:
+			print_metrics.write_report( self.get_print_report_path(), result = "cancelled", extra = report_extra )
+
+			if spool_progress[ "last-line" ] is None:
+				stop_message = "プリンターに送る前に印刷を中止しました"
+			else:
+				stop_message = str( spool_progress[ "last-line" ] + 1 ) + "行目までで印刷を中止しました"
+
+			if chunk_size != 1:
+				stop_message += "（まとめて印刷のため、まだプリンターに送っていなかった分は印刷されません）"
+
+			if print_journal.write_error is None:
+				stop_message += "\n\n残りは「続きから印刷」ボタンで印刷できます"
+
+			wx.CallAfter( self.SetStatusText, stop_message )
+			#「印刷中止」にしていたボタンのラベルを元に戻しておく
+			wx.CallAfter( self.restore_print_buttons )
+			wx.CallAfter( self.stop_message_dialog, stop_message )
+
+			self.print_stop_flag = False
+			return False
+
+		#最後まで送り終わったので、続きから印刷する対象から外す
+		print_journal.finish()
+		print_metrics.write_report( self.get_print_report_path(), result = "completed", extra = report_extra )
+
+		#印刷終了後に、「中止ボタン」に変えていた印刷ボタンのラベルを元に戻しておく
+		wx.CallAfter( self.restore_print_buttons )
+		#ステータスバーに、印刷した枚数と速さを出しておく
+		wx.CallAfter( self.statusbar.SetStatusText, str( print_metrics.cards_done ) + "枚の印刷をプリンターに送りました（" + str( round( print_metrics.elapsed_seconds(), 1 ) ) + "秒、毎分" + str( round( print_metrics.cards_per_minute(), 1 ) ) + "枚、PDF合計" + str( round( print_metrics.spool_bytes / 1024, 1 ) ) + "KB）" )
+
+
+	#印刷範囲の宛名画像を、印刷せずにファイルとして書き出す（形式と書き出し先を選んでから、別スレッドで書き出す）
+	def export_atena_images( self, event ):
+		#印刷中や書き出し中は何もしない
+		if self.print_button.GetLabel() != "宛名印刷する":
+			return
+
+		format_dialog = wx.SingleChoiceDialog( self, "書き出す形式を選んでください（印刷範囲の行が対象です）", "ファイルに書き出す", [ "複数ページのPDF（1つのファイル）", "複数ページのTIFF（1つのファイル）", "PNG（フォルダに1枚ずつ、「行番号_氏名.png」）" ] )
+		if format_dialog.ShowModal() != wx.ID_OK:
+			format_dialog.Destroy()
+			return
+		export_format = EXPORT_FORMATS[ format_dialog.GetSelection() ]
+		format_dialog.Destroy()
+
+		#書き出し先のデフォルトは、CSVファイルと同じフォルダ
+		if os.path.isfile( self.opened_file_path ):
+			save_dir = os.path.dirname( self.opened_file_path )
+			default_save_name = os.path.splitext( os.path.basename( self.opened_file_path ) )[0]
+		else:
+			save_dir = os.path.split( sys.argv[0] )[0]
+			default_save_name = datetime.datetime.now().strftime( "%Y年%m月%d日%H時%M分%S秒" )
+
+		output_path = ""
+		if export_format == "png":
+			ddialog = wx.DirDialog( self, "PNGファイルを書き出すフォルダを選んでください", defaultPath = save_dir )
+			if ddialog.ShowModal() == wx.ID_OK:
+				output_path = ddialog.GetPath()
+			ddialog.Destroy()
+		else:
+			extension = "." + export_format
+			fdialog = wx.FileDialog( self, "書き出すファイル名を決めてください", defaultDir = save_dir, defaultFile = default_save_name + extension, style = wx.FD_SAVE, wildcard = export_format.upper() + " files (*" + extension + ")|*" + extension )
+			if fdialog.ShowModal() == wx.ID_OK:
+				output_path = os.path.join( fdialog.GetDirectory(), fdialog.GetFilename() )
+				if not output_path.lower().endswith( extension ):
+					output_path += extension
+			fdialog.Destroy()
+
+			#すでにあるファイルを飛ばす設定なら、書き出さない
+			if output_path != "" and os.path.isfile( output_path ) and self.software_setting[ "export-skip-existing" ] is True:
+				self.stop_message_dialog( "「" + os.path.basename( output_path ) + "」はすでにあるので、書き出しませんでした。\n\n上書きする場合は、設定タブの「すでにあるファイルは書き出さずに飛ばす」を外してください。" )
+				return
+
+		if output_path == "":
+			return
+
+		self.print_button.SetLabel( "書き出しを中止" )
+		self.resume_print_button.Disable()
+		self.export_button.Disable()
+		self.thread = threading.Thread( target = self.atena_export, args = ( None, export_format, output_path ), daemon=True )
+		self.thread.start()
+
+
+	#宛名の書き出し（印刷と同じく「宛先の取り出し → 宛名画像の作成 → 書き出し」の各段を並行に動かす）
+	#書き出す画像は印刷と同じ宛名画像生成インスタンスで作るので、印刷で送るものと同じになる
+	def atena_export( self, event, export_format, output_path ):
+		current_table = self.get_table_snapshot()
+		min_line, max_line = self.get_print_line_range( current_table )
+
+		print_generator = self.image_generator.derive( self.software_setting[ "print-resolution" ] )
+		print_metrics = PrintJobMetrics( total_rows = max_line - min_line + 1 )
+		render_stage = self.make_render_stage( print_generator, print_metrics )
+
+		try:
+			exporter = CardFileExporter( export_format, output_path, mm_pixel_rate = print_generator.mm_pixel_rate, skip_existing = self.software_setting[ "export-skip-existing" ], pdf_image_options = self.get_pdf_image_options() )
+		except Exception as e:
+			wx.CallAfter( self.restore_print_buttons )
+			wx.CallAfter( self.stop_message_dialog, "書き出しを始められませんでした: " + str( e ) )
+			return False
+
+		export_pipeline = PrintPipeline( source = self.iterate_print_records( current_table, min_line, max_line, print_metrics, skip_check = lambda line_number : exporter.is_existing( line_number, current_table[ line_number ][ self.column_etc_dictionary[ "column-name1" ] ] ) ), stages = [ render_stage, lambda images : self.export_stage( images, exporter, current_table ) ], queue_depth = 4, stop_check = lambda : self.print_stop_flag )
+
+		try:
+			export_completed = export_pipeline.run()
+			if export_completed is True:
+				exporter.close()
+			else:
+				exporter.abort()
+		except Exception as e:
+			exporter.abort()
+			wx.CallAfter( self.restore_print_buttons )
+			wx.CallAfter( self.SetStatusText, "書き出しでエラーが発生しました" )
+			wx.CallAfter( self.stop_message_dialog, "書き出しでエラーが発生しました: " + str( e ) )
+			self.print_stop_flag = False
+			return False
+
+		wx.CallAfter( self.restore_print_buttons )
+
+		if export_completed is False:
+			if export_format == "png":
+				stop_message = "書き出しを中止しました（" + str( exporter.written ) + "枚は書き出し済みです）"
+			else:
+				stop_message = "書き出しを中止しました（ファイルは作られていません）"
+			wx.CallAfter( self.SetStatusText, stop_message )
+			wx.CallAfter( self.stop_message_dialog, stop_message )
+			self.print_stop_flag = False
+			return False
+
+		export_message = str( exporter.written ) + "枚を「" + os.path.basename( output_path ) + "」に書き出しました"
+		if exporter.skipped > 0:
+			export_message += "（すでにあった" + str( exporter.skipped ) + "枚は飛ばしました）"
+		wx.CallAfter( self.statusbar.SetStatusText, export_message )
+
+
+	#書き出しの段：宛名画像を書き出す（PNGのファイル名に使う氏名は、表の宛名の列から取る）
+	def export_stage( self, images, exporter, current_table ):
+		for line_number, print_grayscale_image in images:
+			exporter.add( line_number, current_table[ line_number ][ self.column_etc_dictionary[ "column-name1" ] ], print_grayscale_image )
+
+			wx.CallAfter( self.statusbar.SetStatusText, str( line_number + 1 ) + "行目まで書き出しました（" + str( exporter.written ) + "枚）" )
+
+			yield line_number
+
+
+	#印刷範囲の入力欄から、処理上の（0から数える）開始行と終端行を決める
+	def get_print_line_range( self, current_table ):
 		min_line = self.print_start_line.GetValue() - 1 #GUI上の行番号は1,2,3...だが処理上の行は0,1,2...なので-1しておく
 		max_line = self.print_end_line.GetValue() - 1
 
@@ -3926,10 +5046,39 @@ class frame_plus( wx.Frame ):
 		if max_line >= len( current_table ):
 			max_line = len( current_table ) - 1
 
+		return ( min_line, max_line )
+
+
+	#印刷の2段目（宛名画像を作る段）を、並列に作るかどうかの設定にしたがって用意する
+	def make_render_stage( self, print_generator, print_metrics ):
+		#差出人の部分はどの行でも同じなので、下地画像として一度だけ描いておく
+		our_data_dict = { "our-postal-code" : self.our_data[ "our-postalcode-data" ], "our-name1" : self.our_data[ "our-name1-data" ], "our-name2" : self.our_data[ "our-name2-data" ], "our-address1" : self.our_data[ "our-address1-data" ], "our-address2" : self.our_data[ "our-address2-data" ] }
+
+		#宛名画像を別プロセスで並列に作る場合は、ワーカーがそれぞれ下地画像を描く
+		render_workers = self.software_setting[ "render-workers" ]
+		if render_workers > 0:
+			render_stage = lambda records : self.parallel_render_print_stage( records, print_generator, our_data_dict, render_workers, print_metrics )
+		else:
+			print_generator.prepare_job_template( our_data_dict )
+			render_stage = lambda records : self.render_print_stage( records, print_generator, print_metrics )
+
+		return render_stage
+
+
+	#印刷の1段目：住所表の印刷範囲の各行から、印刷する行の宛先を（行番号, 宛名データの辞書）として取り出す
+	#skip_checkがTrueを返す行（続きから印刷する場合の、プリンターに送り終わった行）は、宛名画像を作らずに飛ばす
+	def iterate_print_records( self, current_table, min_line, max_line, print_metrics, skip_check = None ):
 		for line_number in range( min_line, max_line + 1 ):
+			if skip_check is not None and skip_check( line_number ):
+				continue
+
+			extract_start = time.perf_counter()
+
 			#スレッド化した関数の中で直接GUI操作するとウィンドウが異常終了する場合があるので
 			#関数呼び出しをwx.CallAfterで包む
-			wx.CallAfter( self.statusbar.SetStatusText, str( line_number + 1 ) + "行目を処理中です" )
+			#（1枚目をプリンターに送った後は、送信の段が速さと残り時間を表示する）
+			if print_metrics.cards_done == 0:
+				wx.CallAfter( self.statusbar.SetStatusText, str( line_number + 1 ) + "行目を処理中です" )
 			current_line = current_table[ line_number ]
 			print_check = ""
 
@@ -3950,7 +5099,10 @@ class frame_plus( wx.Frame ):
 						wx.CallAfter( self.statusbar.SetStatusText, str( line_number + 1 ) + "行目は印刷しません（" + str( self.column_etc_dictionary[ "print-control-column" ] + 1 ) + "列目が「" + print_flag + "」）" )
 						print_check = "no"
 
-			if print_check != "no":
+			if print_check == "no":
+				print_metrics.row_skipped()
+
+			else:
 				print_data = ""
 
 				dest_postal_code = current_line[ self.column_etc_dictionary[ "column-postalcode" ] ]
@@ -3976,33 +5128,116 @@ class frame_plus( wx.Frame ):
 
 				print_data = { "postal-code" : dest_postal_code, "name1" : dest_name1, "name2" : dest_name2, "address1" : dest_address1, "address2" : dest_address2, "company" : dest_company, "department" : dest_department, "honorific" : honorific, "our-postal-code" : self.our_data[ "our-postalcode-data" ], "our-name1" : self.our_data[ "our-name1-data" ], "our-name2" : self.our_data[ "our-name2-data" ], "our-address1" : self.our_data[ "our-address1-data" ], "our-address2" : self.our_data[ "our-address2-data" ] }
 
-				print_grayscale_image = self.image_generator.get_cutted_atena_image( data_dict = print_data, space_tblr_mm_list = self.column_etc_dictionary[ "printer-space-top,bottom,left,right" ], cutted_atena_image_upside_down = self.column_etc_dictionary[ "upside-down-print" ] )
-
-				try:
-					pil_printing( pil_image = print_grayscale_image, paper_size = print_size, upside_down = self.column_etc_dictionary[ "upside-down-print" ] )
-				except Exception as e:
-					# 印刷エラーが発生した場合、ダイアログで表示して処理を中止
-					error_message = str(e)
-					wx.CallAfter( self.print_button.SetLabel, "宛名印刷する" )
-					wx.CallAfter( self.SetStatusText, "印刷エラーが発生しました" )
-					wx.CallAfter( self.stop_message_dialog, error_message )
-					self.print_stop_flag = False
-					return False
+				print_metrics.record( "extract", time.perf_counter() - extract_start )
+				print_metrics.card_started( line_number )
 
-			#印刷中止用の変数がTrueなら、ステータスバーやダイアログで中止を表明して関数を終了する
-			if self.print_stop_flag is True:
-				wx.CallAfter( self.SetStatusText, str( line_number + 1 ) + "行目までで印刷を中止しました" )
-				#「印刷中止」にしていたボタンのラベルを元に戻しておく
-				wx.CallAfter( self.print_button.SetLabel, "宛名印刷する" )
-				wx.CallAfter( self.stop_message_dialog, str( line_number + 1 ) + "行目までで印刷を中止しました" )
+				yield ( line_number, print_data )
 
-				self.print_stop_flag = False
-				return False
 
-		#印刷終了後に、「中止ボタン」に変えていた印刷ボタンのラベルを元に戻しておく
-		wx.CallAfter( self.print_button.SetLabel, "宛名印刷する" )
-		#ステータスバーを空欄に戻す
-		wx.CallAfter( self.statusbar.SetStatusText, "" )
+	#印刷の2段目：宛名画像を作る
+	def render_print_stage( self, records, print_generator, print_metrics ):
+		for line_number, print_data in records:
+			render_start = time.perf_counter()
+
+			#上下反転印刷の回転は、PILイメージに変換する前の台紙のうちに済ませておく
+			print_grayscale_image = print_generator.get_cutted_atena_image( data_dict = print_data, space_tblr_mm_list = self.column_etc_dictionary[ "printer-space-top,bottom,left,right" ], cutted_atena_image_upside_down = self.column_etc_dictionary[ "upside-down-print" ], rotate_upside_down = self.column_etc_dictionary[ "upside-down-print" ] )
+			print_metrics.record( "render", time.perf_counter() - render_start )
+
+			yield ( line_number, print_grayscale_image )
+
+
+	#印刷の2段目（並列版）：宛名画像をワーカープロセスで数件ずつまとめて作り、行の順番どおりに返す
+	#ワーカーにはレイアウトの控えを起動時に一度だけ渡し、あとは宛名データだけを送る
+	def parallel_render_print_stage( self, records, print_generator, our_data_dict, worker_count, print_metrics, render_chunk_size = 4 ):
+		print_options = { "space-tblr-mm" : self.column_etc_dictionary[ "printer-space-top,bottom,left,right" ], "upside-down" : self.column_etc_dictionary[ "upside-down-print" ] }
+		#wx/GTKや印刷・プリンター情報のスレッドが動いているこのプロセスをforkすると、ワーカーが他のスレッドの持つロックで固まることがあるので、
+		#forkではなく（使えればforkserver、なければspawnで）新しいプロセスを起動する（ワーカーにはpickleできるレイアウトの控えしか渡さない）
+		if "forkserver" in multiprocessing.get_all_start_methods():
+			worker_context = multiprocessing.get_context( "forkserver" )
+		else:
+			worker_context = multiprocessing.get_context( "spawn" )
+		executor = concurrent.futures.ProcessPoolExecutor( max_workers = worker_count, mp_context = worker_context, initializer = init_render_worker, initargs = ( print_generator.get_layout_snapshot(), our_data_dict, print_options ) )
+
+		#ワーカーに出した塊の待ち行列（出した順番に受け取るので、行の順番は崩れない）
+		pending_futures = collections.deque()
+		record_chunk = []
+
+		try:
+			for record in records:
+				record_chunk.append( record )
+
+				if len( record_chunk ) >= render_chunk_size:
+					pending_futures.append( executor.submit( render_cards_in_worker, record_chunk ) )
+					record_chunk = []
+
+				#先頭の塊ができあがっていれば次の段に渡す。ワーカー数の2倍の塊がたまっていたら、先頭ができるまで待つ
+				while len( pending_futures ) > 0 and ( pending_futures[0].done() or len( pending_futures ) >= worker_count * 2 ):
+					for line_number, print_grayscale_image, render_seconds in pending_futures.popleft().result():
+						print_metrics.record( "render", render_seconds )
+						yield ( line_number, print_grayscale_image )
+
+			if len( record_chunk ) > 0:
+				pending_futures.append( executor.submit( render_cards_in_worker, record_chunk ) )
+
+			while len( pending_futures ) > 0:
+				for line_number, print_grayscale_image, render_seconds in pending_futures.popleft().result():
+					print_metrics.record( "render", render_seconds )
+					yield ( line_number, print_grayscale_image )
+
+		finally:
+			#中止された場合は、まだ始まっていない塊を取り消してワーカーを止める
+			executor.shutdown( wait = False, cancel_futures = True )
+
+
+	#印刷の3段目：宛名画像をchunk_size枚（0なら全部）ずつPDFにまとめて、（PDFに入れた行番号のリスト, PDFのデータ, ページ数）にする
+	#（pdf_image_optionsは宛名画像の埋め込み方。get_pdf_image_optionsを参照）
+	def encode_print_stage( self, images, print_size, mm_pixel_rate, chunk_size, print_metrics, pdf_image_options ):
+		pdf_maker = PdfPrintBatch( paper_size = print_size, mm_pixel_rate = mm_pixel_rate, **pdf_image_options )
+		line_numbers = []
+		encode_seconds = 0 #今のPDFに入れた分のページ追加にかかった時間の合計
+
+		for line_number, print_grayscale_image in images:
+			encode_start = time.perf_counter()
+			pdf_maker.add_page( print_grayscale_image )
+			encode_seconds += time.perf_counter() - encode_start
+			line_numbers.append( line_number )
+
+			if chunk_size > 0 and pdf_maker.pending_pages >= chunk_size:
+				encode_start = time.perf_counter()
+				pdf_data, page_count = pdf_maker.take_pdf()
+				print_metrics.record( "encode", encode_seconds + time.perf_counter() - encode_start, page_count )
+				yield ( line_numbers, pdf_data, page_count )
+				line_numbers = []
+				encode_seconds = 0
+
+		#最後に残った分
+		if pdf_maker.pending_pages > 0:
+			encode_start = time.perf_counter()
+			pdf_data, page_count = pdf_maker.take_pdf()
+			print_metrics.record( "encode", encode_seconds + time.perf_counter() - encode_start, page_count )
+			yield ( line_numbers, pdf_data, page_count )
+
+
+	#印刷の4段目：PDFをプリンターに送り、送り終わった行を印刷ジョブの記録に書く
+	#送るたびに、ステータスバーに速さと残り時間を出す
+	def spool_print_stage( self, pdf_chunks, print_size, spool_progress, print_journal, print_metrics, spool_backend ):
+		for line_numbers, pdf_data, page_count in pdf_chunks:
+			if page_count > 1:
+				print( str( page_count ) + "ページ分のPDFを印刷します（用紙サイズ設定: " + print_size + "）" )
+
+			spool_start = time.perf_counter()
+			job_id = spool_backend.submit( pdf_data, print_size, job_name = "Riosanatea " + str( line_numbers[0] + 1 ) + "-" + str( line_numbers[-1] + 1 ) + "行目" )
+			print_metrics.record( "spool", time.perf_counter() - spool_start, len( line_numbers ) )
+			print_metrics.cards_spooled( line_numbers )
+			print_metrics.record_spool_bytes( len( pdf_data ) )
+
+			spool_progress[ "last-line" ] = line_numbers[-1]
+			spool_progress[ "job-ids" ].append( job_id )
+			print_journal.mark_done( line_numbers )
+
+			wx.CallAfter( self.statusbar.SetStatusText, str( line_numbers[-1] + 1 ) + "行目まで送信（ジョブID: " + job_id + "）　" + print_metrics.status_text() )
+
+			yield line_numbers[-1]
 
 
 	#印刷を中止した場合にダイアログを表示する
@@ -4028,13 +5263,11 @@ class frame_plus( wx.Frame ):
 
 	#履歴の移動
 	def goto_history_point( self, event ):
-		self.history_dialog = HistoryDialog( self.current_history_position, len( self.table_history ) )
+		self.history_dialog = HistoryDialog( self.table_history.position, self.table_history.get_state_count() )
 
 		if self.history_dialog.ShowModal() == wx.ID_OK:
-			self.current_history_position = self.history_dialog.get_list_value()
-			self.set_table( self.table_history[ self.current_history_position ] )
-			self.set_grid_labels() #行数・列数が変化したかもしれないのでラベルを貼り直す
-			self.statusbar.SetStatusText( "履歴番号" + str( self.current_history_position ) + "（最新が0）にやり直しました" )
+			self.move_table_history( self.history_dialog.get_list_value() )
+			self.statusbar.SetStatusText( "履歴番号" + str( self.table_history.position ) + "（最新が0）にやり直しました" )
 
 		self.history_dialog.Destroy()
 
@@ -4057,7 +5290,7 @@ class frame_plus( wx.Frame ):
 
 
 		#次に、表の内容が控えと同一かチェックする
-		current_table = self.get_current_table_list()
+		current_table = self.get_table_snapshot()
 
 		if current_table != self.table_checkpoint:
 			question_dialog = wx.MessageDialog( parent = self, message = "現在の表の内容が変更されていますが保存されていません。\n\n表の内容を保存しますか？\nNoで保存せずに終了します。", caption = "表内容の変更に関する確認", style = wx.YES_NO | wx.ICON_QUESTION )
@@ -4119,24 +5352,23 @@ class frame_plus( wx.Frame ):
 	#Shift + Ctrl + Zで、履歴を進める
 	def key_ctrl_shift_z( self, event ):
 
-		if self.current_history_position == 0:
+		if self.table_history.position == 0:
 			self.statusbar.SetStatusText( "現在、履歴の最新位置（履歴番号0）にあるので、やり直しできません" )
 		else:
-			self.current_history_position -= 1
-			self.set_table( self.table_history[ self.current_history_position ] )
-			self.set_grid_labels() #行数・列数が変化したかもしれないのでラベルを貼り直す
-			self.statusbar.SetStatusText( "履歴番号" + str( self.current_history_position ) + "（最新が0）にやり直しました" )
+			self.move_table_history( self.table_history.position - 1 )
+			self.statusbar.SetStatusText( "履歴番号" + str( self.table_history.position ) + "（最新が0）にやり直しました" )
 
 	#ShiftのないCtrl + Zで、履歴を戻る
 	def key_ctrl_z( self, event ):
 
-		if self.current_history_position >= len( self.table_history ) - 1:
-			self.statusbar.SetStatusText( "現在、ストックの中で最古の履歴（履歴番号" + str( self.current_history_position ) + "）なので、これ以上戻れません" )
+		#履歴に積んでいない変更が残っていたら、先に積んでおく（それを戻せるように）
+		self.add_table_to_history( None )
+
+		if self.table_history.position >= self.table_history.get_state_count() - 1:
+			self.statusbar.SetStatusText( "現在、ストックの中で最古の履歴（履歴番号" + str( self.table_history.position ) + "）なので、これ以上戻れません" )
 		else:
-			self.current_history_position += 1
-			self.set_table( self.table_history[ self.current_history_position ] )
-			self.set_grid_labels() #行数・列数が変化したかもしれないのでラベルを貼り直す
-			self.statusbar.SetStatusText( "履歴番号" + str( self.current_history_position ) + "（最新が0）に戻しました" )
+			self.move_table_history( self.table_history.position + 1 )
+			self.statusbar.SetStatusText( "履歴番号" + str( self.table_history.position ) + "（最新が0）に戻しました" )
 
 	#キー操作の処理はここまで
 
@@ -4157,6 +5389,9 @@ class AtenaPreviewDialog( wx.Dialog ):
 		self.our_dict = copy.deepcopy( our_data ) #our_data辞書、つまり差出人の情報
 		self.image_generator = copy.deepcopy( image_generator_instance )
 		self.space_list = copy.copy( space_tblr_mm_list )
+
+		#差出人の部分はどの行でも同じなので、下地画像として一度だけ描いておく
+		self.image_generator.prepare_job_template( { "our-postal-code" : self.our_dict[ "our-postalcode-data" ], "our-name1" : self.our_dict[ "our-name1-data" ], "our-name2" : self.our_dict[ "our-name2-data" ], "our-address1" : self.our_dict[ "our-address1-data" ], "our-address2" : self.our_dict[ "our-address2-data" ] } )
 		self.cutted_atena_image_upside_down = cutted_atena_image_upside_down
 
 		self.min_line = min_line_int
@@ -4197,7 +5432,7 @@ class AtenaPreviewDialog( wx.Dialog ):
 		no_print_text = "この行は印刷しません"
 
 		no_print_image_pil = Image.new( "RGB", ( 300, 30 ), ( 255, 255, 255 ) )
-		fnt = ImageFont.truetype( self.image_generator.get_parts_data( "fontfile" ), 20, encoding="unic" )
+		fnt = get_truetype_font( self.image_generator.get_parts_data( "fontfile" ), 20 )
 		textimage_draw = ImageDraw.Draw( no_print_image_pil )
 		textimage_draw.text( ( 0, 0 ), no_print_text, font=fnt, fill="black" )
 
@@ -4379,21 +5614,13 @@ class PostalcodeSearchDialog( wx.Dialog ):
 	def __init__( self, csv_path ):
 		wx.Dialog.__init__( self, None, -1, "郵便番号検索", size = ( 900, 600 ) )
 
-		self.code_address_list = []
 		self.code_address_linelist = []
 
 		#公式の郵便番号CSVファイルがあるなら、郵便番号検索用に読み込む
+		#ファイル全体をリストにはせず、1行ずつ読みながら検索用の文字列だけを作っていく
+		#（途中で文字コードの判定が外れていたら、作りかけの分を捨てて次の候補の文字コードで読み直す）
 		if os.path.isfile( csv_path ):
-			self.code_address_list = csv_to_list( csv_path )
-
-			for i in range( len( self.code_address_list ) ):
-				hit_text =  "郵便番号：" + self.code_address_list[ i ][2] + "、地域名：" + self.code_address_list[ i ][6] + self.code_address_list[ i ][7]
-				if self.code_address_list[ i ][8] == "以下に掲載がない場合":
-					hit_text += "　（以下に掲載がない場合）"
-				else:
-					hit_text += self.code_address_list[ i ][8]
-
-				self.code_address_linelist.append( hit_text )
+			self.code_address_linelist = collect_csv_rows( csv_path, self.make_hit_text )[0]
 
 		#ここから、このダイアログのGUI部分
 		self.input_search_word = wx.TextCtrl( self, wx.ID_ANY, style=wx.TE_PROCESS_ENTER )
@@ -4426,6 +5653,16 @@ class PostalcodeSearchDialog( wx.Dialog ):
 		self.SetSizer( sizer )
 
 
+	#郵便番号CSVの1行から、検索用の文字列を作る
+	def make_hit_text( self, code_address ):
+		hit_text =  "郵便番号：" + code_address[2] + "、地域名：" + code_address[6] + code_address[7]
+		if code_address[8] == "以下に掲載がない場合":
+			hit_text += "　（以下に掲載がない場合）"
+		else:
+			hit_text += code_address[8]
+
+		return hit_text
+
 	def search_and_display( self, event ):
 		hit_lines = ""
 		hit = 0
@@ -7,88 +7,633 @@ CSV処理とファイル入出力ユーティリティモジュール
 
 import csv
 import codecs
+import sys
 import subprocess
-import tempfile
 import os
+import queue
+import threading
+import time
+import zlib
+import json
+import hashlib
+import re
+import select
+import struct
+import getpass
+import http.client
+import urllib.parse
+import collections
+import concurrent.futures
 from io import BytesIO
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfdoc
+from PIL import Image, TiffImagePlugin, features
+from image_utils import greyscale_to_bilevel
 
 
-def csv_to_list(csv_path):
-    """何種類かの文字コードに対応させた、CSV読み込みリスト化関数"""
-    code_list = ["euc_jp", "shift_jis", "cp932", "iso2022_jp", "utf-8"]
-    csv_code = ""
-    csv_description_list = []
-    temporary_lines = ""
+# CSVの文字コード候補（先に読めたものを採用するので、順番に意味がある）
+CSV_ENCODING_CANDIDATES = ("euc_jp", "shift_jis", "cp932", "iso2022_jp", "utf-8")
+# 文字コード判定のために先頭から読むバイト数
+CSV_ENCODING_SAMPLE_SIZE = 64 * 1024
+# BOMから文字コードを決められる場合の対応表
+CSV_ENCODING_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+def detect_csv_encoding(csv_path, sample_size=CSV_ENCODING_SAMPLE_SIZE):
+    """
+    CSVファイルの文字コードを判定する
+    
+    BOMがあればそれに従い、なければ先頭のサンプルだけを候補の文字コードで順に試して、
+    最初に読めたものを返す。どの候補でも読めなければNoneを返す
+    """
+    with open(csv_path, "rb") as f:
+        sample = f.read(sample_size)
+        reached_end = f.read(1) == b""
+    
+    for bom, encoding in CSV_ENCODING_BOMS:
+        if sample.startswith(bom):
+            return encoding
+    
+    for code in CSV_ENCODING_CANDIDATES:
+        # サンプルの末尾で多バイト文字が切れていることがあるので、
+        # ファイルの途中までしか読んでいない時は末尾の読み残しを許す
+        decoder = codecs.getincrementaldecoder(code)()
+        try:
+            decoder.decode(sample, final=reached_end)
+        except UnicodeDecodeError:
+            continue
+        return code
+    
+    return None
+
+
+def iter_csv_rows(csv_path, encoding=None):
+    """
+    CSVファイルを1行ずつ読み込んで、（行番号, 行）を順に返すジェネレータ
+    
+    行番号は1始まりで、表に読み込んだ時の行番号と同じになる。
+    ファイル全体をリストにしないので、先頭の行からすぐに処理を始められ、メモリも増えない。
+    文字コードを指定しなければ detect_csv_encoding() で判定する
+    （判定は先頭のサンプルだけなので、途中でUnicodeDecodeErrorになることがある。読み直しが必要なら collect_csv_rows() を使う）
+    """
+    if encoding is None:
+        encoding = detect_csv_encoding(csv_path)
+        if encoding is None:
+            raise UnicodeError(f"CSVファイルの文字コードを判定できませんでした: {csv_path}")
+    
+    with open(csv_path, "r", encoding=encoding) as f:
+        for line_number, row in enumerate(csv.reader(f, quotechar='"'), 1):
+            yield line_number, row
+
+
+def read_csv_file(csv_path):
+    """
+    CSVファイルを読み込んで、（行のリスト, 判定した文字コード）を返す
+    
+    ファイルは判定した文字コードで一度だけ読んで解析する。
+    サンプルより後ろで読めない文字が出てきた場合は、残りの候補で読み直す
+    """
+    return collect_csv_rows(csv_path, lambda row: row)
+
+
+def collect_csv_rows(csv_path, convert_row):
+    """
+    CSVファイルを1行ずつ読みながら、各行をconvert_rowで変換した値のリストを作り、（リスト, 判定した文字コード）を返す
+    
+    行のリストそのものは持たないので、必要な部分だけを残せば大きなファイルでもメモリが増えない。
+    サンプルより後ろで読めない文字が出てきた場合は、それまでに作った分を捨てて、残りの候補で読み直す
+    """
+    encoding = detect_csv_encoding(csv_path)
+    if encoding in CSV_ENCODING_CANDIDATES:
+        code_list = CSV_ENCODING_CANDIDATES[CSV_ENCODING_CANDIDATES.index(encoding):]
+    elif encoding is not None:
+        code_list = (encoding,)
+    else:
+        code_list = ()
     
-    # まず、ファイルの文字コードを調べる
     for code in code_list:
         try:
-            # Python3以降だと、2までと違って読み込みの段階で弾かれるようなので、読み込みをtryにかける
-            f1 = codecs.open(csv_path, "r", code)
-            for line in f1:
-                temporary_lines += line
-        except:
+            return [convert_row(row) for line_number, row in iter_csv_rows(csv_path, code)], code
+        except UnicodeDecodeError:
             continue
+    
+    raise UnicodeError(f"CSVファイルの文字コードを判定できませんでした: {csv_path}")
+
+
+def csv_to_list(csv_path):
+    """何種類かの文字コードに対応させた、CSV読み込みリスト化関数"""
+    return read_csv_file(csv_path)[0]
+
+
+class AddressTableSnapshot:
+    """
+    ある時点の住所表の内容（変更できない写し）
+    
+    列ごとのリストをモデルと共有するので、作るのにセルのコピーはいらない。
+    行番号で引くと、その行の値のリストを返すので、リストのリストと同じように読める
+    """
+    
+    __slots__ = ("columns", "row_count", "version")
+    
+    def __init__(self, columns, row_count, version):
+        self.columns = tuple(columns)
+        self.row_count = row_count
+        self.version = version
+    
+    def get_row_count(self):
+        return self.row_count
+    
+    def get_column_count(self):
+        return len(self.columns)
+    
+    def get_value(self, row, column):
+        return self.columns[column][row]
+    
+    def get_row(self, row):
+        return [column[row] for column in self.columns]
+    
+    def __len__(self):
+        return self.row_count
+    
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.row_count
+        if not 0 <= row < self.row_count:
+            raise IndexError("住所表の行番号が範囲外です")
+        return self.get_row(row)
+    
+    def __iter__(self):
+        return (list(row) for row in zip(*self.columns)) if self.columns else ([] for i in range(self.row_count))
+    
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, AddressTableSnapshot):
+            return self.row_count == other.row_count and self.columns == other.columns
+        if isinstance(other, list):
+            return self.to_list() == other
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def to_list(self):
+        """内容を、行ごとのリストのリストとしてコピーして返す"""
+        return list(self)
+
+
+class AddressTableModel:
+    """
+    住所表の内容を持つモデル（wxに依存しない）
+    
+    列ごとのリストに、sys.intern()した文字列を入れて持つ（都道府県名や敬称、空欄などの
+    同じ文字列は1つのオブジェクトを共有する）。行・列のどちらからでもO(1)でセルを引ける。
+    行ごとの項目数が不揃いなCSVでも、最大の列数に合わせて空白で埋めた長方形の表として持つ。
+    
+    内容を変えるたびにversionが増える。snapshot()は列のリストをそのまま共有した写しを返し、
+    共有中の列は次に書き換えるときにだけコピーする（コピーオンライト）。
+    owned_columnsは列ごとに、このモデルだけが持っている（そのまま書き換えてよい）かどうかの目印
+    
+    変更のたびに、元に戻すための差分（パッチ）をpatch_logに記録する（recordingがFalseの間は記録しない）。
+    パッチは次のタプルで、apply_patch()で進めたり戻したりできる
+      ("cell", 行, 列, 変更前の値, 変更後の値)
+      ("insert-rows", 位置, 行数, None) / ("delete-rows", 位置, 行数, 消した行の列ごとの値)
+      ("insert-columns", 位置, 列数, None) / ("delete-columns", 位置, 列数, 消した列)
+    """
+    
+    def __init__(self, rows=None):
+        rows = rows if rows is not None else []
+        column_count = max((len(row) for row in rows), default=0)
+        self.row_count = len(rows)
+        self.columns = [
+            [sys.intern(row[column]) if column < len(row) else "" for row in rows]
+            for column in range(column_count)
+        ]
+        self.owned_columns = [True] * column_count
+        self.version = 0
+        self._snapshot = None
+        self.patch_log = []
+        self.recording = True
+    
+    @classmethod
+    def blank(cls, row_count, column_count):
+        """空白のセルだけの表を作る"""
+        model = cls()
+        model.row_count = row_count
+        model.columns = [[""] * row_count for i in range(column_count)]
+        model.owned_columns = [True] * column_count
+        return model
+    
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """写しから表を作る（列のリストは書き換えるまで写しと共有する）"""
+        model = cls()
+        model.row_count = snapshot.row_count
+        model.columns = list(snapshot.columns)
+        model.owned_columns = [False] * len(model.columns)
+        model._snapshot = snapshot
+        model.version = snapshot.version
+        return model
+    
+    def get_row_count(self):
+        return self.row_count
+    
+    def get_column_count(self):
+        return len(self.columns)
+    
+    def get_value(self, row, column):
+        return self.columns[column][row]
+    
+    def _writable_column(self, column):
+        """書き換える列を返す。写しと共有している列なら、先にコピーする"""
+        if not self.owned_columns[column]:
+            self.columns[column] = list(self.columns[column])
+            self.owned_columns[column] = True
+        return self.columns[column]
+    
+    def _changed(self):
+        self.version += 1
+        self._snapshot = None
+    
+    def set_value(self, row, column, value):
+        old_value = self.columns[column][row]
+        if old_value == value:
+            return
+        value = sys.intern(value)
+        self._writable_column(column)[row] = value
+        self._changed()
+        self._log(("cell", row, column, old_value, value))
+    
+    def append_rows(self, row_count):
+        self.insert_rows(self.row_count, row_count)
+    
+    def insert_rows(self, position, row_count):
+        position = min(position, self.row_count)
+        if row_count <= 0:
+            return
+        self._insert_rows(position, row_count, None)
+        self._log(("insert-rows", position, row_count, None))
+    
+    def delete_rows(self, position, row_count):
+        row_count = len(range(self.row_count)[position:position + row_count])
+        if row_count <= 0:
+            return
+        removed_values = self._delete_rows(position, row_count)
+        self._log(("delete-rows", position, row_count, removed_values))
+    
+    def append_columns(self, column_count):
+        self.insert_columns(len(self.columns), column_count)
+    
+    def insert_columns(self, position, column_count):
+        position = min(position, len(self.columns))
+        if column_count <= 0:
+            return
+        self._insert_columns(position, column_count, None)
+        self._log(("insert-columns", position, column_count, None))
+    
+    def delete_columns(self, position, column_count):
+        column_count = len(range(len(self.columns))[position:position + column_count])
+        if column_count <= 0:
+            return
+        removed_columns = self._delete_columns(position, column_count)
+        self._log(("delete-columns", position, column_count, removed_columns))
+    
+    def _insert_rows(self, position, row_count, column_values):
+        """行を挿入する（column_valuesが列ごとの値のリストなら、それを入れる。なければ空白）"""
+        for column in range(len(self.columns)):
+            if column_values is not None and column < len(column_values):
+                values = column_values[column]
+            else:
+                values = [""] * row_count
+            self._writable_column(column)[position:position] = values
+        self.row_count += row_count
+        self._changed()
+    
+    def _delete_rows(self, position, row_count):
+        """行を削除して、消した行の値を列ごとのリストにして返す"""
+        removed_values = []
+        for column in range(len(self.columns)):
+            values = self._writable_column(column)
+            removed_values.append(values[position:position + row_count])
+            del values[position:position + row_count]
+        self.row_count -= row_count
+        self._changed()
+        return removed_values
+    
+    def _insert_columns(self, position, column_count, columns):
+        """列を挿入する（columnsが列のリストなら、それを書き換えるまで共有して入れる。なければ空白）"""
+        if columns is None:
+            self.columns[position:position] = [[""] * self.row_count for i in range(column_count)]
+            self.owned_columns[position:position] = [True] * column_count
+        else:
+            self.columns[position:position] = columns
+            self.owned_columns[position:position] = [False] * column_count
+        self._changed()
+    
+    def _delete_columns(self, position, column_count):
+        """列を削除して、消した列を返す"""
+        removed_columns = self.columns[position:position + column_count]
+        del self.columns[position:position + column_count]
+        del self.owned_columns[position:position + column_count]
+        self._changed()
+        return removed_columns
+    
+    def _log(self, patch):
+        if self.recording:
+            self.patch_log.append(patch)
+    
+    def take_patches(self):
+        """記録したパッチを取り出す（取り出した分は記録から消える）"""
+        patches = self.patch_log
+        self.patch_log = []
+        return patches
+    
+    def apply_patch(self, patch, undo=False):
+        """
+        パッチを進める（undoなら戻す）。パッチは記録しない
         
-        csv_code = code
-        break
+        実際に行った操作を（操作の種類, 位置, 数）で返す。セルの変更は（"cell", 行, 列）になる
+        """
+        kind = patch[0]
+        if kind == "cell":
+            row, column, old_value, new_value = patch[1:]
+            self._writable_column(column)[row] = old_value if undo else new_value
+            self._changed()
+            return ("cell", row, column)
+        
+        position, count, values = patch[1:]
+        if kind in ("insert-rows", "delete-rows"):
+            if (kind == "insert-rows") != undo:
+                self._insert_rows(position, count, values)
+                return ("insert-rows", position, count)
+            self._delete_rows(position, count)
+            return ("delete-rows", position, count)
+        
+        if (kind == "insert-columns") != undo:
+            self._insert_columns(position, count, values)
+            return ("insert-columns", position, count)
+        self._delete_columns(position, count)
+        return ("delete-columns", position, count)
     
-    # 調べた文字コードを元に、読み込んでリスト化していく
-    f2 = open(csv_path, "r", encoding=csv_code)
-    reader = csv.reader(f2, quotechar='"')
+    def snapshot(self):
+        """今の内容の写しを返す。前の写しから変わっていなければ、同じ写しを返す"""
+        if self._snapshot is None:
+            self._snapshot = AddressTableSnapshot(self.columns, self.row_count, self.version)
+            self.owned_columns = [False] * len(self.columns)
+        return self._snapshot
     
-    # readerはイテレータで内容を直接表さないのでリストに格納しなおす
-    for row in reader:
-        csv_description_list.append(row)
+    def to_list(self):
+        """表の内容を、行ごとのリストのリストとしてコピーして返す"""
+        return self.snapshot().to_list()
     
-    f2.close()
-    return csv_description_list
+    def sample_row_indices(self, sample_size):
+        """
+        列幅などを見積もるために調べる行番号を選ぶ
+        
+        先頭の行を多めに取り、残りは表全体から等間隔に拾う。
+        行数がサンプル数以下なら全行を返す
+        """
+        row_count = self.row_count
+        if row_count <= sample_size:
+            return list(range(row_count))
+        
+        head_count = sample_size // 2
+        spread_count = sample_size - head_count
+        step = (row_count - head_count) / spread_count
+        return list(range(head_count)) + [head_count + int(i * step) for i in range(spread_count)]
 
 
-def pil_printing(pil_image, paper_size="", upside_down=False):
+class AddressTableHistory:
+    """
+    住所表の変更履歴（アンドゥ・リドゥ用）
+    
+    表を丸ごと写すのではなく、1回の操作ごとに、AddressTableModelが記録したパッチの一覧を積む。
+    積んだパッチの大きさの見積もりがmemory_budget（バイト）を超えたら、古い操作から捨てる
+    （最新の1回分は、大きくても残す）。
+    positionは、アンドゥで戻っている操作の数（0が最新の状態）
     """
-    画像をPDFに変換してlpに渡して印刷する
+    
+    # パッチ1つあたりの、値以外の分の大きさの見積もり（タプルやリストの分）
+    PATCH_OVERHEAD_BYTES = 128
+    
+    def __init__(self, memory_budget=64 * 1024 * 1024):
+        self.memory_budget = memory_budget
+        self.clear()
+    
+    def clear(self):
+        """履歴をすべて捨てる（ファイルを開いた時など）"""
+        self.steps = []
+        self.step_bytes = []
+        self.total_bytes = 0
+        self.position = 0
+    
+    def get_state_count(self):
+        """辿れる表の状態の数（最新の状態を含む）"""
+        return len(self.steps) + 1
+    
+    def set_memory_budget(self, memory_budget):
+        self.memory_budget = memory_budget
+        self._trim()
+    
+    @classmethod
+    def estimate_patch_bytes(cls, patch):
+        """
+        パッチの大きさを見積もる
+        
+        値の文字列は表と共有していることが多いが、多めに見積もるために別々に数える
+        """
+        size = cls.PATCH_OVERHEAD_BYTES
+        if patch[0] == "cell":
+            return size + sys.getsizeof(patch[3]) + sys.getsizeof(patch[4])
+        if patch[3] is not None:
+            for values in patch[3]:
+                size += sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values if value)
+        return size
+    
+    def record(self, patches):
+        """1回の操作のパッチを積む。パッチがなければ何もせずにFalseを返す"""
+        if not patches:
+            return False
+        
+        # アンドゥで戻っている途中なら、戻した分（リドゥできる分）の履歴は捨てる
+        if self.position > 0:
+            del self.steps[-self.position:]
+            del self.step_bytes[-self.position:]
+            self.total_bytes = sum(self.step_bytes)
+            self.position = 0
+        
+        self.steps.append(list(patches))
+        self.step_bytes.append(sum(self.estimate_patch_bytes(patch) for patch in patches))
+        self.total_bytes += self.step_bytes[-1]
+        self._trim()
+        return True
+    
+    def _trim(self):
+        # 捨てられるのは、今の状態に適用済みの（アンドゥできる）古い操作だけ
+        while len(self.steps) > 1 and self.position < len(self.steps) and self.total_bytes > self.memory_budget:
+            self.steps.pop(0)
+            self.total_bytes -= self.step_bytes.pop(0)
+    
+    def undo(self):
+        """1回分戻すためのパッチの一覧を返す（逆順に、戻す向きで適用する）。戻れなければNone"""
+        if self.position >= len(self.steps):
+            return None
+        self.position += 1
+        return self.steps[len(self.steps) - self.position]
+    
+    def redo(self):
+        """1回分進めるためのパッチの一覧を返す（順に、進める向きで適用する）。進めなければNone"""
+        if self.position <= 0:
+            return None
+        patches = self.steps[len(self.steps) - self.position]
+        self.position -= 1
+        return patches
+
+
+def pil_printing(pil_image, paper_size="", upside_down=False, mm_pixel_rate=8, image_encoding="grey", bilevel_threshold=128, bilevel_dither=False, spool_backend=None):
+    """
+    画像をPDFに変換してプリンタに送って印刷し、ジョブIDを返す
     Ubuntu 22.04 / 24.04 対応
     
     PDFを使用することで、用紙サイズと画像サイズを正確に制御し、
     プリンタドライバによる自動スケーリングを防ぐ
     
-    画像は8pixel/mmで生成されているため、画像サイズから用紙サイズを自動計算
+    画像はmm_pixel_rate（pixel/mm、標準は8）で生成されているものとして、画像サイズから用紙サイズを自動計算
+    PDFへの画像の埋め込み方はimage_encoding（PDF_IMAGE_ENCODINGSのどれか。draw_card_imageを参照）
+    送り方はspool_backend（SpoolBackend。省略した場合はlpで送る。closeは呼び出し側で行う）
     """
     
     # 上下反転印刷モードであれば。宛名の画像を180°回転させる
     if upside_down is True:
         pil_image = pil_image.rotate(180)
     
-    # 画像サイズから用紙サイズを計算（8 pixel/mm）
+    # 画像サイズから用紙サイズを計算（mm_pixel_rate pixel/mm）
     img_width_px, img_height_px = pil_image.size
-    paper_width_mm = img_width_px / 8
-    paper_height_mm = img_height_px / 8
+    paper_width_mm = img_width_px / mm_pixel_rate
+    paper_height_mm = img_height_px / mm_pixel_rate
     
     print(f"画像サイズ: {img_width_px}x{img_height_px} pixel")
     print(f"用紙サイズ: {paper_width_mm:.1f}x{paper_height_mm:.1f} mm")
     
-    # 画像を一時ファイルに保存
-    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_img:
-        img_path = tmp_img.name
-        pil_image.save(img_path, format='PNG')
+    # 一時ファイルは使わずに、メモリ上でPDFを作成
+    pdf_buffer = BytesIO()
     
-    # 一時ファイルにPDFを作成
-    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_pdf:
-        pdf_path = tmp_pdf.name
-        
-        # 実際の用紙サイズでPDFを作成
-        pdf_canvas = canvas.Canvas(pdf_path, pagesize=(paper_width_mm*mm, paper_height_mm*mm))
+    # 実際の用紙サイズでPDFを作成
+    # （invariantで作成日時や文書IDを固定し、同じ画像からは常に同じPDFができるようにする。ファイルへの書き出しと比較できる）
+    pdf_canvas = canvas.Canvas(pdf_buffer, pagesize=(paper_width_mm*mm, paper_height_mm*mm), invariant=1)
+    
+    # PDFに画像を配置（用紙サイズぴったりに）
+    # 座標は左下が原点、画像は用紙全体に配置
+    draw_card_image(pdf_canvas, pil_image, paper_width_mm*mm, paper_height_mm*mm, image_encoding, bilevel_threshold, bilevel_dither)
+    pdf_canvas.save()
+    
+    # 用紙サイズの指定がなければ、画像サイズに基づいてプリンタがサポートする最適なサイズを検出
+    if paper_size == "":
+        paper_size = printer_capabilities.get_media_name(paper_width_mm, paper_height_mm)
+    
+    print(f"使用する用紙サイズ設定: {paper_size}")
+    
+    if spool_backend is None:
+        spool_backend = LpSubprocessBackend()
+    
+    return spool_backend.submit(pdf_buffer.getvalue(), paper_size)
+
+
+PDF_IMAGE_ENCODINGS = ("grey", "g4", "flate1")
+
+
+class BilevelImageXObject(pdfdoc.PDFImageXObject):
+    """
+    白黒2値の画像を、圧縮済みのデータのまま埋め込むPDFの画像オブジェクト
+    （reportlabのPDFImageXObjectは8bitの画像しか作らず、CCITTFaxDecodeのパラメータも書けないので、その部分だけ自前で書く）
+    """
+    
+    def __init__(self, name, stream_content, width, height, filter_name, decode_parms=None):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.bitsPerComponent = 1
+        self.colorSpace = "DeviceGray"
+        self.streamContent = stream_content
+        self._filters = (filter_name,)
+        self.decode_parms = decode_parms
+        self.mask = None
+    
+    def format(self, document):
+        pdf_stream = pdfdoc.PDFStream(content=self.streamContent)
+        stream_dict = pdf_stream.dictionary
+        stream_dict["Type"] = pdfdoc.PDFName("XObject")
+        stream_dict["Subtype"] = pdfdoc.PDFName("Image")
+        stream_dict["Width"] = self.width
+        stream_dict["Height"] = self.height
+        stream_dict["BitsPerComponent"] = self.bitsPerComponent
+        stream_dict["ColorSpace"] = pdfdoc.PDFName(self.colorSpace)
+        stream_dict["Filter"] = pdfdoc.PDFArray([pdfdoc.PDFName(x) for x in self._filters])
+        if self.decode_parms is not None:
+            stream_dict["DecodeParms"] = pdfdoc.PDFArray([pdfdoc.PDFDictionary(self.decode_parms)])
+        stream_dict["Length"] = len(self.streamContent)
+        return pdf_stream.format(document)
+
+
+def encode_bilevel_image(bilevel_image, image_encoding):
+    """
+    白黒2値の画像を (圧縮したデータ, フィルタ名, DecodeParmsの辞書かNone) にする
+    g4はCCITT Group 4（libtiffが必要。なければflate1にする）、flate1は1ピクセル1bitをFlateで圧縮する
+    """
+    width, height = bilevel_image.size
+    
+    if image_encoding == "g4" and features.check("libtiff"):
+        # 1つのストリップにまとめたG4のTIFFを作り、そのストリップのデータだけを取り出す
+        tiff_buffer = BytesIO()
+        bilevel_image.save(tiff_buffer, "TIFF", compression="group4", strip_size=((width + 7) // 8) * height)
+        tiff_image = Image.open(BytesIO(tiff_buffer.getvalue()))
+        strip_offset = tiff_image.tag_v2[273][0]  # StripOffsets
+        strip_length = tiff_image.tag_v2[279][0]  # StripByteCounts
+        g4_data = tiff_buffer.getvalue()[strip_offset:strip_offset + strip_length]
         
-        # PDFに画像を配置（用紙サイズぴったりに）
-        # 座標は左下が原点、画像は用紙全体に配置
-        pdf_canvas.drawImage(img_path, 0, 0, width=paper_width_mm*mm, height=paper_height_mm*mm, 
-                            preserveAspectRatio=False)
-        pdf_canvas.save()
+        # PILの"1"は白が1なので、G4では黒の連なりとして符号化されたものが白になる
+        return g4_data, "CCITTFaxDecode", {"K": -1, "Columns": width, "Rows": height, "BlackIs1": pdfdoc.PDFtrue}
+    
+    # PILの"1"のバイト列（1行ごとにバイト境界まで詰める。白が1）は、PDFの1bitのDeviceGrayとそのまま同じ並び
+    return zlib.compress(bilevel_image.tobytes(), 9), "FlateDecode", None
+
+
+def draw_card_image(pdf_canvas, pil_image, width, height, image_encoding="grey", bilevel_threshold=128, bilevel_dither=False):
+    """
+    宛名画像をPDFのページの左下から width x height（ポイント）に敷き詰めて描く
+    image_encodingが"grey"ならreportlabの標準どおり8bitグレーのFlate、
+    "g4"と"flate1"は白黒2値にしてから埋め込む（文字と枠だけの宛名なら、PDFがずっと小さくなる）
+    2値にするときの明るさの境目はbilevel_threshold（0〜255）、bilevel_ditherがTrueなら誤差拡散にする
+    """
+    if image_encoding not in ("g4", "flate1"):
+        pdf_canvas.drawImage(ImageReader(pil_image), 0, 0, width=width, height=height, preserveAspectRatio=False)
+        return
+    
+    stream_content, filter_name, decode_parms = encode_bilevel_image(greyscale_to_bilevel(pil_image, bilevel_threshold, bilevel_dither), image_encoding)
     
-    # デフォルトプリンタの確認
+    # 同じ画像は1つのPDFの中で使い回す（canvas.drawImageと同じ登録の仕方）
+    image_name = "bilevel" + hashlib.md5(stream_content).hexdigest()
+    registered_name = pdf_canvas._doc.getXObjectName(image_name)
+    if pdf_canvas._doc.idToObject.get(registered_name, None) is None:
+        image_object = BilevelImageXObject(image_name, stream_content, pil_image.size[0], pil_image.size[1], filter_name, decode_parms)
+        pdf_canvas._setXObjects(image_object)
+        pdf_canvas._doc.Reference(image_object, registered_name)
+        pdf_canvas._doc.addForm(image_name, image_object)
+    
+    pdf_canvas.saveState()
+    pdf_canvas.scale(width, height)
+    pdf_canvas._code.append(f"/{registered_name} Do")
+    pdf_canvas.restoreState()
+    pdf_canvas._formsinuse.append(image_name)
+
+
+def find_default_printer():
+    """lpstat -d でデフォルトプリンタ名を調べる（設定されていなければNone）"""
     default_printer = None
     try:
         result = subprocess.run(['lpstat', '-d'], capture_output=True, text=True, timeout=5)
@@ -100,121 +645,1060 @@ def pil_printing(pil_image, paper_size="", upside_down=False):
     except Exception as e:
         print(f"デフォルトプリンタの確認エラー: {e}")
     
-    # 用紙サイズの指定がなければ、画像サイズに基づいてプリンタがサポートする最適なサイズを検出
-    if paper_size == "":
-        try:
-            subproc = subprocess.Popen(["lpoptions", "-l"], stdout=subprocess.PIPE)
-            lpoptions_stdout = [x.decode("utf-8") for x in subproc.stdout.readlines()]
-        except:
-            lpoptions_stdout = []
-        
-        # 画像サイズ（mm）を使って、プリンタがサポートする用紙サイズ名を検索
-        # サイズ指定形式のパターン: "100x148", "w283h420" (Canon), "a4", "postcard" など
-        width_int = int(round(paper_width_mm))
-        height_int = int(round(paper_height_mm))
-        
-        # 検索パターン（優先順位順）
-        search_patterns = [
-            f"{width_int}x{height_int}",  # 直接サイズ指定: "100x148"
-            f"w{width_int*283//100}h{height_int*420//148}",  # Canon形式（はがきの場合w283h420）
-        ]
-        
-        # 一般的な名称も追加（サイズに応じて）
-        if width_int == 100 and height_int == 148:
-            search_patterns.extend(["hagaki", "postcard"])
-        elif width_int == 105 and height_int == 148:
-            search_patterns.append("a6")
-        elif width_int == 148 and height_int == 210:
-            search_patterns.append("a5")
-        elif width_int == 210 and height_int == 297:
-            search_patterns.append("a4")
-        elif width_int == 297 and height_int == 420:
-            search_patterns.append("a3")
-        
-        print(f"用紙サイズ検索パターン: {search_patterns}")
-        
-        # プリンタがサポートする用紙サイズを検索
-        for pattern in search_patterns:
-            for line in lpoptions_stdout:
-                if line.startswith("PageSize") or line.startswith("media"):
-                    if pattern.lower() in line.lower():
-                        # 実際の用紙サイズ名を抽出
-                        for word in line.split():
-                            if pattern.lower() in word.lower() and not word.startswith("*"):
-                                paper_size = word
-                                break
-                        if paper_size:
+    return default_printer
+
+
+def find_first_printer():
+    """lpstat -p で利用可能なプリンタを調べ、最初のプリンタ名を返す（見つからなければNone）"""
+    try:
+        result = subprocess.run(['lpstat', '-p'], capture_output=True, text=True, timeout=5)
+    except subprocess.TimeoutExpired:
+        raise Exception("プリンタの検索がタイムアウトしました")
+    
+    if result.returncode == 0 and result.stdout.strip():
+        first_line = result.stdout.strip().split('\n')[0]
+        if first_line.startswith('printer '):
+            return first_line.split()[1]
+    
+    return None
+
+
+def read_lpoptions(printer_name=None):
+    """lpoptions -l の出力（プリンタのオプション一覧）を行のリストで返す"""
+    lpoptions_cmd = ["lpoptions"]
+    if printer_name:
+        lpoptions_cmd.extend(["-p", printer_name])
+    lpoptions_cmd.append("-l")
+    
+    try:
+        subproc = subprocess.Popen(lpoptions_cmd, stdout=subprocess.PIPE)
+        lpoptions_stdout = [x.decode("utf-8") for x in subproc.stdout.readlines()]
+    except:
+        lpoptions_stdout = []
+    
+    return lpoptions_stdout
+
+
+def find_media_name(paper_width_mm, paper_height_mm, lpoptions_stdout=None):
+    """用紙サイズ（mm）から、プリンタがサポートする用紙サイズ名を lpoptions -l の出力から検出する"""
+    paper_size = ""
+    
+    if lpoptions_stdout is None:
+        lpoptions_stdout = read_lpoptions()
+    
+    # 画像サイズ（mm）を使って、プリンタがサポートする用紙サイズ名を検索
+    # サイズ指定形式のパターン: "100x148", "w283h420" (Canon), "a4", "postcard" など
+    width_int = int(round(paper_width_mm))
+    height_int = int(round(paper_height_mm))
+    
+    # 検索パターン（優先順位順）
+    search_patterns = [
+        f"{width_int}x{height_int}",  # 直接サイズ指定: "100x148"
+        f"w{width_int*283//100}h{height_int*420//148}",  # Canon形式（はがきの場合w283h420）
+    ]
+    
+    # 一般的な名称も追加（サイズに応じて）
+    if width_int == 100 and height_int == 148:
+        search_patterns.extend(["hagaki", "postcard"])
+    elif width_int == 105 and height_int == 148:
+        search_patterns.append("a6")
+    elif width_int == 148 and height_int == 210:
+        search_patterns.append("a5")
+    elif width_int == 210 and height_int == 297:
+        search_patterns.append("a4")
+    elif width_int == 297 and height_int == 420:
+        search_patterns.append("a3")
+    
+    print(f"用紙サイズ検索パターン: {search_patterns}")
+    
+    # プリンタがサポートする用紙サイズを検索
+    for pattern in search_patterns:
+        for line in lpoptions_stdout:
+            if line.startswith("PageSize") or line.startswith("media"):
+                if pattern.lower() in line.lower():
+                    # 実際の用紙サイズ名を抽出
+                    for word in line.split():
+                        if pattern.lower() in word.lower() and not word.startswith("*"):
+                            paper_size = word
                             break
-            if paper_size:
+                    if paper_size:
+                        break
+        if paper_size:
+            break
+    
+    # 検出できない場合は、カスタムサイズまたは汎用デフォルト
+    if not paper_size:
+        # カスタムサイズを試す
+        custom_size = f"Custom.{width_int}x{height_int}mm"
+        for line in lpoptions_stdout:
+            if "Custom" in line or "custom" in line.lower():
+                paper_size = custom_size
+                print(f"カスタムサイズを使用: {custom_size}")
                 break
         
-        # 検出できない場合は、カスタムサイズまたは汎用デフォルト
+        # それでもダメなら汎用デフォルト（サイズに応じて）
         if not paper_size:
-            # カスタムサイズを試す
-            custom_size = f"Custom.{width_int}x{height_int}mm"
-            for line in lpoptions_stdout:
-                if "Custom" in line or "custom" in line.lower():
-                    paper_size = custom_size
-                    print(f"カスタムサイズを使用: {custom_size}")
-                    break
-            
-            # それでもダメなら汎用デフォルト（サイズに応じて）
-            if not paper_size:
-                if paper_width_mm <= 110 and paper_height_mm <= 160:
-                    paper_size = "Postcard"
-                elif paper_width_mm <= 160 and paper_height_mm <= 230:
-                    paper_size = "A5"
+            if paper_width_mm <= 110 and paper_height_mm <= 160:
+                paper_size = "Postcard"
+            elif paper_width_mm <= 160 and paper_height_mm <= 230:
+                paper_size = "A5"
+            else:
+                paper_size = "A4"
+            print(f"警告: 用紙サイズを検出できませんでした。{paper_size}を使用します")
+    
+    return paper_size
+
+
+class SpoolBackend:
+    """
+    PDFのデータをプリンタ（ないしその代わり）に送る方法の基底クラス
+    
+    submitはPDFのデータ（bytes）と用紙サイズ名を受け取って1つの印刷ジョブとして送り、ジョブIDの文字列を返す
+    送れなかった場合はExceptionを送出する（メッセージはそのままエラーダイアログに出す）
+    接続などを持ち回る場合は、印刷が終わった後でcloseを呼ぶ
+    """
+    
+    name = ""
+    
+    def submit(self, pdf_data, paper_size, job_name=""):
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+
+
+class LpSubprocessBackend(SpoolBackend):
+    """1ジョブごとにlpコマンドを起動して、標準入力にPDFを流し込む（これまでどおりの送り方）"""
+    
+    name = "lp"
+    
+    def submit(self, pdf_data, paper_size, job_name=""):
+        try:
+            # lpコマンドの構築 - ファイル名を指定しないので、lpは標準入力からPDFを読む
+            # PDFはページサイズが埋め込まれているため、fit-to-pageで正確に印刷できる
+            lp_cmd = ['lp', 
+                      '-o', 'fit-to-page',              # PDFのページサイズに合わせる
+                      '-o', 'media=' + paper_size]      # 用紙サイズ指定
+            
+            if job_name:
+                lp_cmd.extend(['-t', job_name])
+            
+            # 印刷先の確認（デフォルトプリンタが設定されていない場合は、最初のプリンタを-dで指定する）
+            destination = printer_capabilities.get_destination()
+            if destination["printer"] is None:
+                raise Exception("プリンタが見つかりません。システム設定でプリンタを追加してください。")
+            elif destination["is-default"] is False:
+                lp_cmd.extend(['-d', destination["printer"]])
+                print(f"デフォルトプリンタが設定されていないため、'{destination['printer']}' を使用します")
+            
+            # PDFを標準入力に流し込んで印刷
+            p = subprocess.Popen(lp_cmd, 
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate(input=pdf_data)
+            
+            if p.returncode != 0:
+                # プリンタの構成が変わったのかもしれないので、控えておいたプリンタの情報は捨てる
+                printer_capabilities.refresh()
+                
+                error_msg = stderr.decode("utf-8")
+                if "No default destination" in error_msg:
+                    raise Exception("デフォルトプリンタが設定されていません。\n以下のコマンドでプリンタを確認・設定してください:\n  lpstat -p  (利用可能なプリンタ一覧)\n  lpoptions -d プリンタ名  (デフォルトプリンタの設定)")
                 else:
-                    paper_size = "A4"
-                print(f"警告: 用紙サイズを検出できませんでした。{paper_size}を使用します")
+                    raise Exception(f"印刷エラー: {error_msg}")
+        except Exception as e:
+            raise Exception(f"印刷処理でエラーが発生しました: {str(e)}")
+        
+        # "request id is プリンタ名-123 (1 file(s))" の形式からジョブIDを取り出す
+        request_id = re.search(r"request id is (\S+)", stdout.decode("utf-8", "replace"))
+        return request_id.group(1) if request_id else ""
+
+
+class IppSpoolBackend(SpoolBackend):
+    """
+    CUPSにIPPで直接PDFを送る（lpを起動せず、1つのHTTP接続を印刷が終わるまで使い回す）
     
-    print(f"使用する用紙サイズ設定: {paper_size}")
+    Print-Jobの要求は自前で組み立てる。印刷先はprinter_capabilitiesで調べたプリンタ
+    使い回す前に、接続がCUPSの側で閉じられていないかを確かめて、閉じられていればつなぎ直す
+    要求を送っている途中で切れた場合だけ1回だけ送り直し、送り終えた後（応答待ち）の失敗では送り直さない
+    """
     
-    try:
-        # lpコマンドの構築 - PDFファイルを印刷
-        # PDFはページサイズが埋め込まれているため、fit-to-pageで正確に印刷できる
-        lp_cmd = ['lp', 
-                  '-o', 'fit-to-page',              # PDFのページサイズに合わせる
-                  '-o', 'media=' + paper_size,      # 用紙サイズ指定
-                  pdf_path]                         # PDFファイルパス
-        
-        # デフォルトプリンタが設定されていない場合、利用可能なプリンタを確認
-        if not default_printer:
+    name = "ipp"
+    
+    # IPPの値の種類（タグ）
+    _TAG_OPERATION = 0x01
+    _TAG_JOB = 0x02
+    _TAG_END = 0x03
+    _TAG_INTEGER = 0x21
+    _TAG_BOOLEAN = 0x22
+    _TAG_ENUM = 0x23
+    _TAG_TEXT = 0x41
+    _TAG_NAME = 0x42
+    _TAG_KEYWORD = 0x44
+    _TAG_URI = 0x45
+    _TAG_CHARSET = 0x47
+    _TAG_LANGUAGE = 0x48
+    _TAG_MIME = 0x49
+    
+    _OPERATION_PRINT_JOB = 0x0002
+    
+    def __init__(self, host="localhost", port=631, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        
+        self._connection = None
+        self._request_id = 0
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def _attribute(cls, value_tag, attribute_name, value):
+        """1つの属性を「タグ、名前の長さ、名前、値の長さ、値」のバイト列にする"""
+        if value_tag in (cls._TAG_INTEGER, cls._TAG_ENUM):
+            value_bytes = struct.pack(">i", value)
+        elif value_tag == cls._TAG_BOOLEAN:
+            value_bytes = b"\x01" if value else b"\x00"
+        else:
+            value_bytes = value.encode("utf-8")
+        
+        name_bytes = attribute_name.encode("utf-8")
+        return struct.pack(">bh", value_tag, len(name_bytes)) + name_bytes + struct.pack(">h", len(value_bytes)) + value_bytes
+    
+    def _print_job_request(self, printer_uri, paper_size, job_name):
+        self._request_id += 1
+        
+        request = struct.pack(">bbhi", 2, 0, self._OPERATION_PRINT_JOB, self._request_id)
+        request += bytes([self._TAG_OPERATION])
+        request += self._attribute(self._TAG_CHARSET, "attributes-charset", "utf-8")
+        request += self._attribute(self._TAG_LANGUAGE, "attributes-natural-language", "ja")
+        request += self._attribute(self._TAG_URI, "printer-uri", printer_uri)
+        request += self._attribute(self._TAG_NAME, "requesting-user-name", getpass.getuser())
+        request += self._attribute(self._TAG_NAME, "job-name", job_name or "Riosanatea")
+        request += self._attribute(self._TAG_MIME, "document-format", "application/pdf")
+        
+        # lpの -o fit-to-page -o media=... と同じ指定
+        request += bytes([self._TAG_JOB])
+        request += self._attribute(self._TAG_KEYWORD, "media", paper_size)
+        request += self._attribute(self._TAG_BOOLEAN, "fit-to-page", True)
+        request += bytes([self._TAG_END])
+        return request
+    
+    @classmethod
+    def _parse_response(cls, response_data):
+        """応答から (状態コード, {属性名: 値}) を取り出す（値は整数か文字列。同じ名前は最初の値だけ）"""
+        status_code = struct.unpack(">h", response_data[2:4])[0]
+        attributes = {}
+        position = 8
+        attribute_name = ""
+        
+        while position < len(response_data):
+            value_tag = response_data[position]
+            position += 1
+            if value_tag == cls._TAG_END:
+                break
+            if value_tag < 0x10:  # 属性グループの区切り
+                continue
+            
+            name_length = struct.unpack(">h", response_data[position:position + 2])[0]
+            position += 2
+            if name_length > 0:  # 名前がなければ、直前の属性の2つ目以降の値
+                attribute_name = response_data[position:position + name_length].decode("utf-8", "replace")
+            position += name_length
+            
+            value_length = struct.unpack(">h", response_data[position:position + 2])[0]
+            position += 2
+            value_bytes = response_data[position:position + value_length]
+            position += value_length
+            
+            if attribute_name in attributes:
+                continue
+            if value_tag in (cls._TAG_INTEGER, cls._TAG_ENUM) and value_length == 4:
+                attributes[attribute_name] = struct.unpack(">i", value_bytes)[0]
+            else:
+                attributes[attribute_name] = value_bytes.decode("utf-8", "replace")
+        
+        return status_code, attributes
+    
+    def _connection_is_stale(self):
+        """
+        使い回そうとしている接続が、もう使えないかどうか
+        
+        要求を送っていないのに読めるものがあるのは、CUPSが接続を閉じた（EOF）か余計なデータが届いている時なので、使わない
+        """
+        sock = self._connection.sock
+        if sock is None:
+            return True
+        
+        readable, writable, errored = select.select([sock], [], [], 0)
+        return len(readable) > 0
+    
+    def _send(self, printer_path, request_data):
+        if self._connection is None:
+            self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        
+        self._connection.request("POST", printer_path, body=request_data, headers={"Content-Type": "application/ipp"})
+    
+    def _receive(self):
+        response = self._connection.getresponse()
+        response_data = response.read()
+        
+        if response.status != 200:
+            raise Exception(f"CUPSがHTTP {response.status} {response.reason} を返しました")
+        return response_data
+    
+    def submit(self, pdf_data, paper_size, job_name=""):
+        try:
+            destination = printer_capabilities.get_destination()
+            if destination["printer"] is None:
+                raise Exception("プリンタが見つかりません。システム設定でプリンタを追加してください。")
+            
+            printer_path = "/printers/" + urllib.parse.quote(destination["printer"])
+            printer_uri = f"ipp://{self.host}:{self.port}{printer_path}"
+            
+            with self._lock:
+                request_data = self._print_job_request(printer_uri, paper_size, job_name) + pdf_data
+                
+                # 待っている間にCUPSの側で閉じられていた接続は、送る前に捨ててつなぎ直す
+                if self._connection is not None and self._connection_is_stale():
+                    self.close()
+                reused_connection = self._connection is not None
+                
+                try:
+                    try:
+                        self._send(printer_path, request_data)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # 使い回していた接続が、要求を送り終える前に切れた場合だけ、つなぎ直して1回だけ送り直す
+                        # （要求が最後まで届いていないので、CUPSはジョブを作っていない）
+                        self.close()
+                        if not reused_connection:
+                            raise
+                        self._send(printer_path, request_data)
+                    
+                    # 送り終えた後は、タイムアウトや応答の途中での切断でも、CUPSが受け取り済みかもしれないので送り直さない
+                    response_data = self._receive()
+                except Exception:
+                    self.close()
+                    raise
+            
+            status_code, attributes = self._parse_response(response_data)
+            
+            # 0x0000〜0x00ffが成功
+            if status_code > 0x00ff:
+                # プリンタの構成が変わったのかもしれないので、控えておいたプリンタの情報は捨てる
+                printer_capabilities.refresh()
+                raise Exception(f"印刷エラー: {attributes.get('status-message', '')}（IPPの状態コード 0x{status_code:04x}）")
+        except Exception as e:
+            raise Exception(f"印刷処理でエラーが発生しました: {str(e)}")
+        
+        return f"{destination['printer']}-{attributes.get('job-id', '')}"
+    
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class FileSpoolBackend(SpoolBackend):
+    """プリンタには送らず、PDFを連番のファイルとしてフォルダに書き出す（印刷せずに試す場合用）"""
+    
+    name = "file"
+    
+    def __init__(self, spool_directory):
+        self.spool_directory = spool_directory
+        self._job_number = 0
+        self._lock = threading.Lock()
+    
+    def submit(self, pdf_data, paper_size, job_name=""):
+        # 番号はロックの中で控えておき、ジョブIDとファイル名の両方にその控えを使う（別のスレッドが次の番号を取っても、同じファイル名にならない）
+        with self._lock:
+            self._job_number += 1
+            job_number = self._job_number
+        job_id = f"file-{job_number}"
+        
+        # ファイル名に使えない文字は用紙サイズ名から除いておく
+        safe_paper_size = re.sub(r"[^0-9A-Za-z._-]", "_", paper_size)
+        pdf_path = os.path.join(self.spool_directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{job_number:05d}-{safe_paper_size}.pdf")
+        
+        try:
+            os.makedirs(self.spool_directory, exist_ok=True)
+            with open(pdf_path, "wb") as f:
+                f.write(pdf_data)
+        except OSError as e:
+            raise Exception(f"印刷処理でエラーが発生しました: PDFファイルを書き込めませんでした: {e}")
+        
+        return job_id
+
+
+SPOOL_BACKEND_NAMES = ("lp", "ipp", "file")
+
+
+def make_spool_backend(backend_name="lp", spool_directory=""):
+    """設定の名前（SPOOL_BACKEND_NAMESのどれか）から送り方のインスタンスを作る。知らない名前ならlp"""
+    if backend_name == "ipp":
+        return IppSpoolBackend()
+    elif backend_name == "file":
+        return FileSpoolBackend(spool_directory)
+    else:
+        return LpSubprocessBackend()
+
+
+class PrinterCapabilityCache:
+    """
+    プリンタの情報（印刷先、対応している用紙サイズ名の一覧、用紙サイズごとに選んだ用紙サイズ名）を控えておくクラス
+    
+    lpstat や lpoptions を印刷1枚ごとに呼ばないように、一度調べた結果をttl_seconds秒のあいだ使い回す
+    プリンタの構成を変えた場合などは、refreshで控えを捨てて調べ直させる
+    """
+    
+    def __init__(self, ttl_seconds=300):
+        self.ttl_seconds = ttl_seconds
+        
+        self._destination = None  # ( 調べた時刻, {"printer": プリンタ名, "is-default": デフォルトプリンタかどうか} )
+        self._lpoptions = {}  # プリンタ名 -> ( 調べた時刻, lpoptions -l の出力 )
+        self._media_names = {}  # ( プリンタ名, 幅mm, 高さmm ) -> ( 調べた時刻, 用紙サイズ名 )
+        self._lock = threading.Lock()
+    
+    def _is_fresh(self, cached_entry):
+        return cached_entry is not None and time.monotonic() - cached_entry[0] < self.ttl_seconds
+    
+    def get_destination(self):
+        """印刷先のプリンタを {"printer": プリンタ名かNone, "is-default": bool} で返す"""
+        with self._lock:
+            if self._is_fresh(self._destination):
+                return dict(self._destination[1])
+        
+        default_printer = find_default_printer()
+        if default_printer:
+            destination = {"printer": default_printer, "is-default": True}
+        else:
+            destination = {"printer": find_first_printer(), "is-default": False}
+        
+        # プリンタが見つからなかった場合は、次回もう一度調べるように控えない
+        if destination["printer"] is not None:
+            with self._lock:
+                self._destination = (time.monotonic(), destination)
+        
+        return dict(destination)
+    
+    def get_lpoptions(self, printer_name=None):
+        """プリンタの lpoptions -l の出力（行のリスト）を返す"""
+        with self._lock:
+            cached_entry = self._lpoptions.get(printer_name)
+            if self._is_fresh(cached_entry):
+                return cached_entry[1]
+        
+        lpoptions_stdout = read_lpoptions(printer_name)
+        
+        with self._lock:
+            self._lpoptions[printer_name] = (time.monotonic(), lpoptions_stdout)
+        
+        return lpoptions_stdout
+    
+    def get_media_name(self, paper_width_mm, paper_height_mm):
+        """用紙サイズ（mm）に対応する、印刷先のプリンタの用紙サイズ名を返す"""
+        printer_name = self.get_destination()["printer"]
+        media_key = (printer_name, int(round(paper_width_mm)), int(round(paper_height_mm)))
+        
+        with self._lock:
+            cached_entry = self._media_names.get(media_key)
+            if self._is_fresh(cached_entry):
+                return cached_entry[1]
+        
+        media_name = find_media_name(paper_width_mm, paper_height_mm, self.get_lpoptions(printer_name))
+        
+        with self._lock:
+            self._media_names[media_key] = (time.monotonic(), media_name)
+        
+        return media_name
+    
+    def prepare(self, paper_width_mm, paper_height_mm):
+        """用紙サイズが決まった時点で、印刷先と用紙サイズ名を調べて控えておく（GUIの用紙サイズ変更時用）"""
+        try:
+            return self.get_media_name(paper_width_mm, paper_height_mm)
+        except Exception as e:
+            print(f"プリンタ情報の取得エラー: {e}")
+            return ""
+    
+    def refresh(self):
+        """控えておいたプリンタの情報をすべて捨てる（次に使うときに調べ直す）"""
+        with self._lock:
+            self._destination = None
+            self._lpoptions.clear()
+            self._media_names.clear()
+
+
+# 印刷処理で共有するプリンタ情報の控え
+printer_capabilities = PrinterCapabilityCache()
+
+
+class PdfPrintBatch:
+    """
+    宛名画像を1つの複数ページPDFにまとめるクラス
+    
+    add_pageで1枚ずつ追加していき、take_pdfで仕上げたPDFを受け取る（何ページごとに区切るかは呼び出し側で決める）
+    プリンタには送らないので、送るのは呼び出し側のSpoolBackendに任せる
+    中止する場合はdiscardを呼べば、作成中の分は捨てられる
+    """
+    
+    def __init__(self, paper_size="", mm_pixel_rate=8, image_encoding="grey", bilevel_threshold=128, bilevel_dither=False):
+        self.paper_size = paper_size
+        self.mm_pixel_rate = mm_pixel_rate
+        self.image_encoding = image_encoding  # PDFへの画像の埋め込み方（draw_card_imageを参照）
+        self.bilevel_threshold = bilevel_threshold
+        self.bilevel_dither = bilevel_dither
+        
+        self.pending_pages = 0  # 作成中のPDFに入っているページ数
+        
+        self._pdf_buffer = None
+        self._pdf_canvas = None
+        self._first_page_mm = None
+    
+    def add_page(self, pil_image, upside_down=False):
+        """宛名画像を1ページとして追加する"""
+        if upside_down is True:
+            pil_image = pil_image.rotate(180)
+        
+        # 画像サイズから用紙サイズを計算（mm_pixel_rate pixel/mm）
+        paper_width_mm = pil_image.size[0] / self.mm_pixel_rate
+        paper_height_mm = pil_image.size[1] / self.mm_pixel_rate
+        
+        if self._pdf_canvas is None:
+            self._pdf_buffer = BytesIO()
+            self._pdf_canvas = canvas.Canvas(self._pdf_buffer, pagesize=(paper_width_mm*mm, paper_height_mm*mm), invariant=1)
+            self._first_page_mm = (paper_width_mm, paper_height_mm)
+        else:
+            self._pdf_canvas.setPageSize((paper_width_mm*mm, paper_height_mm*mm))
+        
+        # PDFに画像を配置（用紙サイズぴったりに）
+        draw_card_image(self._pdf_canvas, pil_image, paper_width_mm*mm, paper_height_mm*mm, self.image_encoding, self.bilevel_threshold, self.bilevel_dither)
+        self._pdf_canvas.showPage()
+        self.pending_pages += 1
+    
+    def take_pdf(self):
+        """
+        作成中のPDFを仕上げて、(PDFのデータ, ページ数) を返す（ページがなければNone）
+        プリンタには送らないので、送るのは呼び出し側に任せる（印刷のパイプライン用）
+        """
+        if self._pdf_canvas is None:
+            return None
+        
+        # 用紙サイズの指定がなければ、最初のページの大きさからプリンタの用紙サイズ名を検出
+        if self.paper_size == "":
+            self.paper_size = printer_capabilities.get_media_name(self._first_page_mm[0], self._first_page_mm[1])
+        
+        try:
+            self._pdf_canvas.save()
+            return (self._pdf_buffer.getvalue(), self.pending_pages)
+        finally:
+            self.discard()
+    
+    def discard(self):
+        """作成中のPDFを、送らずに破棄する"""
+        self._pdf_buffer = None
+        self._pdf_canvas = None
+        self._first_page_mm = None
+        self.pending_pages = 0
+
+
+class PrintPipeline:
+    """
+    印刷処理を「宛先の取り出し → 宛名画像の作成 → PDF化 → プリンタへの送信」のような段に分けて、
+    各段を別々のスレッドで並行に動かすクラス
+    
+    sourceは最初の段に流す項目のイテラブル（これ自体も専用のスレッドで取り出す）
+    stagesの各段は「前の段の項目のイテレータを受け取って、次の段に渡す項目をyieldする」関数
+    （項目を捨てる場合はyieldしない。最後にまとめて渡すものがあれば、ループの後でyieldする）
+    段の間は最大queue_depth個の待ち行列でつなぐので、メモリ上にたまる項目の数はそこで頭打ちになる
+    
+    stop_checkがTrueを返すか、どこかの段で例外が起きたら、すべての段をすぐに止める
+    """
+    
+    _END = object()  # 待ち行列の終わりを示す目印
+    
+    def __init__(self, source, stages, queue_depth=4, stop_check=None):
+        self.source = source
+        self.stages = list(stages)
+        self.queue_depth = queue_depth
+        self.stop_check = stop_check
+        
+        self.results = []  # 最後の段がyieldしたもの
+        self.cancelled = False
+        
+        self._cancel_event = threading.Event()
+        self._error = None
+        self._error_lock = threading.Lock()
+    
+    def _stopped(self):
+        if self._cancel_event.is_set():
+            return True
+        
+        if self.stop_check is not None and self.stop_check():
+            self.cancelled = True
+            self._cancel_event.set()
+            return True
+        
+        return False
+    
+    def _put(self, item_queue, item):
+        """待ち行列に空きができるまで待って入れる（止められたらFalseを返す）"""
+        while not self._stopped():
             try:
-                result = subprocess.run(['lpstat', '-p'], capture_output=True, text=True, timeout=5)
-                if result.returncode == 0 and result.stdout.strip():
-                    # 最初のプリンタを使用
-                    first_line = result.stdout.strip().split('\n')[0]
-                    if first_line.startswith('printer '):
-                        printer_name = first_line.split()[1]
-                        lp_cmd.extend(['-d', printer_name])
-                        print(f"デフォルトプリンタが設定されていないため、'{printer_name}' を使用します")
-                else:
-                    raise Exception("プリンタが見つかりません。システム設定でプリンタを追加してください。")
-            except subprocess.TimeoutExpired:
-                raise Exception("プリンタの検索がタイムアウトしました")
-        
-        # PDFファイルを印刷
-        p = subprocess.Popen(lp_cmd, 
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        
-        if p.returncode != 0:
-            error_msg = stderr.decode("utf-8")
-            if "No default destination" in error_msg:
-                raise Exception("デフォルトプリンタが設定されていません。\n以下のコマンドでプリンタを確認・設定してください:\n  lpstat -p  (利用可能なプリンタ一覧)\n  lpoptions -d プリンタ名  (デフォルトプリンタの設定)")
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def _iterate(self, item_queue):
+        """待ち行列から項目を取り出すイテレータ（終わりの目印が来るか、止められたら終わる）"""
+        while not self._stopped():
+            try:
+                item = item_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            
+            if item is self._END:
+                return
+            yield item
+    
+    def _run_stage(self, stage, stage_input, output_queue):
+        stage_output = None
+        try:
+            stage_output = stage(stage_input)
+            for item in stage_output:
+                if output_queue is None:
+                    self.results.append(item)
+                elif not self._put(output_queue, item):
+                    return
+            
+            if output_queue is not None:
+                self._put(output_queue, self._END)
+        except Exception as e:
+            with self._error_lock:
+                if self._error is None:
+                    self._error = e
+            self._cancel_event.set()
+        finally:
+            # 途中で止めた段にも、後始末（ワーカープロセスの停止など）をさせる
+            if hasattr(stage_output, "close"):
+                stage_output.close()
+    
+    def run(self):
+        """
+        すべての段が終わるまで待つ。最後まで処理できればTrue、stop_checkで中止された場合はFalseを返す
+        どこかの段で例外が起きた場合は、その例外を送出する
+        """
+        queues = [queue.Queue(maxsize=self.queue_depth) for _ in self.stages]
+        
+        # 最初のスレッドはsourceから取り出して1段目に渡し、以降のスレッドは各段を動かして次の段に渡す
+        threads = [threading.Thread(target=self._run_stage, args=(iter, self.source, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            output_queue = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._run_stage, args=(stage, self._iterate(queues[i]), output_queue), daemon=True))
+        
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        if self._error is not None:
+            raise self._error
+        
+        return not self.cancelled
+
+
+class PrintJobJournal:
+    """
+    印刷ジョブの記録を、JSONファイルとしてディスクに書いておくクラス
+    
+    印刷の条件、レイアウトと住所表のハッシュ、プリンタに送り終わった行を記録しておき、
+    紙詰まりなどで中断した印刷を、送り終わった行を飛ばして続きから印刷できるようにする
+    （レイアウトか住所表のハッシュが変わっていたら、続きから印刷してはいけない）
+    送り終わった行は [最初の行, 最後の行] の範囲のリストで持つ（行番号は0から）
+    """
+    
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        
+        self.params = {}
+        self.layout_hash = ""
+        self.table_hash = ""
+        self.done_ranges = []
+        self.finished = False
+        self.write_error = None  # 最後に書き込みに失敗した時の例外（Noneなら成功している）
+    
+    @staticmethod
+    def hash_data(data):
+        """JSONにできるデータ（辞書やリスト）のハッシュを返す。辞書のキーの順番には左右されない"""
+        json_text = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(json_text.encode("utf-8")).hexdigest()
+    
+    def start(self, params, layout_hash, table_hash):
+        """新しい印刷ジョブとして記録をやり直す（前のジョブの記録は上書きされる）"""
+        self.params = dict(params)
+        self.layout_hash = layout_hash
+        self.table_hash = table_hash
+        self.done_ranges = []
+        self.finished = False
+        self._write()
+    
+    def load(self):
+        """記録ファイルを読み込む。ファイルがないか壊れていればFalseを返す"""
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                journal_data = json.load(f)
+            
+            self.params = journal_data["params"]
+            self.layout_hash = journal_data["layout-hash"]
+            self.table_hash = journal_data["table-hash"]
+            self.done_ranges = [list(done_range) for done_range in journal_data["done-ranges"]]
+            self.finished = journal_data["finished"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        
+        return True
+    
+    def matches(self, layout_hash, table_hash):
+        """記録したときとレイアウト・住所表が同じかどうかを (レイアウト, 住所表) のTrue/Falseで返す"""
+        return (self.layout_hash == layout_hash, self.table_hash == table_hash)
+    
+    def is_done(self, line_number):
+        """その行がプリンタに送り終わっているかどうか"""
+        for first_line, last_line in self.done_ranges:
+            if first_line <= line_number <= last_line:
+                return True
+        return False
+    
+    def done_count(self):
+        """プリンタに送り終わった行の数"""
+        return sum(last_line - first_line + 1 for first_line, last_line in self.done_ranges)
+    
+    def mark_done(self, line_numbers):
+        """プリンタに送り終わった行（1枚分か、まとめて印刷した1ジョブ分）を記録して、ファイルに書く"""
+        for line_number in line_numbers:
+            # 行は順番に送られるので、ほとんどは最後の範囲を伸ばすだけで済む
+            if self.done_ranges and self.done_ranges[-1][0] <= line_number <= self.done_ranges[-1][1] + 1:
+                self.done_ranges[-1][1] = max(self.done_ranges[-1][1], line_number)
+            elif not self.is_done(line_number):
+                self.done_ranges.append([line_number, line_number])
+                self._merge_ranges()
+        
+        self._write()
+    
+    def finish(self):
+        """最後まで送り終わったことを記録する（続きから印刷する対象ではなくなる）"""
+        self.finished = True
+        self._write()
+    
+    def _merge_ranges(self):
+        merged_ranges = []
+        for first_line, last_line in sorted(self.done_ranges):
+            if merged_ranges and first_line <= merged_ranges[-1][1] + 1:
+                merged_ranges[-1][1] = max(merged_ranges[-1][1], last_line)
             else:
-                raise Exception(f"印刷エラー: {error_msg}")
-    except Exception as e:
-        raise Exception(f"印刷処理でエラーが発生しました: {str(e)}")
-    finally:
-        # 一時ファイルを削除（画像とPDF）
+                merged_ranges.append([first_line, last_line])
+        self.done_ranges = merged_ranges
+    
+    def _write(self):
+        """一時ファイルに書いてから置き換えるので、書いている途中で止まっても前の記録は壊れない"""
+        journal_data = {
+            "params": self.params,
+            "layout-hash": self.layout_hash,
+            "table-hash": self.table_hash,
+            "done-ranges": self.done_ranges,
+            "finished": self.finished,
+        }
+        temporary_path = self.journal_path + ".tmp"
+        
+        # 記録が書けなくても印刷そのものは続ける（続きから印刷できなくなるだけ）
         try:
-            if os.path.exists(pdf_path):
-                os.unlink(pdf_path)
-            if os.path.exists(img_path):
-                os.unlink(img_path)
-        except:
-            pass
+            with open(temporary_path, "w", encoding="utf-8") as f:
+                json.dump(journal_data, f, ensure_ascii=False, indent=1)
+            os.replace(temporary_path, self.journal_path)
+            self.write_error = None
+        except OSError as e:
+            self.write_error = e
+            print(f"印刷ジョブの記録を書き込めませんでした: {e}")
 
+
+class PrintJobMetrics:
+    """
+    印刷ジョブの段ごとの所要時間を集計するクラス
+    
+    宛先の取り出し（extract）、宛名画像の作成（render）、PDF化（encode）、プリンタへの送信（spool）の各段で
+    1枚あたりの時間をrecordで記録し、毎分の枚数、p50/p95の時間、残り時間の見込みを出す
+    まとめて処理した段（PDF化や送信）は、かかった時間を枚数で割って1枚あたりにする
+    各段は別々のスレッドから記録するので、記録と集計はロックの中で行う
+    """
+    
+    STAGE_NAMES = ("extract", "render", "encode", "spool")
+    
+    def __init__(self, total_rows=0):
+        self.total_rows = total_rows  # 印刷範囲のうち、これから処理する行の数（残り時間の見込み用）
+        
+        self.cards_done = 0  # プリンタに送り終わった枚数
+        self.rows_skipped = 0  # 印刷の可否の設定で印刷しなかった行の数
+        self.spool_bytes = 0  # プリンタに送ったPDFの大きさの合計
+        
+        self._stage_seconds = {stage_name: [] for stage_name in self.STAGE_NAMES}
+        self._card_latencies = []  # 1枚ごとの、取り出してからプリンタに送り終わるまでの時間
+        self._card_start_times = {}
+        self._start_time = time.monotonic()
+        self._started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self._lock = threading.Lock()
+    
+    def record(self, stage_name, seconds, card_count=1):
+        """段の所要時間を記録する（card_count枚分をまとめて処理した場合は、1枚あたりにならして記録する）"""
+        if card_count <= 0:
+            return
+        
+        with self._lock:
+            self._stage_seconds[stage_name].extend([seconds / card_count] * card_count)
+    
+    def card_started(self, line_number):
+        """宛先を取り出した時刻を記録する（送り終わるまでの時間を測るため）"""
+        with self._lock:
+            self._card_start_times[line_number] = time.monotonic()
+    
+    def row_skipped(self):
+        with self._lock:
+            self.rows_skipped += 1
+    
+    def cards_spooled(self, line_numbers):
+        """プリンタに送り終わった行を記録する"""
+        now = time.monotonic()
+        with self._lock:
+            for line_number in line_numbers:
+                start_time = self._card_start_times.pop(line_number, None)
+                if start_time is not None:
+                    self._card_latencies.append(now - start_time)
+            self.cards_done += len(line_numbers)
+    
+    def record_spool_bytes(self, byte_count):
+        """プリンタに送ったPDFの大きさを記録する"""
+        with self._lock:
+            self.spool_bytes += byte_count
+    
+    def elapsed_seconds(self):
+        return time.monotonic() - self._start_time
+    
+    def cards_per_minute(self):
+        elapsed = self.elapsed_seconds()
+        if elapsed <= 0:
+            return 0.0
+        return self.cards_done * 60 / elapsed
+    
+    def eta_seconds(self):
+        """残りの行を今のペースで処理した場合の残り時間（まだ見込みが立たなければNone）"""
+        with self._lock:
+            rows_done = self.cards_done + self.rows_skipped
+        
+        if rows_done == 0:
+            return None
+        
+        return max(self.total_rows - rows_done, 0) * self.elapsed_seconds() / rows_done
+    
+    @staticmethod
+    def percentile(values, rate):
+        """valuesの百分位数（rateは0〜100。最近傍順位法）。値がなければ0.0"""
+        if not values:
+            return 0.0
+        
+        sorted_values = sorted(values)
+        rank = max(int(-(-rate * len(sorted_values) // 100)), 1)  # 切り上げ
+        return sorted_values[min(rank, len(sorted_values)) - 1]
+    
+    def stage_summary(self, stage_name):
+        """段の1枚あたりの時間の集計（件数、合計、平均、p50、p95、最大）を辞書で返す"""
+        with self._lock:
+            values = list(self._stage_seconds[stage_name])
+        
+        return self._summarize(values)
+    
+    def _summarize(self, values):
+        return {
+            "count": len(values),
+            "total-seconds": sum(values),
+            "mean-seconds": sum(values) / len(values) if values else 0.0,
+            "p50-seconds": self.percentile(values, 50),
+            "p95-seconds": self.percentile(values, 95),
+            "max-seconds": max(values) if values else 0.0,
+        }
+    
+    def status_text(self):
+        """ステータスバーに出す、進み具合と処理速度の文字列"""
+        status = f"{self.cards_done}枚送信済み　毎分{self.cards_per_minute():.1f}枚"
+        
+        eta = self.eta_seconds()
+        if eta is not None:
+            minutes, seconds = divmod(int(eta + 0.5), 60)
+            status += f"　残り約{minutes}分{seconds:02d}秒" if minutes > 0 else f"　残り約{seconds}秒"
+        
+        with self._lock:
+            latencies = list(self._card_latencies)
+        
+        render_summary = self.stage_summary("render")
+        spool_summary = self.stage_summary("spool")
+        status += f"（1枚あたり 作成 p50 {render_summary['p50-seconds']:.2f}秒/p95 {render_summary['p95-seconds']:.2f}秒、"
+        status += f"送信 p50 {spool_summary['p50-seconds']:.2f}秒/p95 {spool_summary['p95-seconds']:.2f}秒、"
+        status += f"全体 p95 {self.percentile(latencies, 95):.2f}秒）"
+        return status
+    
+    def report(self, result="", extra=None):
+        """
+        印刷ジョブ全体の集計を辞書で返す（resultは completed / cancelled / error など）
+        extraの辞書（送り方や印刷ジョブのIDなど）があれば、その項目も加える
+        """
+        with self._lock:
+            latencies = list(self._card_latencies)
+        
+        report_data = {
+            "result": result,
+            "started": self._started_at,
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "elapsed-seconds": self.elapsed_seconds(),
+            "cards": self.cards_done,
+            "rows-skipped": self.rows_skipped,
+            "cards-per-minute": self.cards_per_minute(),
+            "spool-bytes": self.spool_bytes,
+            "spool-bytes-per-card": self.spool_bytes / self.cards_done if self.cards_done > 0 else 0,
+            "stages": {stage_name: self.stage_summary(stage_name) for stage_name in self.STAGE_NAMES},
+            "card-latency": self._summarize(latencies),
+        }
+        
+        if extra is not None:
+            report_data.update(extra)
+        
+        return report_data
+    
+    def write_report(self, report_path, result="", extra=None):
+        """集計をJSONファイルに書く。書けなかった場合はFalseを返す（印刷の結果には影響させない）"""
+        try:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(self.report(result, extra), f, ensure_ascii=False, indent=1)
+        except OSError as e:
+            print(f"印刷の所要時間の記録を書き込めませんでした: {e}")
+            return False
+        
+        return True
+
+
+EXPORT_FORMATS = ("pdf", "tiff", "png")
+
+
+class CardFileExporter:
+    """
+    宛名画像を、印刷せずにファイルとして書き出すクラス
+    
+    pdf: 1つの複数ページPDF（PdfPrintBatchで作るので、まとめて印刷でプリンタに送るPDFと同じもの）
+    tiff: 1つの複数ページTIFF（1ページずつ追記するので、全ページをメモリにためない）
+    png: フォルダに1枚ずつ「行番号_氏名.png」として書く（書き込みは別スレッドで並行に行う）
+    
+    pdf_image_optionsはpdfの画像の埋め込み方（PdfPrintBatchのimage_encoding、bilevel_threshold、bilevel_ditherの辞書）
+    skip_existingがTrueなら、pngではすでにある行のファイルを飛ばす（is_existingで宛名画像を作る前に判別できる）
+    pdfとtiffは書き終わるまで一時ファイルに書いておき、closeで置き換える（abortなら一時ファイルを消す）
+    """
+    
+    def __init__(self, export_format, output_path, mm_pixel_rate=8, skip_existing=True, write_workers=4, pdf_image_options=None):
+        self.export_format = export_format
+        self.output_path = output_path
+        self.mm_pixel_rate = mm_pixel_rate
+        self.skip_existing = skip_existing
+        self.write_workers = write_workers
+        
+        self.written = 0  # 書き出した枚数
+        self.skipped = 0  # すでにあったので飛ばした枚数
+        
+        self._dpi = (25.4 * mm_pixel_rate, 25.4 * mm_pixel_rate)
+        self._temporary_path = output_path + ".tmp"
+        self._pdf_maker = None
+        self._tiff_file = None
+        self._tiff_writer = None
+        self._executor = None
+        self._pending_writes = collections.deque()
+        self._existing_files = set()
+        
+        if export_format == "pdf":
+            self._pdf_maker = PdfPrintBatch(paper_size="-", mm_pixel_rate=mm_pixel_rate, **(pdf_image_options or {}))
+        elif export_format == "tiff":
+            self._tiff_file = open(self._temporary_path, "w+b")
+            self._tiff_writer = TiffImagePlugin.AppendingTiffWriter(self._tiff_file)
+        elif export_format == "png":
+            os.makedirs(output_path, exist_ok=True)
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=write_workers)
+            
+            # すでにあるファイル名を、最初に一度だけ調べておく
+            if skip_existing:
+                self._existing_files = set(os.listdir(output_path))
+        else:
+            raise ValueError(f"書き出しの形式が不明です: {export_format}")
+    
+    def png_file_name(self, line_number, name):
+        """pngのファイル名（行番号は1から数えた5桁。ファイル名に使えない文字は氏名から除く）"""
+        safe_name = re.sub(r'[\\/:*?"<>|\s]', "_", name).strip("_.")
+        if safe_name:
+            return f"{line_number + 1:05d}_{safe_name}.png"
+        return f"{line_number + 1:05d}.png"
+    
+    def is_existing(self, line_number, name):
+        """
+        その行の画像がすでに書き出してあって、飛ばしてよいか
+        
+        この行を書き出す時と同じファイル名（png_file_name）があるかで判別するので、フォルダにある別のpngを行と取り違えない
+        """
+        if self.png_file_name(line_number, name) in self._existing_files:
+            self.skipped += 1
+            return True
+        return False
+    
+    def add(self, line_number, name, pil_image):
+        """宛名画像を1枚書き出す（pngは書き込みを別スレッドに任せ、たまりすぎたら古い方から終わるのを待つ）"""
+        if self.export_format == "pdf":
+            self._pdf_maker.add_page(pil_image)
+        elif self.export_format == "tiff":
+            pil_image.save(self._tiff_writer, format="TIFF", compression="tiff_deflate", dpi=self._dpi)
+            self._tiff_writer.newFrame()
+        else:
+            png_path = os.path.join(self.output_path, self.png_file_name(line_number, name))
+            self._pending_writes.append(self._executor.submit(pil_image.save, png_path, format="PNG", dpi=self._dpi))
+            
+            while len(self._pending_writes) >= self.write_workers * 2:
+                self._pending_writes.popleft().result()
+        
+        self.written += 1
+    
+    def close(self):
+        """書き出しを仕上げる（pdf、tiffは一時ファイルを出力先に置き換える）"""
+        if self.export_format == "pdf":
+            taken_pdf = self._pdf_maker.take_pdf()
+            if taken_pdf is not None:
+                with open(self._temporary_path, "wb") as f:
+                    f.write(taken_pdf[0])
+                os.replace(self._temporary_path, self.output_path)
+        elif self.export_format == "tiff":
+            self._tiff_writer.close()
+            self._tiff_file.close()
+            if self.written > 0:
+                os.replace(self._temporary_path, self.output_path)
+            else:
+                os.remove(self._temporary_path)
+        else:
+            try:
+                while self._pending_writes:
+                    self._pending_writes.popleft().result()
+            finally:
+                self._executor.shutdown(wait=True)
+    
+    def abort(self):
+        """途中でやめる（pdf、tiffは出力先に何も書かない。pngは書き終わった分だけ残る）"""
+        if self.export_format == "pdf":
+            self._pdf_maker.discard()
+        elif self.export_format == "tiff":
+            try:
+                self._tiff_file.close()
+                os.remove(self._temporary_path)
+            except OSError:
+                pass
+        else:
+            self._executor.shutdown(wait=True, cancel_futures=True)
@@ -8,8 +8,145 @@
 
 import os
 import re
+import threading
+from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont, ImageChops
 
+# NumPyは宛名画像をndarrayで合成するモードでのみ使う（なければそのモードは使えない）
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ImageLRUCache:
+    """
+    画像のLRUキャッシュ。
+    画像の画素数の合計がmax_bytesを超えたら、使われていない順に捨てていく。
+    キャッシュした画像は共有されるので、取り出した側で書き換えてはいけない。
+    """
+    
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._current_bytes = 0
+        # 印刷スレッドとGUIスレッドの両方から呼ばれるのでロックをかける
+        self._lock = threading.Lock()
+    
+    def __deepcopy__(self, memo):
+        # キーが画像の作成条件をすべて含んでいるので、コピーしたオブジェクトとも共有してかまわない
+        # （ロックはdeepcopyできないので、コピーせずに同じものを返す）
+        return self
+    
+    def get(self, key):
+        """キャッシュから画像を取り出す。なければNoneを返す"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, image, image_bytes=None):
+        """
+        画像をキャッシュに登録し、上限を超えた分を古い順に捨てる。
+        画像以外（画像を含むタプルなど）を登録する場合は、image_bytesで大きさを指定する。
+        """
+        if image_bytes is None:
+            image_bytes = image_size_bytes(image)
+        
+        # 1枚で上限を超えるような画像はキャッシュしない
+        if image_bytes > self.max_bytes:
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self._current_bytes -= self._entries.pop(key)[1]
+            
+            self._entries[key] = (image, image_bytes)
+            self._current_bytes += image_bytes
+            self._evict()
+    
+    def set_max_bytes(self, max_bytes):
+        """メモリ上限（バイト）を変更する"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+    
+    def clear(self):
+        """キャッシュを空にする（カウンタはそのまま）"""
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+    
+    def get_stats(self):
+        """ヒット・ミス・追い出しの回数と、現在の使用量を辞書で返す"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+                "max-bytes": self.max_bytes,
+            }
+    
+    def _evict(self):
+        while self._current_bytes > self.max_bytes and self._entries:
+            _, (_, old_bytes) = self._entries.popitem(last=False)
+            self._current_bytes -= old_bytes
+            self.evictions += 1
+
+
+def image_size_bytes(pil_image):
+    """画像の画素データのおおよそのバイト数を返す"""
+    return pil_image.size[0] * pil_image.size[1] * len(pil_image.getbands())
+
+
+# letter_to_pil_imageが使う、プロセス全体で共有するグリフキャッシュ
+# キーは（文字, フォントのパス, フォントサイズ, 台紙サイズ, 回転角度）
+glyph_cache = ImageLRUCache()
+
+
+# フォントファイルを開いたFreeTypeFontを（パス, サイズ, インデックス）ごとに使い回すためのプール
+_font_pool = {}
+_font_pool_lock = threading.Lock()
+
+
+def get_truetype_font(fontpath, fontsize, index=0):
+    """
+    FreeTypeFontをプールから取得する。まだ開いていなければ開いてプールに入れる。
+    TTC/OTFの解析は重いので、宛名画像の生成ではこの関数を通してフォントを使うこと。
+    """
+    pool_key = (fontpath, fontsize, index)
+    
+    with _font_pool_lock:
+        font = _font_pool.get(pool_key)
+        if font is None:
+            font = ImageFont.truetype(fontpath, fontsize, index=index, encoding="unic")
+            _font_pool[pool_key] = font
+    
+    return font
+
+
+def invalidate_font_pool(fontpath=None):
+    """
+    プール中のフォントを破棄する。
+    fontpathを指定すればそのフォントだけ、省略すればすべてを破棄する。
+    """
+    with _font_pool_lock:
+        if fontpath is None:
+            _font_pool.clear()
+        else:
+            for pool_key in [x for x in _font_pool if x[0] == fontpath]:
+                del _font_pool[pool_key]
+
 
 def contraction(pil_image, size_xy):
     """与えた画像を、指定したサイズに収まるように縮小して返す。（拡大はしない）"""
@@ -51,84 +188,196 @@ def contraction(pil_image, size_xy):
             return resized_image
 
 
-def pil_through_paste_greyscale(base_image, put_image, point_tuple, transparent_luminance):
-    """
-    特定の色を透明色扱いにして画像を重ねる関数（グレイスケール版）。
-    透過色以外の点では、色が合成される。
-    """
+def _through_paste_crop_box(base_size, put_size, point_tuple):
+    """透過貼り付けで、貼り付ける画像のうち台紙に収まる範囲（切り出す範囲）を返す"""
     if point_tuple[0] < 0:
         horizontal_min = point_tuple[0] * -1
-        if point_tuple[0] + put_image.size[0] > base_image.size[0]:
-            horizontal_max = point_tuple[0] * -1 + base_image.size[0]
+        if point_tuple[0] + put_size[0] > base_size[0]:
+            horizontal_max = point_tuple[0] * -1 + base_size[0]
         else:
-            horizontal_max = put_image.size[0]
+            horizontal_max = put_size[0]
     else:
         horizontal_min = 0
-        if point_tuple[0] + put_image.size[0] > base_image.size[0]:
-            horizontal_max = base_image.size[0] - point_tuple[0]
+        if point_tuple[0] + put_size[0] > base_size[0]:
+            horizontal_max = base_size[0] - point_tuple[0]
         else:
-            horizontal_max = put_image.size[0]
+            horizontal_max = put_size[0]
     
     if point_tuple[1] < 0:
         vertical_min = point_tuple[1] * -1
-        if point_tuple[1] + put_image.size[1] > base_image.size[1]:
-            vertical_max = point_tuple[1] * -1 + base_image.size[1]
+        if point_tuple[1] + put_size[1] > base_size[1]:
+            vertical_max = point_tuple[1] * -1 + base_size[1]
         else:
-            vertical_max = put_image.size[1]
+            vertical_max = put_size[1]
     else:
         vertical_min = 0
-        if point_tuple[1] + put_image.size[1] > base_image.size[1]:
-            vertical_max = base_image.size[1] - point_tuple[1]
+        if point_tuple[1] + put_size[1] > base_size[1]:
+            vertical_max = base_size[1] - point_tuple[1]
         else:
-            vertical_max = put_image.size[1]
+            vertical_max = put_size[1]
+    
+    return (horizontal_min, vertical_min, horizontal_max, vertical_max)
+
+
+def pil_through_paste_greyscale(base_image, put_image, point_tuple, transparent_luminance):
+    """
+    特定の色を透明色扱いにして画像を重ねる関数（グレイスケール版）。
+    透過色以外の点では、色が合成される。
+    画素ごとのループではなく、PillowのImageChopsでまとめて合成する。
+    """
+    crop_box = _through_paste_crop_box(base_image.size, put_image.size, point_tuple)
+    part = put_image.crop(crop_box)
     
-    part = put_image.crop((horizontal_min, vertical_min, horizontal_max, vertical_max))
-    x_max = horizontal_max - horizontal_min
-    x = 0
-    y = 0
+    # 切り出した部分はpoint_tupleを起点に置き、台紙の外（座標が負）にかかる画素は捨てる。
+    # （以前の1画素ずつ処理していた版と同じ扱いにしている）
+    skip_x = max(0, -point_tuple[0])
+    skip_y = max(0, -point_tuple[1])
+    if skip_x >= part.size[0] or skip_y >= part.size[1]:
+        return
     
-    part_data = part.getdata()
+    if skip_x > 0 or skip_y > 0:
+        part = part.crop((skip_x, skip_y, part.size[0], part.size[1]))
     
-    for i in part_data:
-        if i != transparent_luminance:
-            current_pixel = (point_tuple[0] + x, point_tuple[1] + y)
-            
-            if current_pixel[0] >= 0 and current_pixel[1] >= 0:
-                base_info = base_image.getpixel(current_pixel)
-                
-                luminance = i + base_info - 255
-                if luminance < 0:
-                    luminance = 0
-                
-                # 渡したbase_imageそのものを書き換えるので注意が必要。
-                base_image.putpixel(current_pixel, luminance)
-        
-        x += 1
-        if x == x_max:
-            x = 0
-            y += 1
+    paste_box = (
+        point_tuple[0] + skip_x,
+        point_tuple[1] + skip_y,
+        point_tuple[0] + skip_x + part.size[0],
+        point_tuple[1] + skip_y + part.size[1],
+    )
+    base_part = base_image.crop(paste_box)
+    
+    # 台紙と部品の輝度を「足して255を引く（0未満は0）」で合成する。
+    # 部品側が255（白）の点では台紙の輝度がそのまま残る。
+    composed_part = ImageChops.add(base_part, part, scale=1.0, offset=-255)
+    
+    # 透過色が白以外なら、透過色の点だけは台紙の輝度に戻す
+    if transparent_luminance != 255:
+        mask = part.point(lambda i: 0 if i == transparent_luminance else 255)
+        composed_part = Image.composite(composed_part, base_part, mask)
+    
+    # 渡したbase_imageそのものを書き換えるので注意が必要。
+    base_image.paste(composed_part, paste_box)
+
+
+def ndarray_through_paste_greyscale(base_array, put_image, point_tuple, transparent_luminance):
+    """
+    pil_through_paste_greyscaleのndarray版。
+    台紙はuint8の2次元ndarray（高さ×幅）で、貼り付ける画像はPILイメージかndarrayのどちらでもよい。
+    切り出しや台紙外の画素の扱いはPIL版と同じ。
+    """
+    put_array = numpy.asarray(put_image, dtype=numpy.uint8)
+    base_size = (base_array.shape[1], base_array.shape[0])
+    put_size = (put_array.shape[1], put_array.shape[0])
+    
+    left, upper, right, lower = _through_paste_crop_box(base_size, put_size, point_tuple)
+    # PILのcropと同じく、範囲が逆転している場合はエラーにする
+    if right < left:
+        raise ValueError("Coordinate 'right' is less than 'left'")
+    if lower < upper:
+        raise ValueError("Coordinate 'lower' is less than 'upper'")
+    
+    part = put_array[upper:lower, left:right]
+    
+    skip_x = max(0, -point_tuple[0])
+    skip_y = max(0, -point_tuple[1])
+    if skip_x >= part.shape[1] or skip_y >= part.shape[0]:
+        return
+    
+    part = part[skip_y:, skip_x:]
+    paste_x = point_tuple[0] + skip_x
+    paste_y = point_tuple[1] + skip_y
+    base_part = base_array[paste_y:paste_y + part.shape[0], paste_x:paste_x + part.shape[1]]
+    
+    composed_part = numpy.maximum(base_part.astype(numpy.int16) + part - 255, 0).astype(numpy.uint8)
+    if transparent_luminance != 255:
+        composed_part = numpy.where(part == transparent_luminance, base_part, composed_part)
+    
+    # 渡したbase_arrayそのものを書き換えるので注意が必要。
+    base_part[...] = composed_part
+
+
+def ndarray_paste(base_array, put_image, point_tuple):
+    """PILのpaste（透過なし、台紙外は切り捨て）と同じ貼り付けをndarrayで行う"""
+    put_array = numpy.asarray(put_image, dtype=numpy.uint8)
+    
+    left = max(0, point_tuple[0])
+    upper = max(0, point_tuple[1])
+    right = min(base_array.shape[1], point_tuple[0] + put_array.shape[1])
+    lower = min(base_array.shape[0], point_tuple[1] + put_array.shape[0])
+    if right <= left or lower <= upper:
+        return
+    
+    base_array[upper:lower, left:right] = put_array[upper - point_tuple[1]:lower - point_tuple[1], left - point_tuple[0]:right - point_tuple[0]]
 
 
 def letter_to_pil_image(letter, fontpath, fontsize, max_square_width, rotation_degree=0):
-    """文字と台紙イメージのサイズから、画像イメージを作成する関数。"""
+    """
+    文字と台紙イメージのサイズから、画像イメージを作成する関数。
+    同じ引数で作った画像はglyph_cacheから返すので、戻り値を書き換えないこと。
+    """
     
     if not os.path.isfile(fontpath):
         print(f"文字を画像化する関数に渡されたフォントのパス「{fontpath}」が存在しません。\n真っ黒なイメージを返しておきます")
         return Image.new("L", (int(max_square_width / 2), int(max_square_width / 2)), 0)
     
-    textimage_area = Image.new("L", (max_square_width, max_square_width), 255)
-    fnt = ImageFont.truetype(fontpath, fontsize, encoding="unic")
-    textimage_draw = ImageDraw.Draw(textimage_area)
-    textimage_draw.text((0, 0), letter, font=fnt, fill="black")
+    cache_key = (letter, fontpath, fontsize, max_square_width, rotation_degree)
+    cached_image = glyph_cache.get(cache_key)
+    if cached_image is not None:
+        return cached_image
+    
+    fnt = get_truetype_font(fontpath, fontsize)
+    
+    if rotation_degree in _TRANSPOSE_BY_DEGREE:
+        textimage_area = _rasterize_glyph(letter, fnt, max_square_width, rotation_degree)
     
-    if rotation_degree != 0:
+    # 90度単位以外の回転は、従来どおり台紙に描いてから回転させる
+    else:
+        textimage_area = Image.new("L", (max_square_width, max_square_width), 255)
+        textimage_draw = ImageDraw.Draw(textimage_area)
+        textimage_draw.text((0, 0), letter, font=fnt, fill="black")
         textimage_area = textimage_area.rotate(rotation_degree)
     
     textimage_area = greyscale_autocrop(textimage_area)
+    glyph_cache.put(cache_key, textimage_area)
     
     return textimage_area
 
 
+# 正方形の台紙をrotate()したときと同じ結果になる、90度単位の回転に対応するtranspose
+_TRANSPOSE_BY_DEGREE = {
+    0: None,
+    90: Image.ROTATE_90,
+    180: Image.ROTATE_180,
+    270: Image.ROTATE_270,
+}
+
+
+def _rasterize_glyph(letter, fnt, max_square_width, rotation_degree):
+    """
+    台紙を使わずに、文字のインクが乗る範囲だけの画像を作る。
+    FreeTypeから得たバウンディングボックスを台紙（一辺max_square_width）の範囲で切り詰め、
+    その大きさの画像に描画するので、台紙に描いてから切り抜いた場合と画素単位で一致する。
+    """
+    left, top, right, bottom = fnt.getbbox(letter)
+    left = max(left, 0)
+    top = max(top, 0)
+    right = min(right, max_square_width)
+    bottom = min(bottom, max_square_width)
+    
+    # 台紙に何も描かれない文字（スペースなど）は、空白の画像をそのままautocropに回す
+    if right <= left or bottom <= top:
+        return Image.new("L", (1, 1), 255)
+    
+    glyph_image = Image.new("L", (right - left, bottom - top), 255)
+    glyph_draw = ImageDraw.Draw(glyph_image)
+    glyph_draw.text((-left, -top), letter, font=fnt, fill="black")
+    
+    if _TRANSPOSE_BY_DEGREE[rotation_degree] is not None:
+        glyph_image = glyph_image.transpose(_TRANSPOSE_BY_DEGREE[rotation_degree])
+    
+    return glyph_image
+
+
 def greyscale_autocrop(pil_image):
     """画像の余白を除去する"""
     empty_image = Image.new("L", pil_image.size, 255)
@@ -142,6 +391,22 @@ def greyscale_autocrop(pil_image):
         return Image.new("L", (0, 0), 255)
 
 
+def greyscale_to_bilevel(pil_image, threshold=128, dither=False):
+    """
+    グレースケール画像を白黒2値（モード"1"）にする
+    ditherがFalseなら、明るさがthreshold以上を白、未満を黒にする
+    Trueなら誤差拡散（Floyd-Steinberg）で中間調を点の粗密で表す（thresholdは誤差拡散の前に明るさを寄せるのに使う）
+    """
+    if dither:
+        # thresholdが128より大きいほど暗く（黒が多く）なるように、明るさをずらしてから誤差拡散する
+        shift = 128 - threshold
+        if shift != 0:
+            pil_image = pil_image.point(lambda value: min(max(value + shift, 0), 255))
+        return pil_image.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+    
+    return pil_image.point(lambda value: 255 if value >= threshold else 0).convert("1", dither=Image.Dither.NONE)
+
+
 def maybe_list_natsort(not_sorted_list):
     """
     ファイル名を「半角数字を大小で比較しながら」ソートする関数。
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# coding:utf-8
+
+"""
+csv_utils の、wxに依存しない部分（CSVの読み込み、住所表のモデルと変更履歴）のテスト
+
+python -m unittest discover tests （または python -m pytest tests）で実行する
+"""
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from csv_utils import AddressTableHistory, AddressTableModel, collect_csv_rows, detect_csv_encoding, iter_csv_rows, read_csv_file
+
+
+class CsvEncodingFallbackTest(unittest.TestCase):
+    
+    def setUp(self):
+        # 先頭のサンプル（64KB）はASCIIだけで、その後ろにUTF-8の日本語の行があるCSV
+        self.rows = [["0", f"{i:07d}", "ascii only row padding padding padding"] for i in range(3000)]
+        self.rows.append(["1", "1000001", "東京都千代田区千代田"])
+        
+        csv_file = tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".csv", delete=False)
+        with csv_file:
+            for row in self.rows:
+                csv_file.write(",".join(row) + "\n")
+        self.csv_path = csv_file.name
+    
+    def tearDown(self):
+        os.unlink(self.csv_path)
+    
+    def test_sample_guess_fails_later(self):
+        # サンプルだけでは最初の候補（euc_jp）と判定され、そのまま1行ずつ読むと途中で読めなくなる
+        self.assertEqual(detect_csv_encoding(self.csv_path), "euc_jp")
+        with self.assertRaises(UnicodeDecodeError):
+            for line_number, row in iter_csv_rows(self.csv_path):
+                pass
+    
+    def test_collect_rereads_with_next_candidate(self):
+        collected, encoding = collect_csv_rows(self.csv_path, lambda row: row[1] + row[2])
+        self.assertEqual(encoding, "utf-8")
+        self.assertEqual(collected, [row[1] + row[2] for row in self.rows])
+    
+    def test_read_csv_file(self):
+        self.assertEqual(read_csv_file(self.csv_path), (self.rows, "utf-8"))
+
+
+
+class AddressTableSnapshotTest(unittest.TestCase):
+    
+    def test_rows_without_columns_are_not_shared(self):
+        rows = AddressTableModel.blank(3, 0).to_list()
+        rows[0].append("x")
+        self.assertEqual(rows, [["x"], [], []])
+        
+        rows = list(AddressTableModel.blank(3, 0).snapshot())
+        rows[1].append("y")
+        self.assertEqual(rows, [[], ["y"], []])
+
+
+
+def random_edit(rng, model):
+    """セル・行・列のどれかを、でたらめに1回変更する"""
+    row_count = model.get_row_count()
+    column_count = model.get_column_count()
+    kind = rng.choice(["cell", "cell", "cell", "insert-rows", "delete-rows", "insert-columns", "delete-columns"])
+    
+    if kind == "cell" and row_count > 0 and column_count > 0:
+        model.set_value(rng.randrange(row_count), rng.randrange(column_count), rng.choice(["", "東京都", "様", f"値{rng.randrange(1000)}"]))
+    elif kind == "insert-rows":
+        model.insert_rows(rng.randint(0, row_count), rng.randint(1, 3))
+    elif kind == "delete-rows" and row_count > 0:
+        model.delete_rows(rng.randrange(row_count), rng.randint(1, 3))
+    elif kind == "insert-columns":
+        model.insert_columns(rng.randint(0, column_count), rng.randint(1, 2))
+    elif kind == "delete-columns" and column_count > 0:
+        model.delete_columns(rng.randrange(column_count), rng.randint(1, 2))
+
+
+def apply_step(model, patches, undo):
+    """1回分のパッチを当てる（戻すときは逆順に）"""
+    for patch in (reversed(patches) if undo else patches):
+        model.apply_patch(patch, undo=undo)
+
+
+class AddressTableHistoryTest(unittest.TestCase):
+    
+    def make_model(self):
+        return AddressTableModel([[f"{row}-{column}" for column in range(4)] for row in range(6)])
+    
+    def test_random_undo_redo_round_trip(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            model = self.make_model()
+            history = AddressTableHistory()
+            states = [model.to_list()]
+            snapshots = [model.snapshot()]
+            
+            for step in range(40):
+                # 1回の操作で、いくつかの変更をまとめて行うこともある
+                for edit in range(rng.randint(1, 3)):
+                    random_edit(rng, model)
+                if history.record(model.take_patches()):
+                    states.append(model.to_list())
+                    snapshots.append(model.snapshot())
+            
+            self.assertEqual(history.get_state_count(), len(states))
+            
+            # 最初の状態まで戻す
+            for index in range(len(states) - 2, -1, -1):
+                apply_step(model, history.undo(), undo=True)
+                self.assertEqual(model.to_list(), states[index])
+            self.assertIsNone(history.undo())
+            
+            # 最後の状態まで進める
+            for index in range(1, len(states)):
+                apply_step(model, history.redo(), undo=False)
+                self.assertEqual(model.to_list(), states[index])
+            self.assertIsNone(history.redo())
+            
+            # 途中で取った写しは、その後の変更・アンドゥ・リドゥで変わらない
+            for snapshot, state in zip(snapshots, states):
+                self.assertEqual(snapshot.to_list(), state)
+    
+    def test_undo_does_not_change_snapshots(self):
+        model = self.make_model()
+        history = AddressTableHistory()
+        before_delete = model.snapshot()
+        model.delete_columns(1, 1)
+        history.record(model.take_patches())
+        
+        # 戻した列は写しと共有しているので、その後の変更で写しを書き換えない
+        apply_step(model, history.undo(), undo=True)
+        model.set_value(0, 1, "変更")
+        model.insert_rows(0, 1)
+        self.assertEqual(before_delete.to_list(), self.make_model().to_list())
+        self.assertEqual(model.get_value(1, 1), "変更")
+    
+    def test_record_after_undo_discards_redo(self):
+        model = self.make_model()
+        history = AddressTableHistory()
+        for value in ("a", "b", "c"):
+            model.set_value(0, 0, value)
+            history.record(model.take_patches())
+        
+        apply_step(model, history.undo(), undo=True)
+        apply_step(model, history.undo(), undo=True)
+        model.set_value(1, 1, "d")
+        history.record(model.take_patches())
+        
+        self.assertIsNone(history.redo())
+        self.assertEqual(history.get_state_count(), 3)
+        self.assertEqual(model.get_value(0, 0), "a")
+        self.assertEqual(model.get_value(1, 1), "d")
+    
+    def test_trim_drops_oldest_steps_and_keeps_newest(self):
+        model = self.make_model()
+        history = AddressTableHistory()
+        states = [model.to_list()]
+        for step in range(10):
+            model.set_value(step % 6, 0, f"値{step}")
+            history.record(model.take_patches())
+            states.append(model.to_list())
+        
+        # 新しい3回分だけ入る大きさにすると、古い7回分が捨てられる
+        history.set_memory_budget(sum(history.step_bytes[-3:]))
+        self.assertEqual(history.get_state_count(), 4)
+        self.assertLessEqual(history.total_bytes, history.memory_budget)
+        for index in (9, 8, 7):
+            apply_step(model, history.undo(), undo=True)
+            self.assertEqual(model.to_list(), states[index])
+        self.assertIsNone(history.undo())
+        
+        # リドゥできる分は、上限を超えても捨てない
+        history.set_memory_budget(0)
+        self.assertEqual(history.get_state_count(), 4)
+        for index in (8, 9, 10):
+            apply_step(model, history.redo(), undo=False)
+            self.assertEqual(model.to_list(), states[index])
+        
+        # 上限より大きくても、最新の1回分は残す
+        history.set_memory_budget(0)
+        self.assertEqual(history.get_state_count(), 2)
+        model.delete_rows(0, 6)
+        history.record(model.take_patches())
+        self.assertEqual(history.get_state_count(), 2)
+        self.assertGreater(history.total_bytes, history.memory_budget)
+        apply_step(model, history.undo(), undo=True)
+        self.assertEqual(model.to_list(), states[10])
+        self.assertIsNone(history.undo())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# coding:utf-8
+
+"""
+image_utils.pil_through_paste_greyscale() の、以前の画素ごとの版との一致を確かめるテスト
+
+python -m unittest discover tests （または python -m pytest tests）で実行する
+"""
+
+import os
+import random
+import sys
+import unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_utils import pil_through_paste_greyscale
+
+
+def reference_pil_through_paste_greyscale(base_image, put_image, point_tuple, transparent_luminance):
+    """ImageChops化する前の、getpixel/putpixelで1画素ずつ合成していた版（比較用にそのまま残す）"""
+    if point_tuple[0] < 0:
+        horizontal_min = point_tuple[0] * -1
+        if point_tuple[0] + put_image.size[0] > base_image.size[0]:
+            horizontal_max = point_tuple[0] * -1 + base_image.size[0]
+        else:
+            horizontal_max = put_image.size[0]
+    else:
+        horizontal_min = 0
+        if point_tuple[0] + put_image.size[0] > base_image.size[0]:
+            horizontal_max = base_image.size[0] - point_tuple[0]
+        else:
+            horizontal_max = put_image.size[0]
+    
+    if point_tuple[1] < 0:
+        vertical_min = point_tuple[1] * -1
+        if point_tuple[1] + put_image.size[1] > base_image.size[1]:
+            vertical_max = point_tuple[1] * -1 + base_image.size[1]
+        else:
+            vertical_max = put_image.size[1]
+    else:
+        vertical_min = 0
+        if point_tuple[1] + put_image.size[1] > base_image.size[1]:
+            vertical_max = base_image.size[1] - point_tuple[1]
+        else:
+            vertical_max = put_image.size[1]
+    
+    part = put_image.crop((horizontal_min, vertical_min, horizontal_max, vertical_max))
+    x_max = horizontal_max - horizontal_min
+    x = 0
+    y = 0
+    
+    part_data = part.getdata()
+    
+    for i in part_data:
+        if i != transparent_luminance:
+            current_pixel = (point_tuple[0] + x, point_tuple[1] + y)
+            
+            if current_pixel[0] >= 0 and current_pixel[1] >= 0:
+                base_info = base_image.getpixel(current_pixel)
+                
+                luminance = i + base_info - 255
+                if luminance < 0:
+                    luminance = 0
+                
+                base_image.putpixel(current_pixel, luminance)
+        
+        x += 1
+        if x == x_max:
+            x = 0
+            y += 1
+
+
+def random_greyscale_image(rng, width, height, luminance_choices):
+    return Image.frombytes("L", (width, height), bytes(rng.choice(luminance_choices) for i in range(width * height)))
+
+
+class ThroughPasteGreyscaleTest(unittest.TestCase):
+    
+    def assert_same_as_reference(self, base_image, put_image, point_tuple, transparent_luminance):
+        """同じ台紙の写しに両方の版で重ねて、画素（と、出るなら例外の種類）が一致することを確かめる"""
+        expected_image = base_image.copy()
+        actual_image = base_image.copy()
+        expected_error = None
+        actual_error = None
+        
+        try:
+            reference_pil_through_paste_greyscale(expected_image, put_image, point_tuple, transparent_luminance)
+        except Exception as e:
+            expected_error = type(e)
+        
+        try:
+            pil_through_paste_greyscale(actual_image, put_image, point_tuple, transparent_luminance)
+        except Exception as e:
+            actual_error = type(e)
+        
+        message = f"台紙{base_image.size} 部品{put_image.size} 位置{point_tuple} 透過色{transparent_luminance}"
+        self.assertEqual(expected_error, actual_error, message)
+        self.assertEqual(expected_image.tobytes(), actual_image.tobytes(), message)
+    
+    def test_random_images_and_offsets(self):
+        rng = random.Random(20261018)
+        
+        for case in range(1500):
+            base_image = random_greyscale_image(rng, rng.randint(1, 40), rng.randint(1, 40), [255, 255, 0, 100, 200, rng.randint(0, 255)])
+            put_image = random_greyscale_image(rng, rng.randint(1, 50), rng.randint(1, 50), [255, 255, 255, 0, 140, rng.randint(0, 255)])
+            point_tuple = (rng.randint(-60, 60), rng.randint(-60, 60))
+            transparent_luminance = rng.choice([255, 255, 140, 0])
+            
+            self.assert_same_as_reference(base_image, put_image, point_tuple, transparent_luminance)
+    
+    def test_clipping_cases(self):
+        rng = random.Random(1)
+        base_image = random_greyscale_image(rng, 30, 20, [255, 180, 60, 0])
+        put_image = random_greyscale_image(rng, 12, 8, [255, 255, 0, 90, 140])
+        
+        point_list = [
+            (0, 0),  # 台紙の内側
+            (9, 6),
+            (-5, 3),  # 左にはみ出す（負の位置）
+            (4, -3),  # 上にはみ出す
+            (-5, -3),  # 左上にはみ出す
+            (24, 15),  # 右下にはみ出す
+            (-5, 15),  # 左下にはみ出す
+            (-12, 0),  # 左に完全にはみ出す
+            (0, -8),  # 上に完全にはみ出す
+            (-40, -40),
+            (30, 0),  # 右に完全にはみ出す
+            (0, 20),  # 下に完全にはみ出す
+            (45, 30),
+        ]
+        
+        for point_tuple in point_list:
+            for transparent_luminance in (255, 140, 0):
+                self.assert_same_as_reference(base_image, put_image, point_tuple, transparent_luminance)
+    
+    def test_put_image_larger_than_base(self):
+        rng = random.Random(2)
+        base_image = random_greyscale_image(rng, 10, 10, [255, 128, 0])
+        put_image = random_greyscale_image(rng, 25, 25, [255, 0, 200])
+        
+        for point_tuple in ((0, 0), (-7, -7), (-20, 3), (3, -20), (5, 5)):
+            self.assert_same_as_reference(base_image, put_image, point_tuple, 255)
+
+
+if __name__ == "__main__":
+    unittest.main()